@@ -4,6 +4,7 @@ import logging
 import re
 import collections
 import HTSeq
+from IRTools import metrics
 
 # bad genes are those which have exons in different chromosomes or strands.
 def find_bad_genes(gtffile):
@@ -132,6 +133,7 @@ def run(args):
               	                
         
         # Read features from the input GTF file.
+        metrics.start_stage("gtf_parsing")
         gtffile = HTSeq.GFF_Reader(args.inputfile, end_included=True) # issue is likely somewhere in these two lines
         gtffile = filter(lambda feature: re.search(r'chr[a-zA-Z0-9]+$', feature.iv.chrom), gtffile)
         gtffile = list(gtffile)
@@ -151,7 +153,9 @@ def run(args):
                         gene_id = feature.attr["gene_id"]
                         transcript_id = feature.attr["transcript_id"]
                         stop_codon_region[gene_id][transcript_id] = feature.iv                         
+        metrics.end_stage()
                         
+        metrics.start_stage("feature_construction")
         gene_region = find_gene_region(transcript_region)
         gene_region_length = find_gene_region_length(gene_region, transcript_region)
         (CDS_region, five_UTR_region, three_UTR_region) = find_CDS_and_UTR_region(start_codon_region, stop_codon_region, transcript_region)
@@ -438,7 +442,10 @@ def run(args):
                         feature.attr["transcript_id"] = transcript_id
                         three_UTR_region_features[gene_id].append(feature)           
         
+        metrics.end_stage()
+        
         # Write all newly defined features into new gtf annotation file.
+        metrics.start_stage("output_writing")
         logging.info("Writing annotation to file: %s" % os.path.join(args.outdir, args.annofile))
         
         f = open(os.path.join(args.outdir, args.annofile), "w")
@@ -474,6 +481,7 @@ def run(args):
                         f.write( feature.get_gff_line() ) 
                         
         f.close()
+        metrics.end_stage()
         
                 
                                 
@@ -0,0 +1,166 @@
+import os
+import json
+import fcntl
+import logging
+import numpy as np
+import pandas as pd
+from IRTools.table_io import get_table_path, read_table, is_category_column
+
+# Cohort store: the intron, gene (and for IRC junction) level results of many samples in one directory, one row per
+# CIR/gene/CJ and one column per sample. "IRTools quant --cohort-store DIR" adds the sample of each run as a new
+# column, without rewriting the others, and "IRTools diff --cohort-store DIR" maps only the columns of the samples it
+# compares, instead of parsing a text file per replicate.
+#
+#   store.json                        quantification type, samples, and for each level the ID column, the stored
+#                                     columns (counts and IRI/IRC) and the number of IDs
+#   LEVEL.ids.txt                     IDs of the level, one per line, in the order they were first seen
+#   samples/N.LEVEL.rows.npy          rows of the IDs in the results of sample number N (int64)
+#   samples/N.LEVEL.values.npy        values of the stored columns for these rows (float64, rows x columns)
+#
+# Filtered CIRs (e.g. "NA (5'AS)") and NA are NaN. An ID missing from the results of a sample has no row in it, like
+# in its quant file.
+
+STORE_VERSION = 1
+
+LEVELS = {"IRI": ["introns", "genes"], "IRC": ["introns", "genes", "junctions"]}
+
+ID_COLUMNS = {"introns": "CIR_id", "genes": "gene_id", "junctions": "CJ_id"}
+
+class Cohort_Store(object):
+        def __init__(self, directory):
+                self.directory = directory
+                self.manifest = self.load_manifest()
+                self.ids = {}
+
+        def load_manifest(self):
+                manifest_file = os.path.join(self.directory, "store.json")
+                if not os.path.exists(manifest_file):
+                        return {'version': STORE_VERSION, 'quanttype': None, 'levels': {}, 'samples': {}, 'next_sample': 0}
+                with open(manifest_file) as f:
+                        manifest = json.load(f)
+                if manifest['version'] != STORE_VERSION:
+                        raise Exception("Cohort store {} was written by another version of IRTools.".format(self.directory))
+                return manifest
+
+        def write_manifest(self):
+                manifest_file = os.path.join(self.directory, "store.json")
+                with open(manifest_file + ".tmp", "w") as f:
+                        json.dump(self.manifest, f)
+                os.replace(manifest_file + ".tmp", manifest_file)
+
+        @property
+        def samples(self):
+                return sorted(self.manifest['samples'], key=lambda sample: self.manifest['samples'][sample])
+
+        def get_columns(self, level):
+                return self.manifest['levels'][level]['columns']
+
+        def check_samples(self, quanttype, samples):
+                if self.manifest['quanttype'] != quanttype:
+                        raise Exception("Cohort store {} holds no {} results".format(self.directory, quanttype))
+                missing = [sample for sample in samples if sample not in self.manifest['samples']]
+                if missing:
+                        raise Exception("Samples not in cohort store {}: {}".format(self.directory, ",".join(missing)))
+
+        def get_ids(self, level):
+                if level not in self.ids:
+                        with open(os.path.join(self.directory, level + ".ids.txt")) as f:
+                                ids = f.read().split("\n")
+                        # IDs appended by a later run than the manifest are left out
+                        self.ids[level] = np.array(ids[:self.manifest['levels'][level]['n_ids']], dtype=object)
+                return self.ids[level]
+
+        def get_sample_files(self, sample, level):
+                prefix = os.path.join(self.directory, "samples", "{}.{}".format(self.manifest['samples'][sample], level))
+                return prefix + ".rows.npy", prefix + ".values.npy"
+
+        # Rows (into get_ids(level)) and memory-mapped values of one sample.
+        def get_sample(self, sample, level):
+                rows_file, values_file = self.get_sample_files(sample, level)
+                return np.load(rows_file, mmap_mode="r"), np.load(values_file, mmap_mode="r")
+
+        # (IDs, values of sample) of column, in the order of the sample's results.
+        def get_sample_column(self, sample, level, column):
+                rows, values = self.get_sample(sample, level)
+                return self.get_ids(level)[rows], values[:, self.get_columns(level).index(column)]
+
+        # (IDs, values of sample: IDs x columns) of columns, in the order of the sample's results.
+        def get_sample_columns(self, sample, level, columns):
+                rows, values = self.get_sample(sample, level)
+                numbers = [self.get_columns(level).index(column) for column in columns]
+                return self.get_ids(level)[rows], np.asarray(values[:, numbers], dtype=np.float64)
+
+        # IDs x samples matrix of column. Values of IDs missing from the results of a sample are NaN.
+        def get_matrix(self, level, column, samples):
+                ids = self.get_ids(level)
+                number = self.get_columns(level).index(column)
+                matrix = np.full((len(ids), len(samples)), np.nan)
+                for i, sample in enumerate(samples):
+                        rows, values = self.get_sample(sample, level)
+                        matrix[rows, i] = values[:, number]
+                return ids, matrix
+
+        # Adds (or replaces) the results of sample. tables: level -> DataFrame as read by table_io.read_table.
+        def append(self, sample, quanttype, tables):
+                os.makedirs(os.path.join(self.directory, "samples"), exist_ok=True)
+                with open(os.path.join(self.directory, ".lock"), "w") as lock:
+                        # other runs may add their samples at the same time
+                        fcntl.flock(lock, fcntl.LOCK_EX)
+                        self.manifest = self.load_manifest()
+                        self.ids = {}
+                        if self.manifest['quanttype'] is None:
+                                self.manifest['quanttype'] = quanttype
+                        elif self.manifest['quanttype'] != quanttype:
+                                raise Exception("Cohort store {} holds {} results, {} results cannot be added".format(self.directory, self.manifest['quanttype'], quanttype))
+                        previous = self.manifest['samples'].get(sample)
+                        number = self.manifest['next_sample']
+                        for level, df in tables.items():
+                                self.append_level(number, level, df)
+                        self.manifest['samples'][sample] = number
+                        self.manifest['next_sample'] = number + 1
+                        self.write_manifest()
+                        if previous is not None:
+                                logging.info("Sample {} replaced in cohort store {}".format(sample, self.directory))
+                                for level in tables:
+                                        for filename in ("{}.{}.rows.npy".format(previous, level), "{}.{}.values.npy".format(previous, level)):
+                                                os.remove(os.path.join(self.directory, "samples", filename))
+                        logging.info("Results of sample {} added to cohort store: {}".format(sample, self.directory))
+
+        def append_level(self, number, level, df):
+                id_column = ID_COLUMNS[level]
+                columns = [column for column in df.columns if not is_category_column(column) and not column.endswith("_filter")]
+                level_info = self.manifest['levels'].setdefault(level, {'id_column': id_column, 'columns': columns, 'n_ids': 0})
+                if level_info['columns'] != columns:
+                        raise Exception("Columns of the {} results ({}) differ from those in cohort store {}".format(level, ",".join(columns), self.directory))
+                ids = self.get_ids(level) if level_info['n_ids'] else np.array([], dtype=object)
+                sample_ids = df[id_column].astype(str).to_numpy(dtype=object)
+                rows = pd.Index(ids).get_indexer(sample_ids)
+                new = rows < 0
+                new_ids = list(pd.unique(sample_ids[new]))
+                if new_ids:
+                        # the IDs file only grows; the manifest tells how much of it is valid
+                        with open(os.path.join(self.directory, level + ".ids.txt"), "r+" if level_info['n_ids'] else "w") as f:
+                                valid = "\n".join(ids)
+                                f.seek(len(valid.encode()))
+                                f.truncate()
+                                f.write(("\n" if len(ids) else "") + "\n".join(new_ids))
+                        rows[new] = len(ids) + pd.Index(new_ids).get_indexer(sample_ids[new])
+                        level_info['n_ids'] = len(ids) + len(new_ids)
+                rows = rows.astype(np.int64)
+                values = df[columns].to_numpy(dtype=np.float64)
+                prefix = os.path.join(self.directory, "samples", "{}.{}".format(number, level))
+                np.save(prefix + ".rows.npy", rows)
+                np.save(prefix + ".values.npy", values)
+
+def open_cohort_store(directory):
+        if not os.path.exists(os.path.join(directory, "store.json")):
+                raise Exception("No cohort store found in {}".format(directory))
+        return Cohort_Store(directory)
+
+# Adds the results a quant run has written (or restored from the result cache) to the cohort store.
+def append_quant_results(params):
+        prefix = os.path.join(params['outdir'], params['name'] + ".quant." + params['quanttype'])
+        tables = {}
+        for level in LEVELS[params['quanttype']]:
+                tables[level] = read_table(get_table_path(prefix + "." + level, params.get('output_format') or "tsv"))
+        Cohort_Store(params['cohort_store']).append(params['name'], params['quanttype'], tables)
@@ -11,26 +11,200 @@ import os
 import logging
 import pkg_resources
 import re
+import numpy as np
 import pandas as pd
 import subprocess
 import collections
 import copy
+import itertools
+import shutil
+import tempfile
+import multiprocessing
 import networkx as nx
 import HTSeq
-import math
-import scipy.stats
 import statsmodels.stats.multitest
-from statistics import mean
 from IRTools.quant_IRI import IRI_quant
 from IRTools.quant_IRC import IRC_quant
+from IRTools import metrics
+from IRTools.result_cache import open_diff_cache, run_with_cache
+from IRTools.cohort_store import open_cohort_store
+from IRTools.diff_input import load_level_input, stage_level_input, Staged_Level_Input, get_groups, get_replicate_names, update_input_store
+from IRTools.diff_stats import t_test, permutation_test, group_test, beta_binomial_test
+from IRTools.table_io import check_output_format, get_table_path, Table_Writer
+
+# IDs per chunk when --processes is given without --chunk-size
+DEFAULT_CHUNK_SIZE = 20000
+
+# Label permutations of --test permutation without --permutations
+DEFAULT_PERMUTATIONS = 10000
+
+# Number of IDs tested at a time (--chunk-size), None: all IDs of a level at once, in memory.
+def get_chunk_size(params):
+        if params.get('chunk_size'):
+                return params['chunk_size']
+        if (params.get('processes') or 1) > 1:
+                return DEFAULT_CHUNK_SIZE
+        return None
+
+# The inputs of one level: in memory, or with --chunk-size / --processes put into a directory under OUTDIR, from which
+# chunks of IDs are read one at a time.
+def load_input(params, store, quanttype, level, id_column, metric):
+        chunk_size = get_chunk_size(params)
+        if chunk_size is None:
+                return load_level_input(params, store, quanttype, level, id_column, metric)
+        if not params.get('stage_dir'):
+                params['stage_dir'] = tempfile.mkdtemp(prefix=".tmp." + params['name'] + ".diff.", dir=params['outdir'] or ".")
+        return stage_level_input(params, store, quanttype, level, id_column, metric, os.path.join(params['stage_dir'], level), chunk_size)
+
+def remove_stage_dir(params):
+        if params.get('stage_dir'):
+                shutil.rmtree(params['stage_dir'], ignore_errors=True)
+
+# Writes the inputs of one level to the "temp" directory, with --keep-intermediate.
+def write_level_input(params, level_input, quanttype, level, id_column, metric):
+        if not params.get('keep_intermediate'):
+                return
+        input_file_path = os.path.join(params['temp_dir'], params['name'] + ".diff.input." + quanttype + "." + level + ".txt")
+        groups = get_groups(params)
+        level_input.write(input_file_path, [id_column] + [metric + "_" + group for group, names in groups], [len(names) for group, names in groups])
+        logging.info("{} level analysis inputs can be found in {}".format(level[:-1].capitalize(), input_file_path))
+
+# A chunk of level_input. replicates: (columns, n1) to keep only some replicates (see Level_Input.select), None: all.
+def get_chunk(level_input, begin, end, replicates=None):
+        chunk = level_input.get_chunk(begin, end)
+        if replicates is not None:
+                chunk = chunk.select(*replicates)
+        return chunk
+
+# Two-sample test of S1 against S2 of a chunk: (p-values, differences). method: "t", "permutation" (with permutations)
+# or "betabinomial", the beta-binomial test of the read counts, whose differences are those of the fitted IRCs.
+def test_two_groups(chunk, paired, method, permutations):
+        if method == "betabinomial":
+                pvals, means = beta_binomial_test(chunk.get_group_counts())
+                return pvals, means[:, 1] - means[:, 0]
+        if method == "permutation":
+                return permutation_test(*chunk.get_test_values(), paired, permutations)
+        return t_test(*chunk.get_test_values(), paired)
+
+# Test across the groups of a chunk, of sizes replicates: (p-values,). method: "anova", "kruskal" or "betabinomial".
+def test_all_groups(chunk, sizes, method):
+        if method == "betabinomial":
+                return beta_binomial_test(chunk.get_group_counts(sizes))[0],
+        return group_test(chunk.get_group_values(sizes), method),
+
+# Tests a chunk of a Staged_Level_Input in a process of the pool. task: (directory, number of replicates, number of
+# replicates of S1, first row, end row, replicates, test, arguments of test).
+def test_chunk(task):
+        directory, n_replicates, n1, begin, end, replicates, test, test_args = task
+        return test(get_chunk(Staged_Level_Input(directory, None, n_replicates, n1, None), begin, end, replicates), *test_args)
+
+# Tests each chunk of level_input and gathers the results of test (a tuple of arrays, e.g. p-values) of all chunks.
+def test_chunks(params, level_input, replicates, test, test_args):
+        chunks = level_input.get_chunk_bounds()
+        processes = params.get('processes') or 1
+        if processes > 1 and len(chunks) > 1:
+                tasks = [(level_input.directory, level_input.n_replicates, level_input.n1, begin, end, replicates, test, test_args) for begin, end in chunks]
+                pool = multiprocessing.get_context("fork").Pool(min(processes, len(chunks)))
+                try:
+                        results = pool.map(test_chunk, tasks)
+                finally:
+                        pool.close()
+                        pool.join()
+        else:
+                results = [test(get_chunk(level_input, begin, end, replicates), *test_args) for begin, end in chunks]
+        return [np.concatenate(arrays) for arrays in zip(*results)]
+
+# Computes the FDR from the p-values of all IDs at once and writes the results of the IDs tested (p-value not NaN)
+# chunk by chunk: ID, p-value, FDR, the values of each group (sizes: the numbers of replicates of the groups, by default
+# S1 and S2) and the other results of the IDs (e.g. the differences). Returns the path of the results file.
+def write_level_results(params, level_input, replicates, sizes, prefix, columns, pvals, *other):
+        tested = np.flatnonzero(~np.isnan(pvals))
+
+        metrics.start_stage("fdr")
+        fdr_bool_list, fdr_pval_list = statsmodels.stats.multitest.fdrcorrection(pvals[tested])
+        metrics.end_stage()
+
+        fdr = np.full(len(pvals), np.nan)
+        fdr[tested] = fdr_pval_list
+        results_writer = Diff_Results_Writer(prefix, columns, params.get('output_format') or "tsv")
+        for begin, end in level_input.get_chunk_bounds():
+                chunk = get_chunk(level_input, begin, end, replicates)
+                chunk_tested = np.flatnonzero(~np.isnan(pvals[begin:end]))
+                rows = begin + chunk_tested
+                fields = [chunk.ids[chunk_tested], pvals[rows].tolist(), fdr[rows].tolist()] + list(zip(*chunk.format_rows(chunk_tested, sizes))) + \
+                         [values[rows].tolist() for values in other]
+                results_writer.write([list(row) for row in zip(*fields)])
+        return results_writer.close()
+
+# Tests S1 against S2 (or, with replicates, two groups of them) in the IDs of one level and writes the results to
+# NAME.diff.TYPE.LEVEL (+ contrast). Returns the path of the results file.
+def run_level_analysis(params, level_input, quanttype, level, id_column, metric, replicates=None, contrast=""):
+        method = "betabinomial" if params.get('count_test') else params.get('test') or "t"
+        pvals, differences = test_chunks(params, level_input, replicates, test_two_groups, (params["analysistype"] == "P", method, params.get('permutations') or DEFAULT_PERMUTATIONS))
+        return write_level_results(params, level_input, replicates, None, os.path.join(params['outdir'], params['name'] + ".diff." + quanttype + "." + level + contrast),
+                                   [id_column, "PValue", "FDR", metric + "_S1", metric + "_S2", metric + "_difference"], pvals, differences)
+
+# Tests the IDs of one level across the groups of --sample-sheet, and with --post-hoc each pair of groups A and B
+# (A as S1, B as S2) into NAME.diff.TYPE.LEVEL.A_vs_B. Returns the path of the results file of the test across groups.
+def run_group_analysis(params, level_input, quanttype, level, id_column, metric):
+        groups = get_groups(params)
+        sizes = [len(names) for group, names in groups]
+        method = "betabinomial" if params.get('count_test') else params.get('group_test') or "anova"
+        pvals, = test_chunks(params, level_input, None, test_all_groups, (sizes, method))
+        results_file_path = write_level_results(params, level_input, None, sizes, os.path.join(params['outdir'], params['name'] + ".diff." + quanttype + "." + level),
+                                                [id_column, "PValue", "FDR"] + [metric + "_" + group for group, names in groups], pvals)
+        if params.get('post_hoc'):
+                bounds = level_input.get_group_bounds(sizes)
+                for (a, (group_a, names_a)), (b, (group_b, names_b)) in itertools.combinations(enumerate(groups), 2):
+                        columns = list(range(*bounds[a])) + list(range(*bounds[b]))
+                        contrast_file_path = run_level_analysis(params, level_input, quanttype, level, id_column, metric, (columns, len(names_a)), "." + group_a + "_vs_" + group_b)
+                        logging.info("{} vs {} results can be found in {}".format(group_a, group_b, contrast_file_path))
+        return results_file_path
+
+# Tests the IDs of one level, S1 against S2 or across the groups of --sample-sheet.
+def analyze_level(params, level_input, quanttype, level, id_column, metric):
+        if params.get('sample_sheet'):
+                return run_group_analysis(params, level_input, quanttype, level, id_column, metric)
+        return run_level_analysis(params, level_input, quanttype, level, id_column, metric)
+
+# Writes the results of one level chunk by chunk. close() returns the path of the file.
+class Diff_Results_Writer(object):
+        def __init__(self, prefix, columns, output_format):
+                self.columns = columns
+                self.output_format = output_format
+                if output_format == "tsv":
+                        self.results_file_path = get_table_path(prefix, output_format)
+                        self.results_file = open(self.results_file_path, "w")
+                        self.results_file.write("\t".join(columns) + "\n")
+                else:
+                        self.table_writer = Table_Writer(prefix, output_format, columns)
+
+        def write(self, rows):
+                if self.output_format == "tsv":
+                        for row in rows:
+                                self.results_file.write("\t".join(str(x) for x in row) + "\n")
+                else:
+                        self.table_writer.write(pd.DataFrame(rows, columns=self.columns))
+
+        def close(self):
+                if self.output_format == "tsv":
+                        self.results_file.close()
+                        return self.results_file_path
+                return self.table_writer.close()
 
 class IRI_diff(object):
         def __init__(self, args):
                 self.params = args.__dict__.copy()
                 
-                self.temp_dir = self.check_temp_dir(self.params['outdir']) 
-                print("\tNote: Running \"IRTools diff\" will produce some intermediate files saved in directory: {}/".format(self.temp_dir))
-                sys.stdout.flush()   
+                if self.params.get('keep_intermediate'):
+                        self.params['temp_dir'] = self.check_temp_dir(self.params['outdir'])
+                        print("\tNote: The intermediate files of \"IRTools diff\" will be saved in directory: {}/".format(self.params['temp_dir']))
+                        sys.stdout.flush()
+
+                self.store = None
+                if self.params.get('cohort_store'):
+                        self.store = open_cohort_store(self.params['cohort_store'])
+                        self.store.check_samples("IRI", get_replicate_names(self.params))
                 
                 self.logger = logging.getLogger()
         
@@ -45,192 +219,26 @@ class IRI_diff(object):
                                              
                 return temp_dir                  
         
-        @staticmethod
-        def count_distinct_vals(num_IRI_S1, num_IRI_S2):
-                distinct_vals = []
-                for x in num_IRI_S1:
-                        if x not in distinct_vals:
-                                distinct_vals.append(x)
-                for x in num_IRI_S2:
-                        if x not in distinct_vals:
-                                distinct_vals.append(x)
-                return len(distinct_vals)
                                             
         def generate_input_intron_level(self):
                 logging.info("Generating inputs for analysis for differential IR in intron level")
-
-                temp_dict = {}
-
-                for i in self.params['s1files'].split(','):
-                        file_path = os.path.join(self.params['indir'], i + ".quant.IRI.introns.txt")
-                        data = open(file_path, "r")
-                        lines = [x.strip("\n") for x in data if x != "\n"]
-                        if not temp_dict:
-                                for l in lines:
-                                        temp_dict[l.split()[0]] = ([l.split()[8]], [])
-                        else:
-                                for l in lines:
-                                        if l.split()[0] not in temp_dict.keys():
-                                                temp_dict[l.split()[0]] = ([l.split()[8]], [])
-                                        else:
-                                                temp_dict[l.split()[0]][0].append(l.split()[8])    
-                        data.close()
-
-                for i in self.params['s2files'].split(','):
-                        file_path = os.path.join(self.params['indir'], i + ".quant.IRI.introns.txt")
-                        data = open(file_path, "r")
-                        lines = [x.strip("\n") for x in data if x != "\n"]
-                        for l in lines:
-                                if l.split()[0] not in temp_dict.keys():
-                                        temp_dict[l.split()[0]] = ([], [l.split()[8]])
-                                else:
-                                        temp_dict[l.split()[0]][1].append(l.split()[8])    
-                        data.close()
-
-                del temp_dict["CIR_id"]
-                self.input_intron_dict = temp_dict
-
-                input_file_path = os.path.join(self.temp_dir, self.params['name'] + ".diff.input.IRI.introns.txt")
-                input_file = open(input_file_path, "w")
-                input_file.write("CIR_id\tintron_IRI_S1\tintron_IRI_S2\n")
-                for id in sorted(self.input_intron_dict.keys()):
-                        input_file.write(id + "\t" + ",".join(self.input_intron_dict[id][0]) + "\t" + ",".join(self.input_intron_dict[id][1]) + "\n")
-                input_file.close()
-                
-                logging.info("Intron level analysis inputs can be found in " + input_file_path)
+                self.input_intron = load_input(self.params, self.store, "IRI", "introns", "CIR_id", "intron_IRI")
+                write_level_input(self.params, self.input_intron, "IRI", "introns", "CIR_id", "intron_IRI")
 
         def generate_input_gene_level(self):
                 logging.info("Generating inputs for analysis for differential IR in gene level")
-
-                temp_dict = {}
-
-                for i in self.params['s1files'].split(','):
-                        file_path = os.path.join(self.params['indir'], i + ".quant.IRI.genes.txt")
-                        data = open(file_path, "r")
-                        lines = [x.strip("\n") for x in data if x != "\n"]
-                        if not temp_dict:
-                                for l in lines:
-                                        temp_dict[l.split()[0]] = ([l.split()[8]], [])
-                        else:                                
-                                for l in lines:
-                                        if l.split()[0] not in temp_dict.keys():
-                                                temp_dict[l.split()[0]] = ([l.split()[8]], [])
-                                        else:
-                                                temp_dict[l.split()[0]][0].append(l.split()[8])
-                        data.close()
-
-                for i in self.params['s2files'].split(','):
-                        file_path = os.path.join(self.params['indir'], i + ".quant.IRI.genes.txt")
-                        data = open(file_path, "r")
-                        lines = [x.strip("\n") for x in data if x != "\n"]
-                        for l in lines:
-                                if l.split()[0] not in temp_dict.keys():
-                                        temp_dict[l.split()[0]] = ([], [l.split()[8]])
-                                else:
-                                        temp_dict[l.split()[0]][1].append(l.split()[8])
-                        data.close()
-
-                del temp_dict["gene_id"]
-                self.input_gene_dict = temp_dict
-
-                input_file_path = os.path.join(self.temp_dir, self.params['name'] + ".diff.input.IRI.genes.txt")
-                input_file = open(input_file_path, "w")
-                input_file.write("gene_id\tgene_IRI_S1\tgene_IRI_S2\n")
-                for id in sorted(self.input_gene_dict.keys()):
-                        input_file.write(id + "\t" + ",".join(self.input_gene_dict[id][0]) + "\t" + ",".join(self.input_gene_dict[id][1]) + "\n")
-                input_file.close()
-
-                logging.info("Gene level analysis inputs can be found at " + input_file_path)
+                self.input_gene = load_input(self.params, self.store, "IRI", "genes", "gene_id", "gene_IRI")
+                write_level_input(self.params, self.input_gene, "IRI", "genes", "gene_id", "gene_IRI")
 
         def run_analysis_intron_level(self):
                 logging.info("Running analysis for differential IR in intron level")
-
-                filtered_introns = {}
-                pval_list = []
-                IRI_diff_list = []
-
-                for id in sorted(self.input_intron_dict.keys()):
-                        intron_IRI_S1 = self.input_intron_dict[id][0]
-                        intron_IRI_S2 = self.input_intron_dict[id][1]
-                        num_intron_IRI_S1 = []
-                        num_intron_IRI_S2 = []
-                        if self.params["analysistype"] == "P":
-                                for i, val in enumerate(intron_IRI_S1):
-                                        if val != "NA" and val != 'inf' and intron_IRI_S2[i] != "NA" and intron_IRI_S2[i] != 'inf':
-                                                num_intron_IRI_S1.append(float(val))
-                                                num_intron_IRI_S2.append(float(intron_IRI_S2[i]))
-                        else:
-                                num_intron_IRI_S1 = [float(x) for x in intron_IRI_S1 if x != "NA" and x != 'inf']
-                                num_intron_IRI_S2 = [float(x) for x in intron_IRI_S2 if x != "NA" and x != 'inf']
-                        if self.count_distinct_vals(num_intron_IRI_S1, num_intron_IRI_S2) == 1:
-                                continue
-                        if len(num_intron_IRI_S1) < 2 or len(num_intron_IRI_S2) < 2:
-                                continue
-                        if self.params["analysistype"] == "P":
-                                pval = scipy.stats.ttest_rel(num_intron_IRI_S1, num_intron_IRI_S2)[1]
-                        else:
-                                pval = scipy.stats.ttest_ind(num_intron_IRI_S1, num_intron_IRI_S2)[1]
-                        if math.isnan(pval):
-                                continue
-                        filtered_introns[id] = (intron_IRI_S1, intron_IRI_S2)
-                        pval_list.append(pval)
-                        diff = mean(num_intron_IRI_S2) - mean(num_intron_IRI_S1)
-                        IRI_diff_list.append(diff)
-                
-                fdr_bool_list, fdr_pval_list = statsmodels.stats.multitest.fdrcorrection(pval_list)
-                
-                results_file_path = os.path.join(self.params['outdir'], self.params['name'] + ".diff.IRI.introns.txt")
-                results_file = open(results_file_path, "w")
-                results_file.write("CIR_id\tPValue\tFDR\tintron_IRI_S1\tintron_IRI_S2\tintron_IRI_difference\n")
-                for i, id in enumerate(sorted(filtered_introns.keys())):
-                        results_file.write(id + "\t" + str(pval_list[i]) + "\t" + str(fdr_pval_list[i]) + "\t" + ",".join(filtered_introns[id][0]) + "\t" + ",".join(filtered_introns[id][1]) + "\t" + str(IRI_diff_list[i]) + "\n")
-                results_file.close()
+                results_file_path = analyze_level(self.params, self.input_intron, "IRI", "introns", "CIR_id", "intron_IRI")
 
                 logging.info("Intron level differential IR results can be found in " + results_file_path)
 
         def run_analysis_gene_level(self):
                 logging.info("Running analysis for differential IR in gene level")
-
-                filtered_genes = {}
-                pval_list = []
-                IRI_diff_list = []
-
-                for id in sorted(self.input_gene_dict.keys()):
-                        gene_IRI_S1 = self.input_gene_dict[id][0]
-                        gene_IRI_S2 = self.input_gene_dict[id][1]
-                        num_gene_IRI_S1 = []
-                        num_gene_IRI_S2 = []
-                        if self.params["analysistype"] == "P":
-                                for i, val in enumerate(gene_IRI_S1):
-                                        if val != "NA" and val != 'inf' and gene_IRI_S2[i] != "NA" and gene_IRI_S2[i] != 'inf':
-                                                num_gene_IRI_S1.append(float(val))
-                                                num_gene_IRI_S2.append(float(gene_IRI_S2[i]))
-                        else:
-                                num_gene_IRI_S1 = [float(x) for x in gene_IRI_S1 if x != "NA" and x != 'inf']
-                                num_gene_IRI_S2 = [float(x) for x in gene_IRI_S2 if x != "NA" and x != 'inf']
-                        if self.count_distinct_vals(num_gene_IRI_S1, num_gene_IRI_S2) == 1:
-                                continue
-                        if len(num_gene_IRI_S1) < 2 or len(num_gene_IRI_S2) < 2:
-                                continue
-                        if self.params["analysistype"] == "P":
-                                pval = scipy.stats.ttest_rel(num_gene_IRI_S1, num_gene_IRI_S2)[1]
-                        else:
-                                pval = scipy.stats.ttest_ind(num_gene_IRI_S1, num_gene_IRI_S2)[1]
-                        if math.isnan(pval):
-                                continue
-                        filtered_genes[id] = (gene_IRI_S1, gene_IRI_S2)
-                        pval_list.append(pval)
-                        diff = mean(num_gene_IRI_S2) - mean(num_gene_IRI_S1)
-                        IRI_diff_list.append(diff)
-
-                fdr_bool_list, fdr_pval_list = statsmodels.stats.multitest.fdrcorrection(pval_list)
-
-                results_file_path = os.path.join(self.params['outdir'], self.params['name'] + ".diff.IRI.genes.txt")
-                results_file = open(results_file_path, "w")
-                results_file.write("gene_id\tPValue\tFDR\tgene_IRI_S1\tgene_IRI_S2\tgene_IRI_difference\n")
-                for i, id in enumerate(sorted(filtered_genes.keys())):
-                        results_file.write(id + "\t" + str(pval_list[i]) + "\t" + str(fdr_pval_list[i]) + "\t" + ",".join(filtered_genes[id][0]) + "\t" + ",".join(filtered_genes[id][1]) + "\t" + str(IRI_diff_list[i]) + "\n")
-                results_file.close()
+                results_file_path = analyze_level(self.params, self.input_gene, "IRI", "genes", "gene_id", "gene_IRI")
 
                 logging.info("Gene level differential IR results can be found in " + results_file_path)
 
@@ -238,9 +246,15 @@ class IRC_diff(object):
         def __init__(self, args):
                 self.params = args.__dict__.copy()
                 
-                self.temp_dir = self.check_temp_dir(self.params['outdir']) 
-                print("\tNote: Running \"IRTools diff\" will produce some intermediate files saved in directory: {}/".format(self.temp_dir))
-                sys.stdout.flush()   
+                if self.params.get('keep_intermediate'):
+                        self.params['temp_dir'] = self.check_temp_dir(self.params['outdir'])
+                        print("\tNote: The intermediate files of \"IRTools diff\" will be saved in directory: {}/".format(self.params['temp_dir']))
+                        sys.stdout.flush()
+
+                self.store = None
+                if self.params.get('cohort_store'):
+                        self.store = open_cohort_store(self.params['cohort_store'])
+                        self.store.check_samples("IRC", get_replicate_names(self.params))
                 
                 self.logger = logging.getLogger()  
                 
@@ -255,312 +269,112 @@ class IRC_diff(object):
                                              
                 return temp_dir  
         
-        @staticmethod
-        def count_distinct_vals(num_IRC_S1, num_IRC_S2):
-                distinct_vals = []
-                for x in num_IRC_S1:
-                        if x not in distinct_vals:
-                                distinct_vals.append(x)
-                for x in num_IRC_S2:
-                        if x not in distinct_vals:
-                                distinct_vals.append(x)
-                return len(distinct_vals)
                                             
         def generate_input_intron_level(self):
                 logging.info("Generating inputs for analysis for differential IR in intron level")
-
-                temp_dict = {}
-
-                for i in self.params['s1files'].split(','):
-                        file_path = os.path.join(self.params['indir'], i + ".quant.IRC.introns.txt")
-                        data = open(file_path, "r")
-                        lines = [x.strip("\n") for x in data if x != "\n"]
-                        if not temp_dict:
-                                for l in lines:
-                                        temp_dict[l.split()[0]] = ([l.split()[5]], [])
-                        else:
-                                for l in lines:
-                                        if l.split()[0] not in temp_dict.keys():
-                                                temp_dict[l.split()[0]] = ([l.split()[5]], [])
-                                        else:
-                                                temp_dict[l.split()[0]][0].append(l.split()[5])    
-                        data.close()
-
-                for i in self.params['s2files'].split(','):
-                        file_path = os.path.join(self.params['indir'], i + ".quant.IRC.introns.txt")
-                        data = open(file_path, "r")
-                        lines = [x.strip("\n") for x in data if x != "\n"]
-                        for l in lines:
-                                if l.split()[0] not in temp_dict.keys():
-                                        temp_dict[l.split()[0]] = ([], [l.split()[5]])
-                                else:
-                                        temp_dict[l.split()[0]][1].append(l.split()[5])    
-                        data.close()
-
-                del temp_dict["CIR_id"]
-                self.input_intron_dict = temp_dict
-
-                input_file_path = os.path.join(self.temp_dir, self.params['name'] + ".diff.input.IRC.introns.txt")
-                input_file = open(input_file_path, "w")
-                input_file.write("CIR_id\tintron_IRC_S1\tintron_IRC_S2\n")
-                for id in sorted(self.input_intron_dict.keys()):
-                        input_file.write(id + "\t" + ",".join(self.input_intron_dict[id][0]) + "\t" + ",".join(self.input_intron_dict[id][1]) + "\n")
-                input_file.close()
-
-                logging.info("Intron level analysis inputs can be found in " + input_file_path)
+                self.input_intron = load_input(self.params, self.store, "IRC", "introns", "CIR_id", "intron_IRC")
+                write_level_input(self.params, self.input_intron, "IRC", "introns", "CIR_id", "intron_IRC")
 
         def generate_input_gene_level(self):
                 logging.info("Generating inputs for analysis for differential IR in gene level")
-
-                temp_dict = {}
-
-                for i in self.params['s1files'].split(','):
-                        file_path = os.path.join(self.params['indir'], i + ".quant.IRC.genes.txt")
-                        data = open(file_path, "r")
-                        lines = [x.strip("\n") for x in data if x != "\n"]
-                        if not temp_dict:
-                                for l in lines:
-                                        temp_dict[l.split()[0]] = ([l.split()[4]], [])
-                        else:
-                                for l in lines:
-                                        if l.split()[0] not in temp_dict.keys():
-                                                temp_dict[l.split()[0]] = ([l.split()[4]], [])
-                                        else:
-                                                temp_dict[l.split()[0]][0].append(l.split()[4])    
-                        data.close()
-
-                for i in self.params['s2files'].split(','):
-                        file_path = os.path.join(self.params['indir'], i + ".quant.IRC.genes.txt")
-                        data = open(file_path, "r")
-                        lines = [x.strip("\n") for x in data if x != "\n"]
-                        for l in lines:
-                                if l.split()[0] not in temp_dict.keys():
-                                        temp_dict[l.split()[0]] = ([], [l.split()[4]])
-                                else:
-                                        temp_dict[l.split()[0]][1].append(l.split()[4])    
-                        data.close()
-
-                del temp_dict["gene_id"]
-                self.input_gene_dict = temp_dict
-
-                input_file_path = os.path.join(self.temp_dir, self.params['name'] + ".diff.input.IRC.genes.txt")
-                input_file = open(input_file_path, "w")
-                input_file.write("gene_id\tgene_IRC_S1\tgene_IRC_S2\n")
-                for id in sorted(self.input_gene_dict.keys()):
-                        input_file.write(id + "\t" + ",".join(self.input_gene_dict[id][0]) + "\t" + ",".join(self.input_gene_dict[id][1]) + "\n")
-                input_file.close()
-
-                logging.info("Gene level analysis inputs can be found at " + input_file_path)
+                self.input_gene = load_input(self.params, self.store, "IRC", "genes", "gene_id", "gene_IRC")
+                write_level_input(self.params, self.input_gene, "IRC", "genes", "gene_id", "gene_IRC")
 
         def generate_input_junction_level(self):
                 logging.info("Generating inputs for analysis for differential IR in junction level")
-
-                temp_dict = {}
-
-                for i in self.params['s1files'].split(','):
-                        file_path = os.path.join(self.params['indir'], i + ".quant.IRC.junctions.txt")
-                        data = open(file_path, "r")
-                        lines = [x.strip("\n") for x in data if x != "\n"]
-                        if not temp_dict:
-                                for l in lines:
-                                        temp_dict[l.split()[0]] = ([l.split()[5]], [])
-                        else:
-                                for l in lines:
-                                        if l.split()[0] not in temp_dict.keys():
-                                                temp_dict[l.split()[0]] = ([l.split()[5]], [])
-                                        else:
-                                                temp_dict[l.split()[0]][0].append(l.split()[5])    
-                        data.close()
-
-                for i in self.params['s2files'].split(','):
-                        file_path = os.path.join(self.params['indir'], i + ".quant.IRC.junctions.txt")
-                        data = open(file_path, "r")
-                        lines = [x.strip("\n") for x in data if x != "\n"]
-                        for l in lines:
-                                if l.split()[0] not in temp_dict.keys():
-                                        temp_dict[l.split()[0]] = ([], [l.split()[5]])
-                                else:
-                                        temp_dict[l.split()[0]][1].append(l.split()[5])
-                        data.close()
-
-                del temp_dict["CJ_id"]
-                self.input_junction_dict = temp_dict
-
-                input_file_path = os.path.join(self.temp_dir, self.params['name'] + ".diff.input.IRC.junctions.txt")
-                input_file = open(input_file_path, "w")
-                input_file.write("CJ_id\tjunction_IRC_S1\tjunction_IRC_S2\n")
-                for id in sorted(self.input_junction_dict.keys()):
-                        input_file.write(id + "\t" + ",".join(self.input_junction_dict[id][0]) + "\t" + ",".join(self.input_junction_dict[id][1]) + "\n")
-                input_file.close()
-
-                logging.info("junction level analysis inputs can be found at " + input_file_path)
+                self.input_junction = load_input(self.params, self.store, "IRC", "junctions", "CJ_id", "junction_IRC")
+                write_level_input(self.params, self.input_junction, "IRC", "junctions", "CJ_id", "junction_IRC")
 
         def run_analysis_intron_level(self):
                 logging.info("Running analysis for differential IR in intron level")
-
-                filtered_introns = {}
-                pval_list = []
-                IRC_diff_list = []
-
-                for id in sorted(self.input_intron_dict.keys()):
-                        intron_IRC_S1 = self.input_intron_dict[id][0]
-                        intron_IRC_S2 = self.input_intron_dict[id][1]
-                        num_intron_IRC_S1 = []
-                        num_intron_IRC_S2 = []
-                        if self.params["analysistype"] == "P":
-                                for i, val in enumerate(intron_IRC_S1):
-                                        if val != "NA" and val != 'inf' and intron_IRC_S2[i] != "NA" and intron_IRC_S2[i] != 'inf':
-                                                num_intron_IRC_S1.append(float(val))
-                                                num_intron_IRC_S2.append(float(intron_IRC_S2[i]))
-                        else:
-                                num_intron_IRC_S1 = [float(x) for x in intron_IRC_S1 if x != "NA" and x != 'inf']
-                                num_intron_IRC_S2 = [float(x) for x in intron_IRC_S2 if x != "NA" and x != 'inf']
-                        if self.count_distinct_vals(num_intron_IRC_S1, num_intron_IRC_S2) == 1:
-                                continue
-                        if len(num_intron_IRC_S1) < 2 or len(num_intron_IRC_S2) < 2:
-                                continue
-                        if self.params["analysistype"] == "P":
-                                pval = scipy.stats.ttest_rel(num_intron_IRC_S1, num_intron_IRC_S2)[1]
-                        else:
-                                pval = scipy.stats.ttest_ind(num_intron_IRC_S1, num_intron_IRC_S2)[1]
-                        if math.isnan(pval):
-                                continue
-                        filtered_introns[id] = (intron_IRC_S1, intron_IRC_S2)
-                        pval_list.append(pval)
-                        diff = mean(num_intron_IRC_S2) - mean(num_intron_IRC_S1)
-                        IRC_diff_list.append(diff)
-                
-                fdr_bool_list, fdr_pval_list = statsmodels.stats.multitest.fdrcorrection(pval_list)
-
-                results_file_path = os.path.join(self.params['outdir'], self.params['name'] + ".diff.IRC.introns.txt")
-                results_file = open(results_file_path, "w")
-                results_file.write("CIR_id\tPValue\tFDR\tintron_IRC_S1\tintron_IRC_S2\tintron_IRC_difference\n")
-                for i, id in enumerate(sorted(filtered_introns.keys())):
-                        results_file.write(id + "\t" + str(pval_list[i]) + "\t" + str(fdr_pval_list[i]) + "\t" + ",".join(filtered_introns[id][0]) + "\t" + ",".join(filtered_introns[id][1]) + "\t" + str(IRC_diff_list[i]) + "\n")
-                results_file.close()
+                results_file_path = analyze_level(self.params, self.input_intron, "IRC", "introns", "CIR_id", "intron_IRC")
 
                 logging.info("Intron level differential IR results can be found in " + results_file_path)
 
         def run_analysis_gene_level(self):
                 logging.info("Running analysis for differential IR in gene level")
-
-                filtered_genes = {}
-                pval_list = []
-                IRC_diff_list = []
-
-                for id in sorted(self.input_gene_dict.keys()):
-                        gene_IRC_S1 = self.input_gene_dict[id][0]
-                        gene_IRC_S2 = self.input_gene_dict[id][1]
-                        num_gene_IRC_S1 = []
-                        num_gene_IRC_S2 = []
-                        if self.params["analysistype"] == "P":
-                                for i, val in enumerate(gene_IRC_S1):
-                                        if val != "NA" and val != 'inf' and gene_IRC_S2[i] != "NA" and gene_IRC_S2[i] != 'inf':
-                                                num_gene_IRC_S1.append(float(val))
-                                                num_gene_IRC_S2.append(float(gene_IRC_S2[i]))
-                        else:
-                                num_gene_IRC_S1 = [float(x) for x in gene_IRC_S1 if x != "NA" and x != 'inf']
-                                num_gene_IRC_S2 = [float(x) for x in gene_IRC_S2 if x != "NA" and x != 'inf']
-                        if self.count_distinct_vals(num_gene_IRC_S1, num_gene_IRC_S2) == 1:
-                                continue
-                        if len(num_gene_IRC_S1) < 2 or len(num_gene_IRC_S2) < 2:
-                                continue
-                        if self.params["analysistype"] == "P":
-                                pval = scipy.stats.ttest_rel(num_gene_IRC_S1, num_gene_IRC_S2)[1]
-                        else:
-                                pval = scipy.stats.ttest_ind(num_gene_IRC_S1, num_gene_IRC_S2)[1]
-                        if math.isnan(pval):
-                                continue
-                        filtered_genes[id] = (gene_IRC_S1, gene_IRC_S2)
-                        pval_list.append(pval)
-                        diff = mean(num_gene_IRC_S2) - mean(num_gene_IRC_S1)
-                        IRC_diff_list.append(diff)
-
-                fdr_bool_list, fdr_pval_list = statsmodels.stats.multitest.fdrcorrection(pval_list)
-
-                results_file_path = os.path.join(self.params['outdir'], self.params['name'] + ".diff.IRC.genes.txt")
-                results_file = open(results_file_path, "w")
-                results_file.write("gene_id\tPValue\tFDR\tgene_IRC_S1\tgene_IRC_S2\tgene_IRC_difference\n")
-                for i, id in enumerate(sorted(filtered_genes.keys())):
-                        results_file.write(id + "\t" + str(pval_list[i]) + "\t" + str(fdr_pval_list[i]) + "\t" + ",".join(filtered_genes[id][0]) + "\t" + ",".join(filtered_genes[id][1]) + "\t" + str(IRC_diff_list[i]) + "\n")
-                results_file.close()
+                results_file_path = analyze_level(self.params, self.input_gene, "IRC", "genes", "gene_id", "gene_IRC")
 
                 logging.info("Gene level differential IR results can be found in " + results_file_path)
 
         def run_analysis_junction_level(self):
                 logging.info("Running analysis for differential IR in junction level")
-
-                filtered_junctions = {}
-                pval_list = []
-                IRC_diff_list = []
-
-                for id in sorted(self.input_junction_dict.keys()):
-                        junction_IRC_S1 = self.input_junction_dict[id][0]
-                        junction_IRC_S2 = self.input_junction_dict[id][1]
-                        num_junction_IRC_S1 = []
-                        num_junction_IRC_S2 = []
-                        if self.params["analysistype"] == "P":
-                                for i, val in enumerate(junction_IRC_S1):
-                                        if val != "NA" and val != 'inf' and junction_IRC_S2[i] != "NA" and junction_IRC_S2[i] != 'inf':
-                                                num_junction_IRC_S1.append(float(val))
-                                                num_junction_IRC_S2.append(float(junction_IRC_S2[i]))
-                        else:
-                                num_junction_IRC_S1 = [float(x) for x in junction_IRC_S1 if x != "NA" and x != 'inf']
-                                num_junction_IRC_S2 = [float(x) for x in junction_IRC_S2 if x != "NA" and x != 'inf']
-                        if self.count_distinct_vals(num_junction_IRC_S1, num_junction_IRC_S2) == 1:
-                                continue
-                        if len(num_junction_IRC_S1) < 2 or len(num_junction_IRC_S2) < 2:
-                                continue
-                        if self.params["analysistype"] == "P":
-                                pval = scipy.stats.ttest_rel(num_junction_IRC_S1, num_junction_IRC_S2)[1]
-                        else:
-                                pval = scipy.stats.ttest_ind(num_junction_IRC_S1, num_junction_IRC_S2)[1]
-                        if math.isnan(pval):
-                                continue
-                        filtered_junctions[id] = (junction_IRC_S1, junction_IRC_S2)
-                        pval_list.append(pval)
-                        diff = mean(num_junction_IRC_S2) - mean(num_junction_IRC_S1)
-                        IRC_diff_list.append(diff)
-
-                fdr_bool_list, fdr_pval_list = statsmodels.stats.multitest.fdrcorrection(pval_list)
-
-                results_file_path = os.path.join(self.params['outdir'], self.params['name'] + ".diff.IRC.junctions.txt")
-                results_file = open(results_file_path, "w")
-                results_file.write("CJ_id\tPValue\tFDR\tjunction_IRC_S1\tjunction_IRC_S2\tjunction_IRC_difference\n")
-                for i, id in enumerate(sorted(filtered_junctions.keys())):
-                        results_file.write(id + "\t" + str(pval_list[i]) + "\t" + str(fdr_pval_list[i]) + "\t" + ",".join(filtered_junctions[id][0]) + "\t" + ",".join(filtered_junctions[id][1]) + "\t" + str(IRC_diff_list[i]) + "\n")
-                results_file.close()
+                results_file_path = analyze_level(self.params, self.input_junction, "IRC", "junctions", "CJ_id", "junction_IRC")
 
                 logging.info("Junction level differential IR results can be found in " + results_file_path)
 
-def run(args):
+# Logs why the replicates cannot be compared, if they cannot.
+def check_groups(params):
+        groups = get_groups(params)
+        if len(groups) < 2:
+                logging.info("Run Aborted: Differential IR analysis requires at least two groups of replicates in the sample sheet. Please check input.")
+                return False
+        if any(len(names) < 2 for group, names in groups):
+                logging.info("Run Aborted: Differential IR analysis requires at least two replicates per sample. Please check input.")
+                return False
+        if params['analysistype'] == "P" and len(set(len(names) for group, names in groups)) > 1:
+                logging.info("Run Aborted: Samples must have the same number of replicates for paired analysis. Please check input.")
+                return False
+        return True
+
+def run_diff(args):
         if args.quanttype == "IRI":
                 IRI_differ = IRI_diff(args)
-                if ',' not in IRI_differ.params['s1files'] or ',' not in IRI_differ.params['s2files']:
-                        logging.info("Run Aborted: Differential IR analysis requires at least two replicates per sample. Please check input.")
+                if not check_groups(IRI_differ.params):
                         exit()
-                if IRI_differ.params['analysistype'] == "P" and IRI_differ.params['s1files'].count(',') != IRI_differ.params['s2files'].count(','):
-                        logging.info("Run Aborted: Samples must have the same number of replicates for paired analysis. Please check input.")
-                        exit()
-                IRI_differ.generate_input_intron_level()
-                IRI_differ.generate_input_gene_level()
-                IRI_differ.run_analysis_intron_level()
-                IRI_differ.run_analysis_gene_level()
+                try:
+                        metrics.start_stage("parsing")
+                        if IRI_differ.params.get('incremental'):
+                                IRI_differ.store = update_input_store(IRI_differ.params)
+                        IRI_differ.generate_input_intron_level()
+                        IRI_differ.generate_input_gene_level()
+                        metrics.end_stage()
+                        metrics.start_stage("testing")
+                        IRI_differ.run_analysis_intron_level()
+                        IRI_differ.run_analysis_gene_level()
+                        metrics.end_stage()
+                finally:
+                        remove_stage_dir(IRI_differ.params)
 
         elif args.quanttype == "IRC":
                 IRC_differ = IRC_diff(args)
-                if ',' not in IRC_differ.params['s1files'] or ',' not in IRC_differ.params['s2files']:
-                        logging.info("Run Aborted: Differential IR analysis requires at least two replicates per sample. Please check input.")
-                        exit()
-                if IRC_differ.params['analysistype'] == "P" and IRC_differ.params['s1files'].count(',') != IRC_differ.params['s2files'].count(','):
-                        logging.info("Run Aborted: Samples must have the same number of replicates for paired analysis. Please check input.")
+                if not check_groups(IRC_differ.params):
                         exit()
-                IRI_differ.generate_input_intron_level()
-                IRI_differ.generate_input_gene_level()
-                IRI_differ.generate_input_junction_level()
-                IRI_differ.run_analysis_intron_level()
-                IRI_differ.run_analysis_gene_level()
-                IRI_differ.run_analysis_junction_level()
-
-
+                try:
+                        metrics.start_stage("parsing")
+                        if IRC_differ.params.get('incremental'):
+                                IRC_differ.store = update_input_store(IRC_differ.params)
+                        IRC_differ.generate_input_intron_level()
+                        IRC_differ.generate_input_gene_level()
+                        IRC_differ.generate_input_junction_level()
+                        metrics.end_stage()
+                        metrics.start_stage("testing")
+                        IRC_differ.run_analysis_intron_level()
+                        IRC_differ.run_analysis_gene_level()
+                        IRC_differ.run_analysis_junction_level()
+                        metrics.end_stage()
+                finally:
+                        remove_stage_dir(IRC_differ.params)
 
+def run(args):
+        check_output_format(args.__dict__.get('output_format'))
+        for option, name in (('chunk_size', "--chunk-size"), ('processes', "--processes"), ('permutations', "--permutations")):
+                if args.__dict__.get(option) is not None and args.__dict__[option] < 1:
+                        raise Exception("{} must be at least 1".format(name))
+        if args.__dict__.get('sample_sheet'):
+                if args.s1files or args.s2files:
+                        raise Exception("Give the replicates either by --sample-sheet or by -s1/-s2, not both")
+        elif not args.s1files or not args.s2files:
+                raise Exception("The replicates of both samples (-s1 and -s2), or a --sample-sheet, are required")
+        elif args.__dict__.get('post_hoc'):
+                raise Exception("--post-hoc requires --sample-sheet")
+        if args.__dict__.get('incremental') and args.__dict__.get('cohort_store'):
+                raise Exception("--incremental and --cohort-store are mutually exclusive: a cohort store is read without parsing anyway")
+        if args.__dict__.get('count_test'):
+                if args.quanttype != "IRC":
+                        raise Exception("--count-test tests the read counts of IRC results (-q IRC)")
+                if args.analysistype == "P":
+                        raise Exception("--count-test compares unpaired replicates (-t U)")
+                if args.__dict__.get('test') == "permutation":
+                        raise Exception("--count-test and --test permutation are mutually exclusive")
+        run_with_cache(open_diff_cache(args.__dict__), args.no_cache, lambda: run_diff(args))
@@ -0,0 +1,272 @@
+import os
+import json
+import logging
+import itertools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from IRTools.table_io import find_table, read_table
+from IRTools.cohort_store import Cohort_Store, LEVELS, ID_COLUMNS
+
+# Inputs of diff: the IRI/IRC values of one level in all replicates, aligned by ID. Only the ID and IRI/IRC columns of
+# the quant tables are read, as typed columns, and the replicates are read at the same time.
+#
+# Large cohorts are tested in chunks of IDs (see Staged_Level_Input): the values of each replicate are put into a
+# directory once, sorted by ID, and each chunk is put together from there, so that memory does not grow with the number
+# of replicates times the number of IDs.
+
+# Threads reading replicates at the same time
+READ_THREADS = 8
+
+# Read count columns of the IRC results of each level, for --count-test: (retained read columns, spliced read column).
+# The retained reads of a CIR are the mean of its 5' and 3' retained reads, as in its IRC.
+COUNT_COLUMNS = {"introns": (["CIR_5'retained_reads", "CIR_3'retained_reads"], "CIR_spliced_reads"),
+                 "genes": (["gene_retained_reads"], "gene_spliced_reads"),
+                 "junctions": (["CJ_retained_reads"], "CJ_spliced_reads")}
+
+# (replicate, group) of each line of a --sample-sheet file, in order: two columns separated by tabs, commas or spaces, as
+# in quant_groups.load_two_column_file. Lines starting with "#" are ignored. Unlike there, a replicate listed twice is an
+# error, as it would silently leave a group.
+def load_sample_sheet(filename):
+        entries = []
+        line_of = {}
+        with open(filename) as f:
+                for line_number, line in enumerate(f, 1):
+                        line = line.strip()
+                        if not line or line.startswith("#"):
+                                continue
+                        fields = line.replace(",", "\t").split()
+                        if len(fields) < 2:
+                                raise Exception("Line {} of sample sheet file {} does not have two columns: {}".format(line_number, filename, line))
+                        if fields[0] in line_of:
+                                raise Exception("Line {} of sample sheet file {} lists replicate {} again (first on line {}): {}".format(line_number, filename, fields[0], line_of[fields[0]], line))
+                        line_of[fields[0]] = line_number
+                        entries.append((fields[0], fields[1]))
+        if not entries:
+                raise Exception("No entries found in sample sheet file {}".format(filename))
+        return entries
+
+# The groups of replicates compared, [(group, replicate names)]: those of --sample-sheet (replicate and group, groups
+# in the order they first appear), or S1 and S2.
+def get_groups(params):
+        if params.get('sample_sheet'):
+                groups = {}
+                for name, group in load_sample_sheet(params['sample_sheet']):
+                        groups.setdefault(group, []).append(name)
+                return list(groups.items())
+        return [("S1", params['s1files'].split(',')), ("S2", params['s2files'].split(','))]
+
+def get_replicate_names(params):
+        return [name for group, names in get_groups(params) for name in names]
+
+# Each row of values as text: the values present, separated by commas, as table_io.format_value() writes them.
+def join_values(values, present):
+        texts = []
+        for row, row_present in zip(values.tolist(), present.tolist()):
+                if not all(row_present):
+                        row = list(itertools.compress(row, row_present))
+                # repr() of NaN is "nan", which no other value contains
+                texts.append(",".join(map(repr, row)).replace("nan", "NA"))
+        return texts
+
+class Level_Input(object):
+        # ids: sorted IDs. values: IDs x replicates (those of S1, then those of S2, or those of each group in turn), NaN for
+        # NA and filtered CIRs, present: whether the ID is in the results of the replicate. counts: None, or with
+        # --count-test IDs x replicates x 2, the retained and total (retained + spliced) read counts.
+        def __init__(self, ids, values, present, n1, counts=None):
+                self.ids = ids
+                self.values = values
+                self.present = present
+                self.n1 = n1
+                self.counts = counts
+
+        # Column bounds of groups of sizes replicates, by default S1 and S2.
+        def get_group_bounds(self, sizes=None):
+                if sizes is None:
+                        sizes = [self.n1, self.values.shape[1] - self.n1]
+                bounds = np.cumsum([0] + list(sizes))
+                return list(zip(bounds[:-1], bounds[1:]))
+
+        # Values to test of each group: NaN for NA, inf and IDs not in the results of a replicate.
+        def get_group_values(self, sizes=None):
+                values = np.where(self.present & (self.values != np.inf), self.values, np.nan)
+                return [values[:, begin:end] for begin, end in self.get_group_bounds(sizes)]
+
+        def get_test_values(self):
+                return tuple(self.get_group_values())
+
+        # (retained, total) read counts of each group, 0 where the value is not tested.
+        def get_group_counts(self, sizes=None):
+                tested = self.present & np.isfinite(self.values)
+                retained = np.where(tested, self.counts[:, :, 0], 0)
+                total = np.where(tested, self.counts[:, :, 1], 0)
+                return [(retained[:, begin:end], total[:, begin:end]) for begin, end in self.get_group_bounds(sizes)]
+
+        # The values of rows in each group (S1 and S2) as text, as in the quant files of the replicates that have the ID.
+        def format_rows(self, rows, sizes=None):
+                return list(zip(*[join_values(self.values[rows, begin:end], self.present[rows, begin:end]) for begin, end in self.get_group_bounds(sizes)]))
+
+        # Level_Input of some replicates, columns, the first n1 of them in S1.
+        def select(self, columns, n1):
+                return Level_Input(self.ids, self.values[:, columns], self.present[:, columns], n1, self.counts[:, columns] if self.counts is not None else None)
+
+        def get_chunk_bounds(self):
+                return [(0, len(self.ids))]
+
+        def get_chunk(self, begin, end):
+                if (begin, end) == (0, len(self.ids)):
+                        return self
+                return Level_Input(self.ids[begin:end], self.values[begin:end], self.present[begin:end], self.n1, self.counts[begin:end] if self.counts is not None else None)
+
+        # columns: the ID column and a column for each group of sizes replicates.
+        def write(self, path, columns, sizes=None):
+                with open(path, "w") as input_file:
+                        input_file.write("\t".join(columns) + "\n")
+                        for begin, end in self.get_chunk_bounds():
+                                chunk = self.get_chunk(begin, end)
+                                for id, texts in zip(chunk.ids, chunk.format_rows(np.arange(len(chunk.ids)), sizes)):
+                                        input_file.write(id + "\t" + "\t".join(texts) + "\n")
+
+def load_array(filename):
+        try:
+                return np.load(filename, mmap_mode="r")
+        except ValueError:
+                # empty arrays cannot be mapped
+                return np.load(filename)
+
+# Level_Input of a directory with the values of replicate R sorted by row: R.rows.npy and R.values.npy (the columns
+# of read_replicate). Chunks of IDs
+# are put together when they are needed. ids: the sorted IDs (None in the processes testing chunks, which need no IDs).
+class Staged_Level_Input(Level_Input):
+        def __init__(self, directory, ids, n_replicates, n1, chunk_size):
+                self.directory = directory
+                self.ids = ids
+                self.n_replicates = n_replicates
+                self.n1 = n1
+                self.chunk_size = chunk_size
+
+        def get_chunk_bounds(self):
+                # a single empty chunk if there are no IDs
+                return [(begin, min(begin + self.chunk_size, len(self.ids))) for begin in range(0, max(len(self.ids), 1), self.chunk_size)]
+
+        def get_chunk(self, begin, end):
+                values = None
+                present = np.zeros((end - begin, self.n_replicates), dtype=bool)
+                for replicate in range(self.n_replicates):
+                        rows = load_array(os.path.join(self.directory, "{}.rows.npy".format(replicate)))
+                        replicate_values = load_array(os.path.join(self.directory, "{}.values.npy".format(replicate)))
+                        if values is None:
+                                values = np.full((end - begin, self.n_replicates, replicate_values.shape[1]), np.nan)
+                        first, last = np.searchsorted(rows, [begin, end])
+                        chunk_rows = rows[first:last] - begin
+                        values[chunk_rows, replicate] = replicate_values[first:last]
+                        present[chunk_rows, replicate] = True
+                return Level_Input(self.ids[begin:end] if self.ids is not None else None, values[:, :, 0], present, self.n1,
+                                   values[:, :, 1:] if values.shape[2] > 1 else None)
+
+# (IDs, values) of a replicate. values: IDs x 1, the metric column, or with counts IDs x 3, the metric and the retained
+# and total read counts.
+def read_replicate(indir, name, quanttype, level, id_column, metric, store, counts=False):
+        columns = [metric]
+        if counts:
+                retained_columns, spliced_column = COUNT_COLUMNS[level]
+                columns += retained_columns + [spliced_column]
+        if store is not None:
+                ids, values = store.get_sample_columns(name, level, columns)
+                ids = np.asarray(ids, dtype=object)
+        else:
+                df = read_table(find_table(os.path.join(indir, name + ".quant." + quanttype + "." + level)), columns=[id_column] + columns, categorical=False)
+                ids, values = df[id_column].astype(str).to_numpy(dtype=object), df[columns].to_numpy(dtype=np.float64)
+        if counts:
+                retained = values[:, 1:-1].sum(axis=1) / (len(columns) - 2)
+                values = np.column_stack([values[:, 0], retained, retained + values[:, -1]])
+        return ids, values
+
+def load_level_input(params, store, quanttype, level, id_column, metric):
+        groups = get_groups(params)
+        names = get_replicate_names(params)
+        with ThreadPoolExecutor(max_workers=min(READ_THREADS, len(names))) as executor:
+                replicates = list(executor.map(lambda name: read_replicate(params['indir'], name, quanttype, level, id_column, metric, store, params.get('count_test')), names))
+        # index join of the IDs of all replicates
+        codes, ids = pd.factorize(np.concatenate([replicate_ids for replicate_ids, _ in replicates]), sort=True)
+        values = np.full((len(ids), len(names), replicates[0][1].shape[1]), np.nan)
+        present = np.zeros((len(ids), len(names)), dtype=bool)
+        offset = 0
+        for column, (replicate_ids, replicate_values) in enumerate(replicates):
+                rows = codes[offset:offset + len(replicate_ids)]
+                values[rows, column] = replicate_values
+                present[rows, column] = True
+                offset += len(replicate_ids)
+        return Level_Input(np.asarray(ids, dtype=object), values[:, :, 0], present, len(groups[0][1]), values[:, :, 1:] if values.shape[2] > 1 else None)
+
+# Staged_Level_Input in directory. The replicates are read a few at a time, and only the IDs are kept in memory.
+def stage_level_input(params, store, quanttype, level, id_column, metric, directory, chunk_size):
+        groups = get_groups(params)
+        names = get_replicate_names(params)
+        os.makedirs(directory)
+        # IDs in the order they were first seen
+        known = pd.Index([], dtype=object)
+        with ThreadPoolExecutor(max_workers=min(READ_THREADS, len(names))) as executor:
+                for start in range(0, len(names), READ_THREADS):
+                        batch = names[start:start + READ_THREADS]
+                        replicates = executor.map(lambda name: read_replicate(params['indir'], name, quanttype, level, id_column, metric, store, params.get('count_test')), batch)
+                        for replicate, (ids, values) in enumerate(replicates, start):
+                                codes = known.get_indexer(ids)
+                                new = codes < 0
+                                if new.any():
+                                        known = known.append(pd.Index(pd.unique(ids[new]), dtype=object))
+                                        codes[new] = known.get_indexer(ids[new])
+                                np.save(os.path.join(directory, "{}.codes.npy".format(replicate)), codes)
+                                np.save(os.path.join(directory, "{}.values.npy".format(replicate)), values)
+        ids = known.to_numpy(dtype=object)
+        order = np.argsort(ids, kind="stable")
+        ranks = np.empty(len(ids), dtype=np.int64)
+        ranks[order] = np.arange(len(ids))
+        for replicate in range(len(names)):
+                rows = ranks[np.load(os.path.join(directory, "{}.codes.npy".format(replicate)))]
+                values = np.load(os.path.join(directory, "{}.values.npy".format(replicate)))
+                sorted_rows = np.argsort(rows, kind="stable")
+                np.save(os.path.join(directory, "{}.rows.npy".format(replicate)), rows[sorted_rows])
+                np.save(os.path.join(directory, "{}.values.npy".format(replicate)), values[sorted_rows])
+                os.remove(os.path.join(directory, "{}.codes.npy".format(replicate)))
+        return Staged_Level_Input(directory, ids[order], len(names), len(groups[0][1]), chunk_size)
+
+# --incremental: the replicates are kept in a cohort store of their own, OUTDIR/.NAME.diff.TYPE.inputs, with the path,
+# size and modification time of their quant files in sources.json. A rerun parses only the replicates whose files are
+# new or have changed (adding them to the store, whose IDs and sample arrays only grow) and reads the others from the
+# store. Only the IRI/IRC columns (and for IRC the read counts of --count-test) are kept.
+def get_input_store_dir(params):
+        return os.path.join(params['outdir'], "." + params['name'] + ".diff." + params['quanttype'] + ".inputs")
+
+def get_source_fingerprint(path):
+        stat = os.stat(path)
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+def update_input_store(params):
+        quanttype = params['quanttype']
+        directory = get_input_store_dir(params)
+        store = Cohort_Store(directory)
+        sources_file = os.path.join(directory, "sources.json")
+        sources = {}
+        if os.path.exists(sources_file):
+                with open(sources_file) as f:
+                        sources = json.load(f)
+        names = get_replicate_names(params)
+        paths = dict((name, [find_table(os.path.join(params['indir'], name + ".quant." + quanttype + "." + level)) for level in LEVELS[quanttype]]) for name in names)
+        fingerprints = dict((name, [get_source_fingerprint(path) for path in paths[name]]) for name in names)
+        changed = [name for name in names if name not in store.manifest['samples'] or sources.get(name) != fingerprints[name]]
+        logging.info("Replicates parsed: {} of {}, the others are read from {}".format(len(changed), len(names), directory))
+        for name in changed:
+                tables = {}
+                for level, path in zip(LEVELS[quanttype], paths[name]):
+                        columns = [level[:-1] + "_" + quanttype]
+                        if quanttype == "IRC":
+                                retained_columns, spliced_column = COUNT_COLUMNS[level]
+                                columns += retained_columns + [spliced_column]
+                        tables[level] = read_table(path, columns=[ID_COLUMNS[level]] + columns, categorical=False)
+                store.append(name, quanttype, tables)
+                sources[name] = fingerprints[name]
+                with open(sources_file + ".tmp", "w") as f:
+                        json.dump(sources, f)
+                os.replace(sources_file + ".tmp", sources_file)
+        return store
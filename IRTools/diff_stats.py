@@ -0,0 +1,391 @@
+import statistics
+import warnings
+import itertools
+import numpy as np
+import scipy.stats
+import scipy.special
+
+# Statistics of diff for all IDs of a level at once. The IRI/IRC values of the replicates are (IDs x replicates)
+# matrices, NaN for NA and inf, and the IDs are tested in a few vectorized calls instead of one by one. The results
+# are the very same as those of testing the list of values of each ID.
+
+def pad_columns(matrix, width):
+        if matrix.shape[1] < width:
+                matrix = np.hstack([matrix, np.full((matrix.shape[0], width - matrix.shape[1]), np.nan)])
+        return matrix
+
+# Values of each row moved to the first columns, in order, and the number of values of each row.
+def compact_rows(matrix):
+        missing = np.isnan(matrix)
+        order = np.argsort(missing, axis=1, kind="stable")
+        return np.take_along_axis(matrix, order, axis=1), (~missing).sum(axis=1)
+
+# statistics.mean() of the values of each row, i.e. their exact mean rounded once. The mean is computed in extended
+# precision, which rounds to the same double unless it is too close to halfway between two doubles for its error
+# bound; those rows (and rows with inf or very large values) are left to statistics.mean().
+def row_means(values, counts):
+        means = np.full(len(values), np.nan)
+        slow = np.ones(len(values), dtype=bool)
+        extended = np.finfo(np.longdouble)
+        if len(values) and extended.nmant >= 63:
+                with np.errstate(all="ignore"):
+                        filled = np.where(np.isnan(values), 0, values).astype(np.longdouble)
+                        n = np.maximum(counts, 1).astype(np.longdouble)
+                        mean = filled.sum(axis=1) / n
+                        # twice the largest error of the sum and the division
+                        bound = np.abs(filled).sum(axis=1) / n * (values.shape[1] + 1) * extended.eps
+                        rounded = mean.astype(np.float64)
+                        # half the distance to the next double on the side of the mean
+                        neighbour = np.nextafter(rounded, np.where(mean >= rounded, np.inf, -np.inf))
+                        halfway = np.abs(neighbour.astype(np.longdouble) - rounded.astype(np.longdouble)) / 2
+                        margin = halfway - np.abs(mean - rounded.astype(np.longdouble))
+                        slow = ~(np.isfinite(filled).all(axis=1) & (np.abs(filled).max(axis=1) < 1e300) & (margin > bound) & (counts > 0))
+                # statistics.mean() has no negative zero
+                means[~slow] = rounded[~slow] + 0.0
+        for row in np.flatnonzero(slow & (counts > 0)):
+                means[row] = statistics.mean(values[row, :counts[row]].tolist())
+        return means
+
+# The values of the pairs (S1, S2) in which both values are there, NaN for the others.
+def pair_values(S1, S2):
+        width = max(S1.shape[1], S2.shape[1])
+        S1, S2 = pad_columns(S1, width), pad_columns(S2, width)
+        pairs = ~np.isnan(S1) & ~np.isnan(S2)
+        return np.where(pairs, S1, np.nan), np.where(pairs, S2, np.nan)
+
+# Rows of S1 and S2 that are tested: two values or more in each sample, and more than a single distinct value.
+def get_tested_rows(S1, S2):
+        n1, n2 = (~np.isnan(S1)).sum(axis=1), (~np.isnan(S2)).sum(axis=1)
+        largest = np.fmax(np.fmax.reduce(S1, axis=1), np.fmax.reduce(S2, axis=1))
+        smallest = np.fmin(np.fmin.reduce(S1, axis=1), np.fmin.reduce(S2, axis=1))
+        single_value = (n1 + n2 > 0) & (largest == smallest)
+        return np.flatnonzero(~single_value & (n1 >= 2) & (n2 >= 2))
+
+# Differences of the means (S2 - S1) of the rows whose p-value is not NaN, NaN for the others.
+def get_differences(S1, S2, pvals):
+        S1, n1 = compact_rows(S1)
+        S2, n2 = compact_rows(S2)
+        differences = np.full(len(S1), np.nan)
+        valid = ~np.isnan(pvals)
+        differences[valid] = row_means(S2[valid], n2[valid]) - row_means(S1[valid], n1[valid])
+        return differences
+
+# Two-sample t-test (paired: ttest_rel, else ttest_ind) of each row of S1 against the same row of S2. Values missing in
+# S1 or S2 are left out (paired: both values of the pair). Rows with fewer than two values in a sample or with a single
+# distinct value are not tested. Returns the p-values and the differences of the means (S2 - S1), NaN for rows not
+# tested or whose p-value is NaN.
+def t_test(S1, S2, paired):
+        if paired:
+                S1, S2 = pair_values(S1, S2)
+        tested = get_tested_rows(S1, S2)
+        compact_S1, n1 = compact_rows(S1)
+        compact_S2, n2 = compact_rows(S2)
+        pvals = np.full(len(S1), np.nan)
+        test = scipy.stats.ttest_rel if paired else scipy.stats.ttest_ind
+        # rows with the same numbers of values are tested together
+        sizes = n1[tested] * (S2.shape[1] + 1) + n2[tested]
+        for size in np.unique(sizes):
+                rows = tested[sizes == size]
+                with np.errstate(all="ignore"):
+                        pvals[rows] = test(compact_S1[rows, :n1[rows[0]]], compact_S2[rows, :n2[rows[0]]], axis=1)[1]
+        return pvals, get_differences(S1, S2, pvals)
+
+# Permutation test of S1 against S2 (--test permutation), for few replicates, where the t-test is unreliable. The
+# labels of the replicates are permuted (paired: the values of pairs are swapped) once, for all rows, and the statistics
+# of all rows under a block of permutations are a few matrix products. If there are no more distinct permutations than
+# asked for, all of them are used (an exact test), otherwise that many random ones, the same in every run.
+
+# Statistics computed at once: rows x permutations
+PERMUTATION_BLOCK_ROWS = 512
+PERMUTATION_BLOCK_PERMUTATIONS = 128
+
+PERMUTATION_SEED = 0
+
+# Statistics this close to the observed one (relatively) are ties, which count as at least as large
+PERMUTATION_TIE_TOLERANCE = 1e-9
+
+# Labels of the permutations, the observed ones first. paired: n1 pairs, True where the values of a pair are swapped;
+# else n1 + n2 replicates, True for those in S2.
+def get_permutation_labels(n1, n2, paired, permutations):
+        rng = np.random.default_rng(PERMUTATION_SEED)
+        if paired:
+                if 2 ** n1 <= permutations:
+                        # the first one swaps nothing
+                        return np.array(list(itertools.product([False, True], repeat=n1)), dtype=bool).reshape(-1, n1)
+                return np.vstack([np.zeros(n1, dtype=bool), rng.integers(0, 2, (permutations, n1)).astype(bool)])
+        observed = np.arange(n1 + n2) >= n1
+        if scipy.special.comb(n1 + n2, n2, exact=True) <= permutations:
+                labels = np.zeros((scipy.special.comb(n1 + n2, n2, exact=True), n1 + n2), dtype=bool)
+                for row, columns in enumerate(itertools.combinations(range(n1 + n2), n2)):
+                        labels[row, list(columns)] = True
+                # the observed labels are the last combination
+                return labels[::-1]
+        return np.vstack([observed, rng.permuted(np.tile(observed, (permutations, 1)), axis=1)])
+
+# Welch t^2 of each row (values: rows x replicates, 0 where missing, present: where not missing) for each set of labels
+# (True: S2). NaN where a sample has fewer than two values or the statistic is not defined. In place where possible,
+# as the arrays are large.
+def welch_statistics(values, squares, present, labels):
+        in_S2 = labels.T.astype(np.float64)
+        sum2, squares2, n2 = values @ in_S2, squares @ in_S2, present @ in_S2
+        # the values are centred: the sums of both samples are opposite
+        sum1 = np.negative(sum2)
+        squares1 = np.subtract(squares.sum(axis=1)[:, None], squares2)
+        n1 = np.subtract(present.sum(axis=1)[:, None], n2)
+        with np.errstate(all="ignore"):
+                # squared mean difference over the variance of it
+                difference = sum2 / n2
+                difference -= sum1 / n1
+                difference *= difference
+                variance = squares1 - sum1 * sum1 / n1
+                np.maximum(variance, 0, out=variance)
+                variance /= n1 * (n1 - 1)
+                squares2 -= sum2 * sum2 / n2
+                np.maximum(squares2, 0, out=squares2)
+                squares2 /= n2 * (n2 - 1)
+                variance += squares2
+                difference /= variance
+        difference[(n1 < 2) | (n2 < 2)] = np.nan
+        return difference
+
+# Permutation test of each row of S1 against the same row of S2, with the values left out and the rows tested as in
+# t_test. The statistic is |Welch t| (paired: |the sum of the differences of the pairs|), permutations in which a
+# sample has fewer than two values are left out, and the p-value is the fraction of the permutations, the observed
+# one included, whose statistic is at least the observed one. Returns the p-values and the differences of the means.
+def permutation_test(S1, S2, paired, permutations):
+        if paired:
+                S1, S2 = pair_values(S1, S2)
+        tested = get_tested_rows(S1, S2)
+        labels = get_permutation_labels(S1.shape[1], S2.shape[1], paired, permutations)
+        if paired:
+                differences = np.nan_to_num(S2[tested] - S1[tested])
+                statistic = lambda rows, labels: np.abs(differences[rows] @ (1 - 2 * labels.T.astype(np.float64)))
+        else:
+                values = np.hstack([S1[tested], S2[tested]])
+                present = (~np.isnan(values)).astype(np.float64)
+                # centred, which changes no statistic, for smaller rounding errors
+                with np.errstate(all="ignore"), warnings.catch_warnings():
+                        warnings.simplefilter("ignore")
+                        values = np.nan_to_num(values - np.nanmean(values, axis=1)[:, None])
+                squares = values * values
+                statistic = lambda rows, labels: welch_statistics(values[rows], squares[rows], present[rows], labels)
+        at_least = np.zeros(len(tested))
+        counted = np.zeros(len(tested))
+        # blocks small enough to stay in the CPU caches
+        for row in range(0, len(tested), PERMUTATION_BLOCK_ROWS):
+                rows = slice(row, row + PERMUTATION_BLOCK_ROWS)
+                observed = statistic(rows, labels[:1])
+                threshold = observed * (1 - PERMUTATION_TIE_TOLERANCE)
+                for start in range(0, len(labels), PERMUTATION_BLOCK_PERMUTATIONS):
+                        statistics = statistic(rows, labels[start:start + PERMUTATION_BLOCK_PERMUTATIONS])
+                        at_least[rows] += np.count_nonzero(statistics >= threshold, axis=1)
+                        counted[rows] += np.count_nonzero(~np.isnan(statistics), axis=1)
+                at_least[rows][np.isnan(observed[:, 0])] = np.nan
+        pvals = np.full(len(S1), np.nan)
+        with np.errstate(all="ignore"):
+                pvals[tested] = at_least / counted
+        return pvals, get_differences(S1, S2, pvals)
+
+# One-way ANOVA (method "anova": f_oneway) or Kruskal-Wallis test ("kruskal") of each row across the groups, values
+# missing in a group left out. Rows with fewer than two values in a group or with a single distinct value are not
+# tested. Returns the p-values, NaN for rows not tested.
+def group_test(groups, method):
+        compacted = [compact_rows(group) for group in groups]
+        groups = [group for group, counts in compacted]
+        counts = np.column_stack([counts for group, counts in compacted])
+        largest = np.fmax.reduce(np.column_stack([np.fmax.reduce(group, axis=1) for group in groups]), axis=1)
+        smallest = np.fmin.reduce(np.column_stack([np.fmin.reduce(group, axis=1) for group in groups]), axis=1)
+        single_value = (counts.sum(axis=1) > 0) & (largest == smallest)
+        tested = np.flatnonzero(~single_value & (counts >= 2).all(axis=1))
+        pvals = np.full(len(counts), np.nan)
+        test = scipy.stats.f_oneway if method == "anova" else scipy.stats.kruskal
+        # rows with the same numbers of values in each group are tested together
+        sizes, size_of_row = np.unique(counts[tested], axis=0, return_inverse=True)
+        for number, size in enumerate(sizes):
+                rows = tested[size_of_row.ravel() == number]
+                with np.errstate(all="ignore"), warnings.catch_warnings():
+                        # e.g. groups whose values are all the same
+                        warnings.simplefilter("ignore")
+                        pvals[rows] = test(*[group[rows, :count] for group, count in zip(groups, size)], axis=1)[1]
+        return pvals
+
+# Beta-binomial model of read counts (--count-test): the retained reads of an ID in a replicate out of its retained and
+# spliced reads are beta-binomial, with a mean (the expected IRC) for each group and a precision (alpha + beta) shared
+# by the groups. The model is fitted to all IDs at once: Levenberg-Marquardt damped Newton steps on the logits of the
+# means and the log of the precision, each step one set of NumPy operations on all IDs that are not converged.
+
+# Largest number of replicate values fitted at once (rows x replicates)
+BB_BATCH_VALUES = 1 << 16
+
+BB_MAX_ITERATIONS = 200
+
+BB_START_PRECISION = 10.0
+
+# Bounds of the logits of the means and of the log precision
+BB_LOGIT_BOUND = 30.0
+BB_LOG_PRECISION_BOUNDS = (-10.0, 25.0)
+
+def clip_bb_params(params):
+        params[:, :-1] = np.clip(params[:, :-1], -BB_LOGIT_BOUND, BB_LOGIT_BOUND)
+        params[:, -1] = np.clip(params[:, -1], *BB_LOG_PRECISION_BOUNDS)
+        return params
+
+# Means (rows x replicates) and 1 - means of params (logits of the means of each group, log precision), and the precision.
+def get_bb_means(params, groups):
+        return scipy.special.expit(params[:, :-1])[:, groups], scipy.special.expit(-params[:, :-1])[:, groups], np.exp(params[:, -1])[:, None]
+
+def stirling_correction(x):
+        return 1 / (12 * x) - 1 / (360 * x ** 3) + 1 / (1260 * x ** 5)
+
+# gammaln(x + n) - gammaln(x), also accurate for large x, where the difference of the gammaln values cancels.
+def log_rising(x, n):
+        x, n = np.broadcast_arrays(x, n)
+        result = scipy.special.gammaln(x + n) - scipy.special.gammaln(x)
+        large = np.nonzero(x > 1e4)
+        x, n = x[large], n[large]
+        result[large] = (x - 0.5) * np.log1p(n / x) + n * np.log(x + n) - n + stirling_correction(x + n) - stirling_correction(x)
+        return result
+
+# Log-likelihood of each row, without the binomial coefficients, which do not depend on the parameters. Replicates
+# without reads add nothing.
+def bb_loglik(retained, total, params, groups):
+        mean, other, precision = get_bb_means(params, groups)
+        return (log_rising(precision * mean, retained) + log_rising(precision * other, total - retained) - log_rising(precision, total)).sum(axis=1)
+
+# Sums of the replicates of each group (starts: the first replicate of each group). Unlike a matrix product, the sums
+# of a row do not depend on the other rows, so the fit of an ID does not depend on the chunk it is in.
+def group_sums(values, starts):
+        return np.add.reduceat(values, starts, axis=1)
+
+# polygamma(1, x) of positive x, several times faster: x < 6 is moved up with trigamma(x) = trigamma(x + 1) + 1 / x^2,
+# then the asymptotic series is used (relative error about 1e-9, plenty for Newton steps).
+def trigamma(x):
+        x = np.array(x, dtype=np.float64)
+        result = np.zeros_like(x)
+        small = np.nonzero(x < 6)
+        shifted = x[small]
+        for _ in range(6):
+                result[small] += 1 / (shifted * shifted)
+                shifted += 1
+        x[small] = shifted
+        inverse = 1 / x
+        square = inverse * inverse
+        return result + inverse + square / 2 + inverse * square * (1 / 6 - square * (1 / 30 - square * (1 / 42 - square / 30)))
+
+# Gradient and Hessian of the log-likelihood of each row with respect to params.
+def bb_derivatives(retained, total, params, groups, starts):
+        mean, other, precision = get_bb_means(params, groups)
+        alpha, beta = precision * mean, precision * other
+        variance = mean * other
+        digamma = scipy.special.digamma
+        a = digamma(retained + alpha) - digamma(alpha)
+        b = digamma(total - retained + beta) - digamma(beta)
+        c = digamma(total + precision) - digamma(precision)
+        a1 = trigamma(retained + alpha) - trigamma(alpha)
+        b1 = trigamma(total - retained + beta) - trigamma(beta)
+        c1 = trigamma(total + precision) - trigamma(precision)
+        n_params = params.shape[1]
+        gradient = np.empty((len(params), n_params))
+        hessian = np.zeros((len(params), n_params, n_params))
+        gradient[:, :-1] = group_sums(precision * variance * (a - b), starts)
+        gradient[:, -1] = (precision * (mean * a + other * b - c)).sum(axis=1)
+        diagonal = np.arange(n_params - 1)
+        hessian[:, diagonal, diagonal] = group_sums(precision * variance * (other - mean) * (a - b) + (precision * variance) ** 2 * (a1 + b1), starts)
+        hessian[:, diagonal, -1] = hessian[:, -1, diagonal] = group_sums(precision * variance * (a - b) + precision ** 2 * variance * (mean * a1 - other * b1), starts)
+        hessian[:, -1, -1] = gradient[:, -1] + (precision ** 2 * (mean ** 2 * a1 + other ** 2 * b1 - c1)).sum(axis=1)
+        return gradient, hessian
+
+# Damped Newton steps from params until each row converges. fixed: the parameters (rows x parameters) that are kept
+# as they are. Returns the log-likelihood of each row and the parameters.
+def bb_maximize(retained, total, params, groups, starts, fixed):
+        loglik = bb_loglik(retained, total, params, groups)
+        damping = np.full(len(retained), 1e-3)
+        active = np.arange(len(retained))
+        # the derivatives at params of the active rows; after a rejected step they are still the same
+        gradients = np.empty(params.shape)
+        hessians = np.empty(params.shape + params.shape[1:])
+        moved = active
+        for iteration in range(BB_MAX_ITERATIONS):
+                if not len(active):
+                        break
+                if len(moved):
+                        gradients[moved], hessians[moved] = bb_derivatives(retained[moved], total[moved], params[moved], groups, starts)
+                gradient, hessian = gradients[active], hessians[active]
+                # the steps of fixed parameters are 0
+                active_fixed = fixed[active]
+                gradient[active_fixed] = 0
+                hessian[active_fixed[:, :, None] | active_fixed[:, None, :]] = 0
+                hessian[:, np.arange(params.shape[1]), np.arange(params.shape[1])] -= active_fixed
+                # Levenberg-Marquardt: the diagonal is made positive and increased by damping times its size
+                diagonal = np.diagonal(hessian, axis1=1, axis2=2)
+                shift = 2 * np.maximum(diagonal, 0) + damping[active, None] * np.maximum(np.abs(diagonal), 1e-8)
+                matrix = -hessian + shift[:, :, None] * np.eye(params.shape[1])
+                # no step where the derivatives overflow
+                invalid = ~(np.isfinite(matrix).all(axis=(1, 2)) & np.isfinite(gradient).all(axis=1))
+                matrix[invalid], gradient[invalid] = np.eye(params.shape[1]), 0
+                with np.errstate(all="ignore"):
+                        # the pseudo-inverse also solves singular systems
+                        step = (np.linalg.pinv(matrix) @ gradient[:, :, None])[:, :, 0]
+                step = np.clip(step, -5, 5)
+                trial = clip_bb_params(params[active] + step)
+                trial_loglik = bb_loglik(retained[active], total[active], trial, groups)
+                gain = trial_loglik - loglik[active]
+                better = gain >= 0
+                params[active[better]] = trial[better]
+                loglik[active[better]] = trial_loglik[better]
+                # converged: a nearly undamped step that changes the likelihood (almost) not at all, or no step that gains anything
+                converged = ((np.abs(gain) <= 1e-10 * (1 + np.abs(loglik[active]))) & (damping[active] <= 1e-3)) | (damping[active] >= 1e10)
+                damping[active] = np.clip(np.where(better, damping[active] / 10, damping[active] * 10), 1e-12, 1e10)
+                moved = active[better & ~converged]
+                active = active[~converged]
+        return loglik, params
+
+# Fits the beta-binomial model to each row of retained and total (rows x replicates). groups: the group number of each
+# replicate, in increasing order. The mean of a group without retained (or without spliced) reads is 0 (or 1) at any
+# precision and is not fitted. The likelihood may have a maximum at a low precision and another one at the largest
+# precision, where the model is binomial and the means are the pooled IRCs: the fit starts from a low precision, and the
+# binomial limit is kept where it is better. Returns the log-likelihood of each row and the fitted parameters.
+def fit_beta_binomial(retained, total, groups):
+        starts = np.flatnonzero(np.diff(groups, prepend=-1))
+        group_retained, group_total = group_sums(retained, starts), group_sums(total, starts)
+        with np.errstate(all="ignore"):
+                # the pooled IRC of each group (1/2 for groups without reads)
+                pooled = np.nan_to_num(scipy.special.logit(group_retained / group_total))
+                # starting means: the pooled IRC of each group, away from 0 and 1
+                logits = scipy.special.logit((group_retained + 0.5) / (group_total + 1))
+        fixed = np.column_stack([(group_retained == 0) | (group_retained == group_total), np.zeros(len(retained), dtype=bool)])
+        logits[fixed[:, :-1]] = pooled[fixed[:, :-1]]
+        params = clip_bb_params(np.column_stack([logits, np.full(len(retained), np.log(BB_START_PRECISION))]))
+        loglik, params = bb_maximize(retained, total, params, groups, starts, fixed)
+        binomial_params = clip_bb_params(np.column_stack([pooled, np.full(len(retained), np.inf)]))
+        binomial_loglik = bb_loglik(retained, total, binomial_params, groups)
+        better = binomial_loglik > loglik
+        return np.where(better, binomial_loglik, loglik), np.where(better[:, None], binomial_params, params)
+
+# Likelihood-ratio test of each row between the beta-binomial model with a mean for each group and the one with a
+# single mean. groups: (retained, total) read counts of each group (IDs x replicates, 0 where missing). Rows with fewer
+# than two replicates with reads in a group or with the same IRC in all replicates are not tested. Returns the p-values
+# and the fitted means (IDs x groups), NaN for rows not tested.
+def beta_binomial_test(groups):
+        retained = np.hstack([group_retained for group_retained, group_total in groups])
+        total = np.hstack([group_total for group_retained, group_total in groups])
+        group_of_replicate = np.repeat(np.arange(len(groups)), [group_total.shape[1] for group_retained, group_total in groups])
+        counts = np.column_stack([(group_total > 0).sum(axis=1) for group_retained, group_total in groups])
+        with np.errstate(all="ignore"):
+                ratios = np.where(total > 0, retained / total, np.nan)
+        single_value = (counts.sum(axis=1) > 0) & (np.fmax.reduce(ratios, axis=1) == np.fmin.reduce(ratios, axis=1))
+        tested = np.flatnonzero(~single_value & (counts >= 2).all(axis=1))
+        pvals = np.full(len(total), np.nan)
+        means = np.full((len(total), len(groups)), np.nan)
+        batch = max(1, BB_BATCH_VALUES // max(total.shape[1], 1))
+        for start in range(0, len(tested), batch):
+                rows = tested[start:start + batch]
+                full_loglik, full_params = fit_beta_binomial(retained[rows], total[rows], group_of_replicate)
+                null_loglik, null_params = fit_beta_binomial(retained[rows], total[rows], np.zeros_like(group_of_replicate))
+                pvals[rows] = scipy.stats.chi2.sf(np.maximum(2 * (full_loglik - null_loglik), 0), len(groups) - 1)
+                means[rows] = scipy.special.expit(full_params[:, :-1])
+        # the means that are not fitted
+        group_retained = np.column_stack([group_retained.sum(axis=1) for group_retained, group_total in groups])
+        group_total = np.column_stack([group_total.sum(axis=1) for group_retained, group_total in groups])
+        means[tested] = np.where(group_retained[tested] == 0, 0, np.where(group_retained[tested] == group_total[tested], 1, means[tested]))
+        return pvals, means
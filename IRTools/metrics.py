@@ -0,0 +1,75 @@
+import sys
+import time
+import json
+import logging
+import resource
+import collections
+
+# Per-stage wall time, CPU time, peak RSS and read throughput for one IRTools run.
+# Stages may nest; the time spent in a nested stage is reported only for that stage, not for its parent.
+# A stage can also report other numbers of its own (e.g. cache hit rates), which are added to its entry as they are.
+
+def peak_rss_mb():
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+        if sys.platform == "darwin":
+                return maxrss / 1024.0 / 1024.0
+        return maxrss / 1024.0
+
+STAGE_KEYS = ("stage", "wall_seconds", "cpu_seconds", "peak_rss_mb", "reads_processed", "reads_per_second")
+
+class Run_Metrics(object):
+        def __init__(self):
+                self.stages = collections.OrderedDict()
+                self.stack = []
+                self.start_wall = time.time()
+                self.start_cpu = time.process_time()
+
+        def start_stage(self, name):
+                self.stack.append([name, time.time(), time.process_time(), 0.0, 0.0])
+
+        def end_stage(self, reads_processed=None, **values):
+                name, start_wall, start_cpu, child_wall, child_cpu = self.stack.pop()
+                wall = time.time() - start_wall
+                cpu = time.process_time() - start_cpu
+                if self.stack:
+                        self.stack[-1][3] += wall
+                        self.stack[-1][4] += cpu
+
+                stage = self.stages.setdefault(name, {"stage": name, "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_mb": 0.0})
+                stage["wall_seconds"] += wall - child_wall
+                stage["cpu_seconds"] += cpu - child_cpu
+                stage["peak_rss_mb"] = peak_rss_mb()
+                if reads_processed is not None:
+                        stage["reads_processed"] = stage.get("reads_processed", 0) + reads_processed
+                        stage["reads_per_second"] = stage["reads_processed"] / stage["wall_seconds"] if stage["wall_seconds"] > 0 else None
+                stage.update(values)
+
+        def log_summary(self):
+                for stage in self.stages.values():
+                        line = "\t{}: {:.2f}s wall, {:.2f}s CPU, peak RSS {:.1f} MB".format(stage["stage"], stage["wall_seconds"], stage["cpu_seconds"], stage["peak_rss_mb"])
+                        if "reads_processed" in stage:
+                                line += ", {} reads ({:.0f} reads/sec)".format(stage["reads_processed"], stage["reads_per_second"] or 0)
+                        for key, value in stage.items():
+                                if key not in STAGE_KEYS:
+                                        line += ", {} {:g}".format(key, value) if isinstance(value, float) else ", {} {}".format(key, value)
+                        print(line)
+
+        def write_json(self, filename, subcommand, params):
+                metrics = {"subcommand": subcommand,
+                           "params": params,
+                           "wall_seconds": time.time() - self.start_wall,
+                           "cpu_seconds": time.process_time() - self.start_cpu,
+                           "peak_rss_mb": peak_rss_mb(),
+                           "stages": list(self.stages.values())}
+                with open(filename, "w") as f:
+                        json.dump(metrics, f, indent=2, default=str)
+                logging.info("Run metrics written to file: {}".format(filename))
+
+RUN_METRICS = Run_Metrics()
+
+def start_stage(name):
+        RUN_METRICS.start_stage(name)
+
+def end_stage(reads_processed=None, **values):
+        RUN_METRICS.end_stage(reads_processed, **values)
@@ -0,0 +1,108 @@
+import os
+import io
+import signal
+import pstats
+import logging
+import collections
+
+# Interval between two stack samples in "sampling" mode. At 100 samples per second the cost of
+# walking the Python stack is negligible next to quant's per-read work, so it can be left on.
+SAMPLING_INTERVAL = 0.01
+
+# Number of functions listed in the text summary.
+TOP_FUNCTIONS = 40
+
+# Statistical profiler driven by SIGPROF: every SAMPLING_INTERVAL seconds of CPU time the Python stack is recorded.
+# Samples are exposed in the same format as cProfile, so pstats, snakeviz etc. can read the dumped file;
+# times are estimated as number of samples * SAMPLING_INTERVAL and call counts are sample counts.
+class Sampling_Profiler(object):
+        def __init__(self, interval=SAMPLING_INTERVAL):
+                self.interval = interval
+                self.self_samples = collections.Counter()
+                self.cumulative_samples = collections.Counter()
+                self.caller_samples = collections.defaultdict( lambda: collections.Counter() )
+                self.previous_handler = None
+
+        @staticmethod
+        def frame_key(frame):
+                code = frame.f_code
+                return (code.co_filename, code.co_firstlineno, code.co_name)
+
+        def sample(self, signum, frame):
+                callee = None
+                on_stack = set()
+                while frame is not None:
+                        key = self.frame_key(frame)
+                        if callee is None:
+                                self.self_samples[key] += 1
+                        else:
+                                self.caller_samples[callee][key] += 1
+                        # recursive functions are counted once per sample
+                        if key not in on_stack:
+                                self.cumulative_samples[key] += 1
+                                on_stack.add(key)
+                        callee = key
+                        frame = frame.f_back
+
+        def enable(self):
+                self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+                signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+        def disable(self):
+                signal.setitimer(signal.ITIMER_PROF, 0, 0)
+                signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+
+        # Called by pstats.Stats(profiler)
+        def create_stats(self):
+                self.stats = {}
+                for key, cumulative in self.cumulative_samples.items():
+                        callers = dict((caller, (count, count, 0.0, count * self.interval)) for caller, count in self.caller_samples[key].items())
+                        self.stats[key] = (cumulative, cumulative, self.self_samples[key] * self.interval, cumulative * self.interval, callers)
+
+def get_profile_prefix(args, subcommand):
+        params = args.__dict__
+        if params.get('name'):
+                name = params['name']
+        else:
+                name = os.path.splitext(os.path.basename(params['annofile']))[0]
+        return os.path.join(params['outdir'], name + "." + subcommand)
+
+def write_profile_report(profiler, prefix, mode):
+        stats = pstats.Stats(profiler)
+        stats_file = prefix + ".prof"
+        stats.dump_stats(stats_file)
+
+        summary = io.StringIO()
+        summary_stats = pstats.Stats(stats_file, stream=summary)
+        summary_stats.strip_dirs()
+        summary.write("IRTools profile ({} mode)\n".format(mode))
+        if mode == "sampling":
+                summary.write("Times are estimated from stack samples taken every {} seconds; call counts are sample counts.\n".format(SAMPLING_INTERVAL))
+        summary.write("\nTop {} functions by cumulative time:\n".format(TOP_FUNCTIONS))
+        summary_stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        summary.write("\nTop {} functions by own time:\n".format(TOP_FUNCTIONS))
+        summary_stats.sort_stats("tottime").print_stats(TOP_FUNCTIONS)
+
+        summary_file = prefix + ".profile.txt"
+        with open(summary_file, "w") as f:
+                f.write(summary.getvalue())
+        logging.info("Profile written to files: {} and {}".format(stats_file, summary_file))
+
+def run_with_profiler(run, args, subcommand):
+        mode = args.__dict__.get('profile')
+        if not mode:
+                return run(args)
+
+        if mode == "sampling":
+                profiler = Sampling_Profiler()
+        else:
+                import cProfile
+                profiler = cProfile.Profile()
+
+        logging.info("Profiling {} run ({} mode)".format(subcommand, mode))
+        profiler.enable()
+        try:
+                return run(args)
+        finally:
+                profiler.disable()
+                write_profile_report(profiler, get_profile_prefix(args, subcommand), mode)
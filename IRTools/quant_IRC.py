@@ -7,12 +7,25 @@ import bisect
 import numpy as np
 import pandas as pd
 import HTSeq
+from IRTools.quant_reader import Alignment_Reader
+from IRTools.quant_checkpoint import Quant_Checkpoint, update_nested
+from IRTools import metrics
+from IRTools.quant_saturation import Saturation_Counter, parse_saturation_depths
+from IRTools.quant_groups import Group_Counter, load_barcode_groups, load_libtype_sheet
+from IRTools.quant_dedup import UMI_Deduplicator
+from IRTools.quant_memo import Assignment_Cache, alignment_signature, add_contributions
+from IRTools.quant_sweep import Annotation_Sweep
+from IRTools.quant_index import annotation_index_dir, open_annotation_index, write_annotation_index
+from IRTools.table_io import get_table_path, write_table
 
 class IRC_quant(object): 
         def __init__(self, args):
                 self.params = args.__dict__.copy()
                 self.stranded = self.is_stranded(self.params['libtype'])
+                # Library type of the reads being counted (it can change from read to read with --split-by and --libtype-sheet)
+                self.libtype = self.params['libtype']
                 
+                metrics.start_stage("annotation_loading")
                 self.gtffile = self.load_gtffile()
                 
                 self.gene_id2iv = self.get_gene_iv()
@@ -23,7 +36,13 @@ class IRC_quant(object):
                 
                 self.gene_CJ_database = self.summarize_gene_CJ()
                 self.gene_CIR_database, self.gene_CIR_associated_CJ_database = self.summarize_gene_CIR()
+                # With --annotation-index, the arrays used to assign reads are mapped from the index written by an earlier run
+                self.index_dir = annotation_index_dir(self.params, "IRC", self.stranded) if self.params.get('annotation_index') else None
+                self.index = open_annotation_index(self.index_dir) if self.index_dir else None
                 self.genes, self.gene_region, self.CER_region, self.gene_counts, self.CIR_counts, self.CJ_counts = self.init_GenomicArrayOfSets_and_Counter_for_quant_IRC()
+                if self.index_dir and not self.index:
+                        write_annotation_index(self.index_dir, {"genes": self.genes, "gene_region": self.gene_region, "CER_region": self.CER_region}, self.stranded)
+                metrics.end_stage()
                 
                 self.filter = True
 
@@ -111,10 +130,12 @@ class IRC_quant(object):
                                 gene_CIR_associated_CJ_database[gene_id][CIR_number]['downstream_constitutive_junction'] = self.gene_CJ_database[gene_id][downstream_CJ_number] 
                 return gene_CIR_database, gene_CIR_associated_CJ_database
                                       
+        # With an annotation index only the counters are built, the arrays are those of the index.
         def init_GenomicArrayOfSets_and_Counter_for_quant_IRC(self):
-                genes = HTSeq.GenomicArrayOfSets("auto", stranded=self.stranded)
-                gene_region = HTSeq.GenomicArrayOfSets("auto", stranded=self.stranded)
-                CER_region = HTSeq.GenomicArrayOfSets("auto", stranded=self.stranded)                
+                build = self.index is None
+                genes = HTSeq.GenomicArrayOfSets("auto", stranded=self.stranded) if build else self.index.get_array("genes")
+                gene_region = HTSeq.GenomicArrayOfSets("auto", stranded=self.stranded) if build else self.index.get_array("gene_region")
+                CER_region = HTSeq.GenomicArrayOfSets("auto", stranded=self.stranded) if build else self.index.get_array("CER_region")
                        
                 gene_counts = collections.defaultdict( lambda:  collections.Counter()) 
                 CIR_counts = collections.defaultdict( lambda:  collections.defaultdict( lambda:  collections.Counter() ))      
@@ -122,14 +143,17 @@ class IRC_quant(object):
                 for feature in self.gtffile:
                         gene_id = feature.attr["gene_id"]
                         if feature.type == "gene_region":
-                                gene_region[feature.iv] += gene_id
+                                if build:
+                                        gene_region[feature.iv] += gene_id
                         elif feature.type == "constitutive_exonic_region" and gene_id in self.valid_genes:
                                 CER_number = feature.attr["constitutive_exonic_region_number"]
-                                genes[feature.iv] += (gene_id, feature.type, CER_number)
-                                CER_region[feature.iv] += "constitutive_exonic_region"
+                                if build:
+                                        genes[feature.iv] += (gene_id, feature.type, CER_number)
+                                        CER_region[feature.iv] += "constitutive_exonic_region"
                         elif feature.type == "constitutive_intronic_region" and gene_id in self.valid_genes:
                                 CIR_number = feature.attr["constitutive_intronic_region_number"]
-                                genes[feature.iv] += (gene_id, feature.type, CIR_number)
+                                if build:
+                                        genes[feature.iv] += (gene_id, feature.type, CIR_number)
                                 if self.CIR_has_both_upstream_and_downstream_CERs(feature):
                                         CIR_counts[gene_id][CIR_number]["CIR_5'retained_reads"] = 0
                                         CIR_counts[gene_id][CIR_number]["CIR_3'retained_reads"] = 0
@@ -170,7 +194,7 @@ class IRC_quant(object):
                 return iv_reversed        
         
         def get_alt_iv(self, alt):
-                libtype = self.params['libtype']
+                libtype = self.libtype
                 if libtype == "fr-secondstrand" or libtype == "fr-unstranded":
                         alt_iv_seq = [ co.ref_iv for co in alt.cigar if co.type == "M" and co.size > 0 ]
                 elif libtype == "fr-firststrand":
@@ -178,7 +202,7 @@ class IRC_quant(object):
                 return alt_iv_seq
         
         def get_pair_alt_iv(self, alt1, alt2):
-                libtype = self.params['libtype']
+                libtype = self.libtype
                 if libtype == "fr-secondstrand" or libtype == "fr-unstranded":
                         alt_iv_seq1 = [ co.ref_iv for co in alt1.cigar if co.type == "M" and co.size > 0 ]
                         alt_iv_seq2 = [ self.reverse_strand(co.ref_iv) for co in alt2.cigar if co.type == "M" and co.size > 0 ]
@@ -290,7 +314,8 @@ class IRC_quant(object):
                                 break     
                 return flag
                                 
-        def assign_read_to_CJ(self, alt_iv_seq, CJ):     
+        # The counts of a read are appended to contributions (see quant_memo) and added to the counters by count_read.
+        def assign_read_to_CJ(self, alt_iv_seq, CJ, contributions):     
                 gene_id, gene_chrom, gene_strand = CJ.attr["gene_id"], CJ.iv.chrom, CJ.iv.strand
                 CJ_number, CJ_type = CJ.attr["constitutive_junction_number"], CJ.attr["constitutive_junction_type"]
                 overlap = self.params['minoverlap']
@@ -308,7 +333,7 @@ class IRC_quant(object):
                         # Junction is not spliced. in other words, intron retention is happend in this alignment for this constitutive junction
                         if junction_from_pos_index != -1 and junction_to_pos_index != -1:
                                 assert junction_from_pos_index == junction_to_pos_index
-                                self.CJ_counts[gene_id][CJ_number]["CJ_retained_reads"] += 1
+                                contributions.append(("CJ_counts", gene_id, CJ_number, "CJ_retained_reads", 1))
         
                         # Junction is spliced. The upstream region of constituive exonic region is covered by the alignment but 
                         # the downstream region of constitutive intronic region is not covered by the alignment.
@@ -337,7 +362,7 @@ class IRC_quant(object):
                                 
                                 # If all the pos in alt_next_pos_list are located in constituitive exonic region, we count this as a splicing junction read.
                                 if self.is_spliced_read_entirely_in_CER(alt_next_pos_list):
-                                        self.CJ_counts[gene_id][CJ_number]["CJ_spliced_reads"] += 1                                      
+                                        contributions.append(("CJ_counts", gene_id, CJ_number, "CJ_spliced_reads", 1))                                      
         
                         # Junction is spliced. The upstream region of constituive intronic region is not covered by the alignment and  
                         # the downstream region of constitutive exonic region is covered by the alignment.
@@ -366,9 +391,9 @@ class IRC_quant(object):
                                         
                                 # If all the pos in alt_prev_pos_list are located in constituitive exonic region, we count this as a splicing junction read.
                                 if self.is_spliced_read_entirely_in_CER(alt_prev_pos_list):
-                                        self.CJ_counts[gene_id][CJ_number]["CJ_spliced_reads"] += 1 
+                                        contributions.append(("CJ_counts", gene_id, CJ_number, "CJ_spliced_reads", 1)) 
                                         
-        def assign_read_to_CIR(self, alt_iv_seq, CIR):
+        def assign_read_to_CIR(self, alt_iv_seq, CIR, contributions):
                 gene_id, gene_chrom, gene_strand, CIR_number = CIR.attr["gene_id"], CIR.iv.chrom, CIR.iv.strand, CIR.attr["constitutive_intronic_region_number"]
                 upstream_CJ = self.gene_CIR_associated_CJ_database[gene_id][CIR_number]['upstream_constitutive_junction']
                 downstream_CJ = self.gene_CIR_associated_CJ_database[gene_id][CIR_number]['downstream_constitutive_junction']
@@ -395,10 +420,32 @@ class IRC_quant(object):
                         
                 if upstream_junction_from_pos_index != -1 and downstream_junction_to_pos_index != -1:
                         if gene_strand == "+" and downstream_junction_to_pos_index - upstream_junction_from_pos_index == 1 and upstream_junction_from_pos == end_list[upstream_junction_from_pos_index] and downstream_junction_to_pos == start_list[downstream_junction_to_pos_index]:
-                                self.CIR_counts[gene_id][CIR_number]['CIR_spliced_reads'] += 1
+                                contributions.append(("CIR_counts", gene_id, CIR_number, "CIR_spliced_reads", 1))
                         elif gene_strand ==  "-" and downstream_junction_to_pos_index - upstream_junction_from_pos_index == -1 and upstream_junction_from_pos == start_list[upstream_junction_from_pos_index] and downstream_junction_to_pos == end_list[downstream_junction_to_pos_index]:
-                                self.CIR_counts[gene_id][CIR_number]['CIR_spliced_reads'] += 1 
+                                contributions.append(("CIR_counts", gene_id, CIR_number, "CIR_spliced_reads", 1)) 
                                 
+        def get_read_contributions(self, alt_iv_seq):
+                contributions = []
+                if self.is_read_in_gene_region(alt_iv_seq) and self.is_read_in_CIR_or_CER(alt_iv_seq):
+                        gene_id = self.read_associated_gene(alt_iv_seq)
+                        for CJ in list(self.gene_CJ_database[gene_id].values()):
+                                self.assign_read_to_CJ(alt_iv_seq, CJ, contributions)
+                        for CIR in list(self.gene_CIR_database[gene_id].values()):
+                                self.assign_read_to_CIR(alt_iv_seq, CIR, contributions)
+                return contributions
+
+        # Reads with the same aligned blocks add the same counts, which are looked up in the assignment cache if enabled.
+        def count_read(self, alt_iv_seq):
+                if self.assignment_cache is None:
+                        add_contributions(self, self.get_read_contributions(alt_iv_seq))
+                        return
+                signature = alignment_signature(alt_iv_seq)
+                contributions = self.assignment_cache.get(signature)
+                if contributions is None:
+                        contributions = self.get_read_contributions(alt_iv_seq)
+                        self.assignment_cache.put(signature, contributions)
+                add_contributions(self, contributions)
+
         @staticmethod                                        
         def combine_pair_iv_seq(alt_first_iv_seq, alt_second_iv_seq):
                 combine_alt_iv_seq = []
@@ -412,148 +459,255 @@ class IRC_quant(object):
                                 combine_alt_iv_seq.append(alt.copy())
                 return combine_alt_iv_seq  
         
+        def get_quant_state(self):
+                return {'CIR_counts': self.CIR_counts, 'CJ_counts': self.CJ_counts}
+
+        def set_quant_state(self, state):
+                update_nested(self.CIR_counts, state['CIR_counts'])
+                update_nested(self.CJ_counts, state['CJ_counts'])
+
+        # With --saturation, --barcode-tag or --split-by the counters are split into buckets, which are all saved.
+        # With --umi-tag the fragments seen so far are saved too.
+        def get_checkpoint_state(self):
+                buckets = self.saturation or self.groups
+                state = buckets.get_state() if buckets else self.get_quant_state()
+                if self.dedup:
+                        state = dict(state, umi_dedup=self.dedup.get_state())
+                return state
+
+        def set_checkpoint_state(self, state):
+                buckets = self.saturation or self.groups
+                if buckets:
+                        buckets.set_state(state)
+                else:
+                        self.set_quant_state(state)
+                if self.dedup:
+                        self.dedup.set_state(state['umi_dedup'])
+
         def quant(self):
                 self.init_Counter_for_quant()
+                self.saturation = None
+                if self.params.get('saturation'):
+                        self.saturation = Saturation_Counter(self, parse_saturation_depths(self.params['saturation']), self.params.get('subsample'))
+                self.groups = None
+                if self.params.get('barcode_tag'):
+                        if not self.params.get('barcode_groups'):
+                                raise Exception("--barcode-tag requires a barcode to group file (--barcode-groups)")
+                        if self.saturation:
+                                raise Exception("--saturation cannot be combined with --barcode-tag")
+                        self.groups = Group_Counter(self, self.params['barcode_tag'], load_barcode_groups(self.params['barcode_groups']))
+                if self.params.get('split_by'):
+                        if self.saturation or self.groups:
+                                raise Exception("--split-by cannot be combined with --saturation or --barcode-tag")
+                        libtypes = None
+                        if self.params.get('libtype_sheet'):
+                                libtypes = load_libtype_sheet(self.params['libtype_sheet'])
+                                # Strandedness of the annotation arrays is decided by --library-type
+                                for value, libtype in libtypes.items():
+                                        if self.is_stranded(libtype) != self.stranded:
+                                                raise Exception("Library type {} of {} in {} and --library-type {} must be all stranded or all unstranded.".format(libtype, value, self.params['libtype_sheet'], self.params['libtype']))
+                        self.groups = Group_Counter(self, self.params['split_by'], libtypes=libtypes)
                 
                 logging.info("Counting number of retained reads and spliced reads for each constitutive junction (CJ) and constitutive intronic region (CIR)")                        
                 
-                bamfile = HTSeq.BAM_Reader(self.params['altfile'])
+                bamfile = Alignment_Reader(self.params['altfile'], self.params.get('reference'), self.params.get('subsample'), self.params.get('regions'))
+                # Read pairs are bundled by read name, so only single-end reads can come in coordinate order
+                coordinate_sorted = self.params['readtype'] == "single" and bamfile.get_sort_order() == "coordinate"
+                self.dedup = None
+                if self.params.get('umi_tag'):
+                        # The copy of a fragment that is kept may be in a higher depth than its duplicates
+                        if self.saturation:
+                                raise Exception("--umi-tag cannot be combined with --saturation")
+                        self.dedup = UMI_Deduplicator(self.params['umi_tag'], self.params.get('barcode_tag') or self.params.get('split_by'), coordinate_sorted)
+                self.sweep = None
+                if coordinate_sorted and not self.params.get('no_sweep'):
+                        arrays = ["genes", "gene_region", "CER_region"]
+                        self.sweep = Annotation_Sweep(self, arrays)
+                self.assignment_cache = None
+                if self.params.get('assignment_cache', 0) > 0:
+                        self.assignment_cache = Assignment_Cache(self.params['assignment_cache'])
+                checkpoint = Quant_Checkpoint(self.params)
+                if self.params.get('resume'):
+                        saved_checkpoint = checkpoint.load()
+                        if saved_checkpoint is not None:
+                                self.set_checkpoint_state(saved_checkpoint['counters'])
+                                bamfile.set_resume_point(saved_checkpoint['record_no'], saved_checkpoint['offset'])
+                                
                 if self.params['readtype'] == "single":
                         for alt in bamfile:
+                                # Counters include every record before this one, so this is a safe point to resume from.
+                                if checkpoint.enabled and checkpoint.is_due(bamfile.record_no):
+                                        checkpoint.save(self.get_checkpoint_state(), bamfile.record_no, bamfile.record_offset)
+                                        
+                                if self.saturation:
+                                        self.saturation.select(alt.read.name)
+                                if self.groups and not self.groups.select(alt):
+                                        continue
                                 # Consider the alignments that are aligned and uniquely mapped.
                                 if alt.aligned and self.unique_aligned(alt) and re.match('chr', alt.iv.chrom):                                              
-                                        alt_iv_seq = self.get_alt_iv(alt)    
-                                        if self.is_read_in_gene_region(alt_iv_seq) and self.is_read_in_CIR_or_CER(alt_iv_seq):                                             
-                                                gene_id = self.read_associated_gene(alt_iv_seq)
-                                                for CJ in list(self.gene_CJ_database[gene_id].values()):
-                                                        self.assign_read_to_CJ(alt_iv_seq, CJ)
-                                                for CIR in list(self.gene_CIR_database[gene_id].values()):
-                                                        self.assign_read_to_CIR(alt_iv_seq, CIR)
+                                        if self.dedup and self.dedup.is_duplicate(alt):
+                                                continue
+                                        if self.sweep:
+                                                self.sweep.move_to(alt.iv.chrom, alt.iv.start)
+                                        if self.saturation:
+                                                self.saturation.add_read()
+                                        self.count_read(self.get_alt_iv(alt))
                                                         
                 elif self.params['readtype'] == "paired":
-                        for alt_first, alt_second in HTSeq.pair_SAM_alignments(bamfile):
-                                if alt_first == None or alt_second == None:
-                                        continue
-                                if alt_first.aligned and self.unique_aligned(alt_first) and alt_second.aligned and self.unique_aligned(alt_second) and alt_first.iv.chrom == alt_second.iv.chrom and re.match('chr', alt_first.iv.chrom) and re.match('chr', alt_second.iv.chrom):
-                                        alt_first_iv_seq, alt_second_iv_seq = self.get_pair_alt_iv(alt_first, alt_second)
-                                        alt_iv_seq = self.combine_pair_iv_seq(alt_first_iv_seq, alt_second_iv_seq)
+                        # Alignments are bundled by read name, so that a checkpoint never splits the alignments of one read pair.
+                        for bundle in bamfile.pair_bundles():
+                                for alt_first, alt_second in bundle:
+                                        if alt_first == None or alt_second == None:
+                                                continue
+                                        if self.saturation:
+                                                self.saturation.select(alt_first.read.name)
+                                        if self.groups and not self.groups.select(alt_first):
+                                                continue
+                                        if alt_first.aligned and self.unique_aligned(alt_first) and alt_second.aligned and self.unique_aligned(alt_second) and alt_first.iv.chrom == alt_second.iv.chrom and re.match('chr', alt_first.iv.chrom) and re.match('chr', alt_second.iv.chrom):
+                                                if self.dedup and self.dedup.is_duplicate_pair(alt_first, alt_second):
+                                                        continue
+                                                if self.saturation:
+                                                        self.saturation.add_read()
+                                                alt_first_iv_seq, alt_second_iv_seq = self.get_pair_alt_iv(alt_first, alt_second)
+                                                self.count_read(self.combine_pair_iv_seq(alt_first_iv_seq, alt_second_iv_seq))
+                                                                
+                                # The record just read by the pairing belongs to the next read name and is not counted yet.
+                                if checkpoint.enabled and not bamfile.exhausted and checkpoint.is_due(bamfile.record_no):
+                                        checkpoint.save(self.get_checkpoint_state(), bamfile.record_no, bamfile.record_offset)
                                         
-                                        if self.is_read_in_gene_region(alt_iv_seq) and self.is_read_in_CIR_or_CER(alt_iv_seq):   
-                                                gene_id = self.read_associated_gene(alt_iv_seq)
-                                                for CJ in list(self.gene_CJ_database[gene_id].values()):
-                                                        self.assign_read_to_CJ(alt_iv_seq, CJ)
-                                                for CIR in list(self.gene_CIR_database[gene_id].values()):
-                                                        self.assign_read_to_CIR(alt_iv_seq, CIR)
+                checkpoint.remove()
+                if self.sweep:
+                        self.sweep.close()
+                if self.dedup:
+                        self.dedup.log_summary()
+                self.counting_metrics = {}
+                if self.assignment_cache:
+                        logging.info("Assignment cache: {} hits in {} reads ({:.2f}%)".format(self.assignment_cache.hits, self.assignment_cache.hits + self.assignment_cache.misses, self.assignment_cache.hit_rate() * 100))
+                        self.counting_metrics = self.assignment_cache.get_metrics()
+                self.records_processed = bamfile.record_no - bamfile.resume_record_no
                                                         
         @staticmethod
-        def get_quantile_index(read_count_qantile_list, read_count):
-                return bisect.bisect_right(read_count_qantile_list, read_count) - 1
-                                                        
-        def empirical_filter(self, row, read_count_qantile_list, filter_cutoff_quantile_list):
-                if row.CIR_retained_reads == 0:
-                        return row.intron_IRC
-                else:
-                        if row.max_percentage <= filter_cutoff_quantile_list[self.get_quantile_index(read_count_qantile_list, row.CIR_retained_reads)]:
-                                return row.intron_IRC
-                        else:
-                                if row.max_percentage == row["5_percentage"]:
-                                        return "NA (5'AS)"
-                                elif row.max_percentage == row["3_percentage"]:
-                                        return "NA (3'AS)"
-                                                        
+        def get_IRC(retained_reads, total_reads):
+                with np.errstate(divide='ignore', invalid='ignore'):
+                        return np.divide(retained_reads, total_reads)
+
+        # Retained and spliced read counts of every CJ as arrays, in the order of the junction output, and the position of each CJ in them.
+        def get_CJ_vectors(self):
+                CJ_keys, CJ_retained_reads, CJ_spliced_reads = [], [], []
+                for gene_id in sorted(self.CJ_counts.keys()):
+                        gene_CJ_counts = self.CJ_counts[gene_id]
+                        for CJ_number in sorted(gene_CJ_counts.keys()):
+                                CJ_counter = gene_CJ_counts[CJ_number]
+                                CJ_keys.append((gene_id, CJ_number))
+                                CJ_retained_reads.append(CJ_counter["CJ_retained_reads"])
+                                CJ_spliced_reads.append(CJ_counter["CJ_spliced_reads"])
+                CJ_index = dict(zip(CJ_keys, range(len(CJ_keys))))
+                return CJ_keys, CJ_index, np.array(CJ_retained_reads), np.array(CJ_spliced_reads)
+
+        # CIRs whose retained reads come mostly from one side (alternative 5' or 3' splice sites rather than intron retention) are
+        # labelled "NA (5'AS)" or "NA (3'AS)". The cut-off of the larger side's share is the (1 - outlier) percentile within each
+        # quartile of retained read counts.
         def apply_5_3_unbalanced_filter(self, df, outlier=0.01):
                 logging.info("Appling filter to remove fake intron retention events")
                 
-                df["gene_id"] = df.CIR_id.str[:-4]
-                df["CIR_number"] = df.CIR_id.str[-3:]
-                
-                df["CIR_retained_reads"] = df["CIR_5'retained_reads"] + df["CIR_3'retained_reads"]
-                df["5_percentage"] = df["CIR_5'retained_reads"] / df["CIR_retained_reads"]
-                df["3_percentage"] = df["CIR_3'retained_reads"] / df["CIR_retained_reads"]
-                df["max_percentage"] = df.apply(lambda row: max(row["5_percentage"], row["3_percentage"]), axis=1)       
+                five_retained_reads = df["CIR_5'retained_reads"].values
+                three_retained_reads = df["CIR_3'retained_reads"].values
+                CIR_retained_reads = five_retained_reads + three_retained_reads
+                with np.errstate(divide='ignore', invalid='ignore'):
+                        five_percentage = five_retained_reads / CIR_retained_reads
+                        three_percentage = three_retained_reads / CIR_retained_reads
+                max_percentage = np.maximum(five_percentage, three_percentage)
                 
                 try:
                         read_count_qantile_list = []
                         filter_cutoff_quantile_list = []
+                        retained = CIR_retained_reads[CIR_retained_reads > 0]
                         for q in [0, 25, 50, 75]:
-                                lower, upper = np.percentile(df[df.CIR_retained_reads > 0].CIR_retained_reads, q), np.percentile(df[df.CIR_retained_reads > 0].CIR_retained_reads, q+25)
-                                max_percentage_cutoff = np.percentile(df.loc[(df.CIR_retained_reads > lower) & (df.CIR_retained_reads <= upper), 'max_percentage'], (1 - outlier) * 100)
+                                lower, upper = np.percentile(retained, q), np.percentile(retained, q+25)
+                                max_percentage_cutoff = np.percentile(max_percentage[(CIR_retained_reads > lower) & (CIR_retained_reads <= upper)], (1 - outlier) * 100)
                                 
                                 read_count_qantile_list.append(lower)
                                 filter_cutoff_quantile_list.append(max_percentage_cutoff)
                         
-                        df['intron_IRC'] = df.apply(lambda row: self.empirical_filter(row, read_count_qantile_list, filter_cutoff_quantile_list), axis=1)
+                        quantile_index = np.searchsorted(read_count_qantile_list, CIR_retained_reads, side="right") - 1
+                        filtered = (CIR_retained_reads != 0) & ~(max_percentage <= np.array(filter_cutoff_quantile_list)[quantile_index])
+                        if filtered.any():
+                                intron_IRC = df.intron_IRC.values.astype(object)
+                                intron_IRC[filtered] = None
+                                intron_IRC[filtered & (max_percentage == three_percentage)] = "NA (3'AS)"
+                                intron_IRC[filtered & (max_percentage == five_percentage)] = "NA (5'AS)"
+                                df['intron_IRC'] = intron_IRC
                         
-                        self.filtered_CIR_id_list = list(df[df.intron_IRC.isin(["NA (5'AS)", "NA (3'AS)"])].CIR_id)  
+                        self.filtered_CIR_id_list = list(df.CIR_id.values[filtered])
                 except IndexError:
                         self.filtered_CIR_id_list = []
 
                 logging.info("{} constitutive intronic regions (CIR) are unlikely to be intron retention events and are filtered".format(len(self.filtered_CIR_id_list)))
                 
-                return df.drop(labels=['gene_id', 'CIR_number', 'CIR_retained_reads', '5_percentage', '3_percentage', 'max_percentage'], axis=1)
+                return df
                                                         
         def output_IRC_junction_level(self):                 
                 logging.info("Calculating IRC for each constitutive junction (CJ)")
                 
-                IRC_junction_level_data = []
-                for gene_id in sorted(self.CJ_counts.keys()):
-                        for CJ_number in sorted(self.CJ_counts[gene_id].keys()):
-                                CJ_id = gene_id + ":" + CJ_number
-                                CJ_type = self.gene_CJ_database[gene_id][CJ_number].attr["constitutive_junction_type"]
-                                CJ_retained_reads = self.CJ_counts[gene_id][CJ_number]["CJ_retained_reads"]
-                                CJ_spliced_reads = self.CJ_counts[gene_id][CJ_number]["CJ_spliced_reads"]                               
-                                
-                                junction_IRC = np.divide(CJ_retained_reads * 1.0, CJ_retained_reads + CJ_spliced_reads)
-                                
-                                IRC_junction_level_dict = {"CJ_id": CJ_id,
-                                                           "CJ_iv": self.CJ_id2iv[CJ_id],
-                                                           "CJ_type": CJ_type,
+                CJ_keys, CJ_index, CJ_retained_reads, CJ_spliced_reads = self.get_CJ_vectors()
+                CJ_ids = [gene_id + ":" + CJ_number for gene_id, CJ_number in CJ_keys]
+                                                                   
+                self.IRC_junction_level_df = pd.DataFrame({"CJ_id": CJ_ids,
+                                                           "CJ_iv": [self.CJ_id2iv[CJ_id] for CJ_id in CJ_ids],
+                                                           "CJ_type": [self.gene_CJ_database[gene_id][CJ_number].attr["constitutive_junction_type"] for gene_id, CJ_number in CJ_keys],
                                                            "CJ_retained_reads": CJ_retained_reads,
                                                            "CJ_spliced_reads": CJ_spliced_reads,
-                                                           "junction_IRC": junction_IRC}
-                                
-                                IRC_junction_level_data.append(IRC_junction_level_dict)                                
-                                                                   
-                self.IRC_junction_level_df = pd.DataFrame(IRC_junction_level_data, columns=["CJ_id", "CJ_iv", "CJ_type", "CJ_retained_reads", "CJ_spliced_reads", "junction_IRC"])                
+                                                           "junction_IRC": self.get_IRC(CJ_retained_reads * 1.0, CJ_retained_reads + CJ_spliced_reads)},
+                                                          columns=["CJ_id", "CJ_iv", "CJ_type", "CJ_retained_reads", "CJ_spliced_reads", "junction_IRC"])                
                 
-                outfile = self.params['name'] + ".quant.IRC.junctions.txt" 
-                outfile_fullpath = os.path.join(self.params['outdir'], outfile)
+                outfile_prefix = os.path.join(self.params['outdir'], self.params['name'] + ".quant.IRC.junctions")
+                outfile_fullpath = get_table_path(outfile_prefix, self.params.get('output_format') or "tsv")
                 logging.info("Writing junction level result to file: {}".format(outfile_fullpath))
-                self.IRC_junction_level_df.to_csv(outfile_fullpath, index=None, sep='\t', na_rep="NA")
+                write_table(self.IRC_junction_level_df, outfile_prefix, self.params.get('output_format') or "tsv")
                 
         def output_IRC_intron_level(self):                 
                 logging.info("Calculating IRC for each constitutive intronic region (CIR)")
                 
-                IRC_intron_level_data = []
+                CJ_keys, CJ_index, CJ_retained_reads, CJ_spliced_reads = self.get_CJ_vectors()
+                # 5' and 3' retained reads of a CIR are the retained reads of its upstream and downstream CJ
+                CIR_ids, CIR_counters, upstream_CJ, downstream_CJ, CIR_spliced_reads = [], [], [], [], []
                 for gene_id in sorted(self.CIR_counts.keys()):
-                        for CIR_number in sorted(self.CIR_counts[gene_id].keys()):
-                                CIR_id = gene_id + ":" + CIR_number
-                                upstream_CJ_number = self.gene_CIR_database[gene_id][CIR_number].attr["upstream_constitutive_junction_number"]
-                                downstream_CJ_number = self.gene_CIR_database[gene_id][CIR_number].attr["downstream_constitutive_junction_number"]
-                                CIR_five_retained_reads = self.CIR_counts[gene_id][CIR_number]["CIR_5'retained_reads"] = self.CJ_counts[gene_id][upstream_CJ_number]["CJ_retained_reads"]
-                                CIR_three_retained_reads = self.CIR_counts[gene_id][CIR_number]["CIR_3'retained_reads"] = self.CJ_counts[gene_id][downstream_CJ_number]["CJ_retained_reads"]
-                                
-                                CIR_spliced_reads = self.CIR_counts[gene_id][CIR_number]["CIR_spliced_reads"]                                
-                                intron_IRC = np.divide((CIR_five_retained_reads + CIR_three_retained_reads) / 2.0, (CIR_five_retained_reads + CIR_three_retained_reads) / 2.0 + CIR_spliced_reads)
-                                                                
-                                IRC_intron_level_dict = {"CIR_id": CIR_id,
-                                                         "CIR_iv": self.CIR_id2iv[CIR_id],
+                        gene_CIR_counts = self.CIR_counts[gene_id]
+                        gene_CIR_database = self.gene_CIR_database[gene_id]
+                        for CIR_number in sorted(gene_CIR_counts.keys()):
+                                CIR_counter = gene_CIR_counts[CIR_number]
+                                CIR_attr = gene_CIR_database[CIR_number].attr
+                                CIR_ids.append(gene_id + ":" + CIR_number)
+                                CIR_counters.append(CIR_counter)
+                                upstream_CJ.append(CJ_index[(gene_id, CIR_attr["upstream_constitutive_junction_number"])])
+                                downstream_CJ.append(CJ_index[(gene_id, CIR_attr["downstream_constitutive_junction_number"])])
+                                CIR_spliced_reads.append(CIR_counter["CIR_spliced_reads"])
+                CIR_five_retained_reads = CJ_retained_reads[np.array(upstream_CJ, dtype=int)]
+                CIR_three_retained_reads = CJ_retained_reads[np.array(downstream_CJ, dtype=int)]
+                CIR_spliced_reads = np.array(CIR_spliced_reads)
+                # the gene level counts are summed from the CIR counters
+                for CIR_counter, five_retained_reads, three_retained_reads in zip(CIR_counters, CIR_five_retained_reads.tolist(), CIR_three_retained_reads.tolist()):
+                        CIR_counter["CIR_5'retained_reads"] = five_retained_reads
+                        CIR_counter["CIR_3'retained_reads"] = three_retained_reads
+                
+                half_retained_reads = (CIR_five_retained_reads + CIR_three_retained_reads) / 2.0
+                self.IRC_intron_level_df = pd.DataFrame({"CIR_id": CIR_ids,
+                                                         "CIR_iv": [self.CIR_id2iv[CIR_id] for CIR_id in CIR_ids],
                                                          "CIR_5'retained_reads": CIR_five_retained_reads,
                                                          "CIR_3'retained_reads": CIR_three_retained_reads,
                                                          "CIR_spliced_reads": CIR_spliced_reads,
-                                                         "intron_IRC": intron_IRC}
-                                
-                                IRC_intron_level_data.append(IRC_intron_level_dict)                                
-                                                                   
-                self.IRC_intron_level_df = pd.DataFrame(IRC_intron_level_data, columns=["CIR_id", "CIR_iv", "CIR_5'retained_reads", "CIR_3'retained_reads", "CIR_spliced_reads", "intron_IRC"])                
+                                                         "intron_IRC": self.get_IRC(half_retained_reads, half_retained_reads + CIR_spliced_reads)},
+                                                        columns=["CIR_id", "CIR_iv", "CIR_5'retained_reads", "CIR_3'retained_reads", "CIR_spliced_reads", "intron_IRC"])                
                 
                 if self.filter:
+                        metrics.start_stage("filtering")
                         self.IRC_intron_level_df = self.apply_5_3_unbalanced_filter(self.IRC_intron_level_df)
+                        metrics.end_stage()
                 
-                outfile = self.params['name'] + ".quant.IRC.introns.txt" 
-                outfile_fullpath = os.path.join(self.params['outdir'], outfile)
+                outfile_prefix = os.path.join(self.params['outdir'], self.params['name'] + ".quant.IRC.introns")
+                outfile_fullpath = get_table_path(outfile_prefix, self.params.get('output_format') or "tsv")
                 logging.info("Writing intron level result to file: {}".format(outfile_fullpath))
-                self.IRC_intron_level_df.to_csv(outfile_fullpath, index=None, sep='\t', na_rep="NA")
+                write_table(self.IRC_intron_level_df, outfile_prefix, self.params.get('output_format') or "tsv")
                 
         def filter_CIR_id(self, filtered_CIR_id_list):
                 for CIR_id in filtered_CIR_id_list:
@@ -568,27 +722,38 @@ class IRC_quant(object):
                         filtered_CIR_id_list = self.filtered_CIR_id_list
                 self.filter_CIR_id(filtered_CIR_id_list)                
                 
-                IRC_gene_level_data = []
-                for gene_id in sorted(self.CIR_counts.keys()):
-                        gene_retained_reads = self.gene_counts["gene_retained_reads"][gene_id] = sum([(self.CIR_counts[gene_id][CIR_number]["CIR_5'retained_reads"] + self.CIR_counts[gene_id][CIR_number]["CIR_3'retained_reads"]) / 2.0 for CIR_number in list(self.CIR_counts[gene_id].keys())])
-                        gene_spliced_reads = self.gene_counts["gene_spliced_reads"][gene_id] = sum([self.CIR_counts[gene_id][CIR_number]["CIR_spliced_reads"] for CIR_number in list(self.CIR_counts[gene_id].keys())])
-                        
-                        gene_IRC = np.divide(gene_retained_reads * 1.0, gene_retained_reads + gene_spliced_reads)
-                        
-                        IRC_gene_level_dict = {"gene_id": gene_id,
-                                               "gene_iv": self.gene_id2iv[gene_id],
-                                               "gene_retained_reads": gene_retained_reads,
-                                               "gene_spliced_reads": gene_spliced_reads,
-                                               "gene_IRC": gene_IRC}
-                
-                        IRC_gene_level_data.append(IRC_gene_level_dict)                                    
+                # Counts of the remaining CIRs summed by gene. They are whole numbers (halves for retained reads), so the sums
+                # are exact in any order.
+                gene_ids = sorted(self.CIR_counts.keys())
+                CIR_gene_index, CIR_half_retained_reads, CIR_spliced_reads = [], [], []
+                for i, gene_id in enumerate(gene_ids):
+                        for CIR_counter in self.CIR_counts[gene_id].values():
+                                CIR_gene_index.append(i)
+                                CIR_half_retained_reads.append((CIR_counter["CIR_5'retained_reads"] + CIR_counter["CIR_3'retained_reads"]) / 2.0)
+                                CIR_spliced_reads.append(CIR_counter["CIR_spliced_reads"])
+                CIR_spliced_reads = np.array(CIR_spliced_reads)
+                gene_retained_reads = np.bincount(CIR_gene_index, weights=CIR_half_retained_reads, minlength=len(gene_ids))
+                gene_spliced_reads = np.bincount(CIR_gene_index, weights=CIR_spliced_reads, minlength=len(gene_ids))
+                if CIR_spliced_reads.dtype.kind in "iu" or not CIR_gene_index:
+                        gene_spliced_reads = gene_spliced_reads.astype(np.int64)
+                if not CIR_gene_index:
+                        # genes without CIRs count 0, not 0.0
+                        gene_retained_reads = gene_retained_reads.astype(np.int64)
+                for gene_id, retained_reads, spliced_reads in zip(gene_ids, gene_retained_reads.tolist(), gene_spliced_reads.tolist()):
+                        self.gene_counts["gene_retained_reads"][gene_id] = retained_reads
+                        self.gene_counts["gene_spliced_reads"][gene_id] = spliced_reads
                                                                           
-                self.IRC_gene_level_df = pd.DataFrame(IRC_gene_level_data, columns=["gene_id", "gene_iv", "gene_retained_reads", "gene_spliced_reads", "gene_IRC"])                
-                
-                outfile = self.params['name'] + ".quant.IRC.genes.txt" 
-                outfile_fullpath = os.path.join(self.params['outdir'], outfile)
+                self.IRC_gene_level_df = pd.DataFrame({"gene_id": gene_ids,
+                                                       "gene_iv": [self.gene_id2iv[gene_id] for gene_id in gene_ids],
+                                                       "gene_retained_reads": gene_retained_reads,
+                                                       "gene_spliced_reads": gene_spliced_reads,
+                                                       "gene_IRC": self.get_IRC(gene_retained_reads * 1.0, gene_retained_reads + gene_spliced_reads)},
+                                                      columns=["gene_id", "gene_iv", "gene_retained_reads", "gene_spliced_reads", "gene_IRC"])                
+                
+                outfile_prefix = os.path.join(self.params['outdir'], self.params['name'] + ".quant.IRC.genes")
+                outfile_fullpath = get_table_path(outfile_prefix, self.params.get('output_format') or "tsv")
                 logging.info("Writing gene level result to file: {}".format(outfile_fullpath))
-                self.IRC_gene_level_df.to_csv(outfile_fullpath, index=None, sep='\t', na_rep="NA")
+                write_table(self.IRC_gene_level_df, outfile_prefix, self.params.get('output_format') or "tsv")
                 
         def output_IRC_genome_wide(self):
                 total_retained_reads = sum(self.gene_counts["gene_retained_reads"].values())
@@ -601,4 +766,6 @@ class IRC_quant(object):
                 print(("\tTotal retained reads: %i (%.2f%%)" % (total_retained_reads, total_retained_reads * 100.0 / total_reads)))
                 print(("\tTotal spliced reads: %i (%.2f%%)" % (total_spliced_reads, total_spliced_reads * 100.0 / total_reads)))
                 print(("\tTotal junction reads (retained reads + spliced reads): %i" % (total_retained_reads + total_spliced_reads)))
+                if self.params.get('subsample'):
+                        print(("\tSubsampling fraction: %g" % self.params['subsample']))
                 print(("\tGenome-wide IRC: %f" % IRC_genome_wide))
@@ -11,24 +11,47 @@ import bisect
 import HTSeq
 import warnings
 from functools import reduce
+from IRTools.quant_reader import Alignment_Reader
+from IRTools.quant_checkpoint import Quant_Checkpoint, update_nested
+from IRTools import metrics
+from IRTools.quant_saturation import Saturation_Counter, parse_saturation_depths
+from IRTools.quant_groups import Group_Counter, load_barcode_groups, load_libtype_sheet
+from IRTools.quant_dedup import UMI_Deduplicator
+from IRTools.quant_memo import Assignment_Cache, alignment_signature, add_contributions
+from IRTools.quant_sweep import Annotation_Sweep, score_sum
+from IRTools.quant_index import annotation_index_dir, open_annotation_index, write_annotation_index
+from IRTools.table_io import get_table_path, write_table
 
 class IRI_quant(object):       
         def __init__(self, args):
                 self.params = args.__dict__.copy()
                 self.stranded = self.is_stranded(self.params['libtype'])
+                # Library type of the reads being counted (it can change from read to read with --split-by and --libtype-sheet)
+                self.libtype = self.params['libtype']
                 
+                metrics.start_stage("annotation_loading")
                 self.gtffile = self.load_gtffile()
                 
                 self.gene_id2iv = self.get_gene_iv()
                 self.valid_genes = set(self.gene_id2iv.keys())
                 
                 self.CIR_id2iv = self.get_CIR_iv()
-                
-                self.gene_map_score = self.init_mappability_GenomicArray(map_score_cutoff = 0.1)   
+                # With --annotation-index, the arrays used to assign reads are mapped from the index written by an earlier run
+                self.index_dir = annotation_index_dir(self.params, "IRI", self.stranded) if self.params.get('annotation_index') else None
+                self.index = open_annotation_index(self.index_dir) if self.index_dir else None
+                metrics.end_stage()
+                
+                metrics.start_stage("mappability_loading")
+                if self.index:
+                        self.gene_map_score = self.index.get_array("gene_map_score")
+                else:
+                        self.gene_map_score = self.init_mappability_GenomicArray(map_score_cutoff = 0.1)   
                 
                 self.CIR_effective_length = self.get_CIR_effective_length()
                 self.CER_length = self.get_CER_length()
+                metrics.end_stage()
                 
+                metrics.start_stage("annotation_loading")
                 self.genes, self.gene_region, self.counts = self.init_GenomicArrayOfSets_and_Counter_for_quant_IRI()
                                        
                 # bin filter
@@ -38,6 +61,9 @@ class IRI_quant(object):
                         self.bins, self.bin_counts = self.init_GenomicArrayOfSets_and_Counter_for_bin_filter()
                 
                 self.G = self.get_constitutive_junction_graph()
+                if self.index_dir and not self.index:
+                        write_annotation_index(self.index_dir, {"genes": self.genes, "gene_region": self.gene_region, "gene_map_score": self.gene_map_score, "bins": self.bins}, self.stranded)
+                metrics.end_stage()
                 
         @staticmethod
         def is_stranded(libtype):
@@ -155,28 +181,33 @@ class IRI_quant(object):
                 if type(alt_iv_seq) == list:
                         read_length = 0
                         for alt_iv in alt_iv_seq:
-                                read_length += int(sum(gene_map_score[alt_iv]))
+                                read_length += int(score_sum(gene_map_score, alt_iv))
                         return read_length
                 else:
-                        return int(sum(gene_map_score[alt_iv_seq]))   
+                        return int(score_sum(gene_map_score, alt_iv_seq))   
                 
+        # With an annotation index only the counters are built, the arrays are those of the index.
         def init_GenomicArrayOfSets_and_Counter_for_quant_IRI(self):
-                genes = HTSeq.GenomicArrayOfSets("auto", stranded=self.stranded)
-                gene_region = HTSeq.GenomicArrayOfSets("auto", stranded=self.stranded)                
+                build = self.index is None
+                genes = HTSeq.GenomicArrayOfSets("auto", stranded=self.stranded) if build else self.index.get_array("genes")
+                gene_region = HTSeq.GenomicArrayOfSets("auto", stranded=self.stranded) if build else self.index.get_array("gene_region")
                 counts = collections.defaultdict( lambda:  collections.defaultdict( lambda:  collections.Counter()))  
                 
                 for feature in self.gtffile:
                         gene_id = feature.attr["gene_id"]
                         if feature.type == "gene_region":
-                                gene_region[feature.iv] += gene_id
+                                if build:
+                                        gene_region[feature.iv] += gene_id
                         elif feature.type == "constitutive_exonic_region" and gene_id in self.valid_genes:
                                 CER_number = feature.attr["constitutive_exonic_region_number"]
-                                genes[feature.iv] += (gene_id, feature.type, CER_number)
+                                if build:
+                                        genes[feature.iv] += (gene_id, feature.type, CER_number)
                                 counts[gene_id]["constitutive_exonic_region"][CER_number] = 0
                         elif feature.type == "constitutive_intronic_region" and gene_id in self.valid_genes:
                                 CIR_number = feature.attr["constitutive_intronic_region_number"]
                                 if self.CIR_effective_length[gene_id][CIR_number] > 0: 
-                                        genes[feature.iv] += (gene_id, feature.type, CIR_number) 
+                                        if build:
+                                                genes[feature.iv] += (gene_id, feature.type, CIR_number) 
                                         counts[gene_id]["constitutive_intronic_region"][CIR_number] = 0
                 return genes, gene_region, counts             
         
@@ -206,7 +237,8 @@ class IRI_quant(object):
                 return bin_iv_list      
         
         def init_GenomicArrayOfSets_and_Counter_for_bin_filter(self):
-                bins = HTSeq.GenomicArrayOfSets("auto", stranded=self.stranded)                   
+                build = self.index is None
+                bins = HTSeq.GenomicArrayOfSets("auto", stranded=self.stranded) if build else self.index.get_array("bins")
                 bin_counts = collections.defaultdict( lambda:  collections.defaultdict( lambda:  collections.Counter()))
                         
                 for feature in self.gtffile:
@@ -215,9 +247,11 @@ class IRI_quant(object):
                                 CIR_number = feature.attr["constitutive_intronic_region_number"]
                                 CIR_effective_length = self.CIR_effective_length[gene_id][CIR_number]
                                 if CIR_effective_length >= self.num_bins:
-                                        bins_iv_list = self.binnize(feature.iv, CIR_effective_length, self.gene_map_score, self.num_bins)
+                                        if build:
+                                                bins_iv_list = self.binnize(feature.iv, CIR_effective_length, self.gene_map_score, self.num_bins)
                                         for bin_number in range(self.num_bins):
-                                                bins[bins_iv_list[bin_number]] += (gene_id, CIR_number, bin_number) 
+                                                if build:
+                                                        bins[bins_iv_list[bin_number]] += (gene_id, CIR_number, bin_number) 
                                                 bin_counts[gene_id][CIR_number][bin_number] = 0 
                                 else:
                                         for bin_number in range(self.num_bins):
@@ -258,7 +292,7 @@ class IRI_quant(object):
                 return iv_reversed        
         
         def get_alt_iv(self, alt):
-                libtype = self.params['libtype']
+                libtype = self.libtype
                 if libtype == "fr-secondstrand" or libtype == "fr-unstranded":
                         alt_iv_seq = [ co.ref_iv for co in alt.cigar if co.type == "M" and co.size > 0 ]
                 elif libtype == "fr-firststrand":
@@ -266,7 +300,7 @@ class IRI_quant(object):
                 return alt_iv_seq
         
         def get_pair_alt_iv(self, alt1, alt2):
-                libtype = self.params['libtype']
+                libtype = self.libtype
                 if libtype == "fr-secondstrand" or libtype == "fr-unstranded":
                         alt_iv_seq1 = [ co.ref_iv for co in alt1.cigar if co.type == "M" and co.size > 0 ]
                         alt_iv_seq2 = [ self.reverse_strand(co.ref_iv) for co in alt2.cigar if co.type == "M" and co.size > 0 ]
@@ -310,24 +344,48 @@ class IRI_quant(object):
                                         iset_union.update(gene_step_set)                             
                 return len(iset_union) == 1
         
-        def assign_read_to_region(self, alt_iv_seq):
+        # The counts of a read are appended to contributions (see quant_memo) and added to the counters by count_read.
+        def assign_read_to_region(self, alt_iv_seq, contributions):
                 alt_read_length = self.get_effective_length(alt_iv_seq, self.gene_map_score)
                 if alt_read_length > 0:
                         for alt_iv in alt_iv_seq:
                                 for iv, step_set in self.genes[alt_iv].steps():
                                         if step_set:
                                                 gene_id, feature_type, region_number = list(step_set)[0]
-                                                self.counts[gene_id][feature_type][region_number] += self.get_effective_length(iv, self.gene_map_score) * 1.0 / alt_read_length 
+                                                contributions.append(("counts", gene_id, feature_type, region_number, self.get_effective_length(iv, self.gene_map_score) * 1.0 / alt_read_length))
                                         
-        def assign_read_to_bin_filter(self, alt_iv_seq):
+        def assign_read_to_bin_filter(self, alt_iv_seq, contributions):
                 alt_read_length = self.get_effective_length(alt_iv_seq, self.gene_map_score)
                 if alt_read_length > 0:
                         for alt_iv in alt_iv_seq:
                                 for iv, step_set in self.bins[alt_iv].steps():
                                         if step_set:
                                                 gene_id, CIR_number, bin_number = list(step_set)[0]
-                                                self.bin_counts[gene_id][CIR_number][bin_number] += self.get_effective_length(iv, self.gene_map_score) * 1.0 / alt_read_length  
+                                                contributions.append(("bin_counts", gene_id, CIR_number, bin_number, self.get_effective_length(iv, self.gene_map_score) * 1.0 / alt_read_length))
+
+        # Eligible alignments are those mapped into one gene's either constitutive exonic region (CER) or constitutive intronic region (CIR).
+        # For each eligible alignment, we count by fraction of length. i.e. If an alt has 50 bps, 30 bps in CER "001", 20 bps in CIR "001". Then, count in CER "001" is 0.6,
+        # and count in CIR "001" is 0.4. (IRI is considered in intron level, so count is distributed in intron level)
+        def get_read_contributions(self, alt_iv_seq):
+                contributions = []
+                if self.is_read_in_gene_region(alt_iv_seq) and self.is_read_in_CIR_or_CER(alt_iv_seq):
+                        self.assign_read_to_region(alt_iv_seq, contributions)
+                        if self.bin_filter:
+                                self.assign_read_to_bin_filter(alt_iv_seq, contributions)
+                return contributions
         
+        # Reads with the same aligned blocks add the same counts, which are looked up in the assignment cache if enabled.
+        def count_read(self, alt_iv_seq):
+                if self.assignment_cache is None:
+                        add_contributions(self, self.get_read_contributions(alt_iv_seq))
+                        return
+                signature = alignment_signature(alt_iv_seq)
+                contributions = self.assignment_cache.get(signature)
+                if contributions is None:
+                        contributions = self.get_read_contributions(alt_iv_seq)
+                        self.assignment_cache.put(signature, contributions)
+                add_contributions(self, contributions)
+
         @staticmethod                                        
         def combine_pair_iv_seq(alt_first_iv_seq, alt_second_iv_seq):
                 combine_alt_iv_seq = []
@@ -341,44 +399,140 @@ class IRI_quant(object):
                                 combine_alt_iv_seq.append(alt.copy())
                 return combine_alt_iv_seq              
         
+        def get_quant_state(self):
+                return {'counts': self.counts, 'bin_counts': self.bin_counts if self.bin_filter else {}, 'total_read_count': self.total_read_count}
+
+        def set_quant_state(self, state):
+                update_nested(self.counts, state['counts'])
+                if self.bin_filter:
+                        update_nested(self.bin_counts, state['bin_counts'])
+                self.total_read_count = state['total_read_count']
+
+        # With --saturation, --barcode-tag or --split-by the counters are split into buckets, which are all saved.
+        # With --umi-tag the fragments seen so far are saved too.
+        def get_checkpoint_state(self):
+                buckets = self.saturation or self.groups
+                state = buckets.get_state() if buckets else self.get_quant_state()
+                if self.dedup:
+                        state = dict(state, umi_dedup=self.dedup.get_state())
+                return state
+
+        def set_checkpoint_state(self, state):
+                buckets = self.saturation or self.groups
+                if buckets:
+                        buckets.set_state(state)
+                else:
+                        self.set_quant_state(state)
+                if self.dedup:
+                        self.dedup.set_state(state['umi_dedup'])
+
         def quant(self):
                 self.init_Counter_for_quant()
                 self.total_read_count = 0
+                self.saturation = None
+                if self.params.get('saturation'):
+                        self.saturation = Saturation_Counter(self, parse_saturation_depths(self.params['saturation']), self.params.get('subsample'))
+                self.groups = None
+                if self.params.get('barcode_tag'):
+                        if not self.params.get('barcode_groups'):
+                                raise Exception("--barcode-tag requires a barcode to group file (--barcode-groups)")
+                        if self.saturation:
+                                raise Exception("--saturation cannot be combined with --barcode-tag")
+                        self.groups = Group_Counter(self, self.params['barcode_tag'], load_barcode_groups(self.params['barcode_groups']))
+                if self.params.get('split_by'):
+                        if self.saturation or self.groups:
+                                raise Exception("--split-by cannot be combined with --saturation or --barcode-tag")
+                        libtypes = None
+                        if self.params.get('libtype_sheet'):
+                                libtypes = load_libtype_sheet(self.params['libtype_sheet'])
+                                # Strandedness of the annotation arrays is decided by --library-type
+                                for value, libtype in libtypes.items():
+                                        if self.is_stranded(libtype) != self.stranded:
+                                                raise Exception("Library type {} of {} in {} and --library-type {} must be all stranded or all unstranded.".format(libtype, value, self.params['libtype_sheet'], self.params['libtype']))
+                        self.groups = Group_Counter(self, self.params['split_by'], libtypes=libtypes)
                 
                 logging.info("Counting number of reads that map to each individual constitutive intronic region (CIR) and constitutive exonic region (CER)")
                   
-                # Input is bam file
-		bamfile = HTSeq.BAM_Reader(self.params['altfile'])
-		# Single end
-		if self.params['readtype'] == "single":
-			for alt in bamfile:
-				# Consider the alignments that are aligned and uniquely mapped.
-				if alt.aligned and self.unique_aligned(alt) and re.match('chr', alt.iv.chrom):
-					self.total_read_count += 1                                               
-					alt_iv_seq = self.get_alt_iv(alt)
-								
-					# Eligible alignments are those mapped into one gene's either constitutive exonic region (CER) or constitutive intronic region (CIR).
-					# For each eligible alignment, we count by fraction of length. i.e. If an alt has 50 bps, 30 bps in CER "001", 20 bps in CIR "001". Then, count in CER "001" is 0.6,
-					# and count in CIR "001" is 0.4. (IRI is considered in intron level, so count is distributed in intron level)                                                
-					if self.is_read_in_gene_region(alt_iv_seq) and self.is_read_in_CIR_or_CER(alt_iv_seq):    
-						self.assign_read_to_region(alt_iv_seq)                                   
-						if self.bin_filter:
-							self.assign_read_to_bin_filter(alt_iv_seq)
-							
-		elif self.params['readtype'] == "paired":
-			for alt_first, alt_second in HTSeq.pair_SAM_alignments(bamfile):
-				if alt_first == None or alt_second == None:
-					continue
-				if alt_first.aligned and self.unique_aligned(alt_first) and alt_second.aligned and self.unique_aligned(alt_second) and alt_first.iv.chrom == alt_second.iv.chrom and re.match('chr', alt_first.iv.chrom) and re.match('chr', alt_second.iv.chrom):
-					self.total_read_count += 1   
-					alt_first_iv_seq, alt_second_iv_seq = self.get_pair_alt_iv(alt_first, alt_second)
-					alt_iv_seq = self.combine_pair_iv_seq(alt_first_iv_seq, alt_second_iv_seq)
-					
-					if self.is_read_in_gene_region(alt_iv_seq) and self.is_read_in_CIR_or_CER(alt_iv_seq):    
-						self.assign_read_to_region(alt_iv_seq)                                   
-						if self.bin_filter:
-							self.assign_read_to_bin_filter(alt_iv_seq)    
-							
+                # Input is bam or cram file
+                bamfile = Alignment_Reader(self.params['altfile'], self.params.get('reference'), self.params.get('subsample'), self.params.get('regions'))
+                # Read pairs are bundled by read name, so only single-end reads can come in coordinate order
+                coordinate_sorted = self.params['readtype'] == "single" and bamfile.get_sort_order() == "coordinate"
+                self.dedup = None
+                if self.params.get('umi_tag'):
+                        # The copy of a fragment that is kept may be in a higher depth than its duplicates
+                        if self.saturation:
+                                raise Exception("--umi-tag cannot be combined with --saturation")
+                        self.dedup = UMI_Deduplicator(self.params['umi_tag'], self.params.get('barcode_tag') or self.params.get('split_by'), coordinate_sorted)
+                self.sweep = None
+                if coordinate_sorted and not self.params.get('no_sweep'):
+                        arrays = ["genes", "gene_region", "gene_map_score"] + (["bins"] if self.bin_filter else [])
+                        self.sweep = Annotation_Sweep(self, arrays)
+                self.assignment_cache = None
+                if self.params.get('assignment_cache', 0) > 0:
+                        self.assignment_cache = Assignment_Cache(self.params['assignment_cache'])
+                checkpoint = Quant_Checkpoint(self.params)
+                if self.params.get('resume'):
+                        saved_checkpoint = checkpoint.load()
+                        if saved_checkpoint is not None:
+                                self.set_checkpoint_state(saved_checkpoint['counters'])
+                                bamfile.set_resume_point(saved_checkpoint['record_no'], saved_checkpoint['offset'])
+                                
+                # Single end
+                if self.params['readtype'] == "single":
+                        for alt in bamfile:
+                                # Counters include every record before this one, so this is a safe point to resume from.
+                                if checkpoint.enabled and checkpoint.is_due(bamfile.record_no):
+                                        checkpoint.save(self.get_checkpoint_state(), bamfile.record_no, bamfile.record_offset)
+                                        
+                                if self.saturation:
+                                        self.saturation.select(alt.read.name)
+                                if self.groups and not self.groups.select(alt):
+                                        continue
+                                # Consider the alignments that are aligned and uniquely mapped.
+                                if alt.aligned and self.unique_aligned(alt) and re.match('chr', alt.iv.chrom):
+                                        if self.dedup and self.dedup.is_duplicate(alt):
+                                                continue
+                                        if self.sweep:
+                                                self.sweep.move_to(alt.iv.chrom, alt.iv.start)
+                                        self.total_read_count += 1                                               
+                                        if self.saturation:
+                                                self.saturation.add_read()
+                                        self.count_read(self.get_alt_iv(alt))
+                                                        
+                elif self.params['readtype'] == "paired":
+                        # Alignments are bundled by read name, so that a checkpoint never splits the alignments of one read pair.
+                        for bundle in bamfile.pair_bundles():
+                                for alt_first, alt_second in bundle:
+                                        if alt_first == None or alt_second == None:
+                                                continue
+                                        if self.saturation:
+                                                self.saturation.select(alt_first.read.name)
+                                        if self.groups and not self.groups.select(alt_first):
+                                                continue
+                                        if alt_first.aligned and self.unique_aligned(alt_first) and alt_second.aligned and self.unique_aligned(alt_second) and alt_first.iv.chrom == alt_second.iv.chrom and re.match('chr', alt_first.iv.chrom) and re.match('chr', alt_second.iv.chrom):
+                                                if self.dedup and self.dedup.is_duplicate_pair(alt_first, alt_second):
+                                                        continue
+                                                self.total_read_count += 1   
+                                                if self.saturation:
+                                                        self.saturation.add_read()
+                                                alt_first_iv_seq, alt_second_iv_seq = self.get_pair_alt_iv(alt_first, alt_second)
+                                                self.count_read(self.combine_pair_iv_seq(alt_first_iv_seq, alt_second_iv_seq))
+                                                                
+                                # The record just read by the pairing belongs to the next read name and is not counted yet.
+                                if checkpoint.enabled and not bamfile.exhausted and checkpoint.is_due(bamfile.record_no):
+                                        checkpoint.save(self.get_checkpoint_state(), bamfile.record_no, bamfile.record_offset)
+                                        
+                checkpoint.remove()
+                if self.sweep:
+                        self.sweep.close()
+                if self.dedup:
+                        self.dedup.log_summary()
+                self.counting_metrics = {}
+                if self.assignment_cache:
+                        logging.info("Assignment cache: {} hits in {} reads ({:.2f}%)".format(self.assignment_cache.hits, self.assignment_cache.hits + self.assignment_cache.misses, self.assignment_cache.hit_rate() * 100))
+                        self.counting_metrics = self.assignment_cache.get_metrics()
+                self.records_processed = bamfile.record_no - bamfile.resume_record_no
+                                                                
         @staticmethod
         def CIRs_in_consitutive_junction_graph(graph):
                 return sorted([node for node in graph.nodes() if re.match('constitutive_intronic_region', node)])        
@@ -489,12 +643,14 @@ class IRI_quant(object):
                 self.IRI_intron_level_df = pd.DataFrame(IRI_intron_level_data, columns=["CIR_id", "CIR_iv", "CIR_length", "adjacent_CER_length", "CIR_read_count", "adjacent_CER_read_count", "CIR_RPKM", "adjacent_CER_RPKM", "intron_IRI"])                
                 
                 if self.bin_filter:
+                        metrics.start_stage("filtering")
                         self.IRI_intron_level_df = self.apply_bin_filter(self.IRI_intron_level_df)
+                        metrics.end_stage()
                 
-                outfile = self.params['name'] + ".quant.IRI.introns.txt" 
-                outfile_fullpath = os.path.join(self.params['outdir'], outfile)
+                outfile_prefix = os.path.join(self.params['outdir'], self.params['name'] + ".quant.IRI.introns")
+                outfile_fullpath = get_table_path(outfile_prefix, self.params.get('output_format') or "tsv")
                 logging.info("Writing intron level result to file: {}".format(outfile_fullpath))
-                self.IRI_intron_level_df.to_csv(outfile_fullpath, index=None, sep='\t', na_rep="NA")
+                write_table(self.IRI_intron_level_df, outfile_prefix, self.params.get('output_format') or "tsv")
                 
         def filter_CIR_id(self, filtered_CIR_id_list):
                 for CIR_id in filtered_CIR_id_list:
@@ -555,10 +711,10 @@ class IRI_quant(object):
                         
                 self.IRI_gene_level_df = pd.DataFrame(IRI_gene_level_data, columns=["gene_id", "gene_iv", "gene_CIR_length", "gene_CER_length", "gene_CIR_read_count", "gene_CER_read_count", "gene_CIR_RPKM", "gene_CER_RPKM", "gene_IRI"])   
                 
-                outfile = self.params['name'] + ".quant.IRI.genes.txt"
-                outfile_fullpath = os.path.join(self.params['outdir'], outfile)
-                logging.info("Writing gene level result to file: {}".format(outfile_fullpath))              
-                self.IRI_gene_level_df.to_csv(outfile_fullpath, index=None, sep='\t', na_rep="NA")  
+                outfile_prefix = os.path.join(self.params['outdir'], self.params['name'] + ".quant.IRI.genes")
+                outfile_fullpath = get_table_path(outfile_prefix, self.params.get('output_format') or "tsv")
+                logging.info("Writing gene level result to file: {}".format(outfile_fullpath))
+                write_table(self.IRI_gene_level_df, outfile_prefix, self.params.get('output_format') or "tsv")
                 
         def output_IRI_genome_wide(self):
                 total_CIR_effective_length = reduce(lambda x,y: x + sum(y.values()), list(self.CIR_effective_length.values()), 0) 
@@ -573,6 +729,9 @@ class IRI_quant(object):
                 print(("\tTotal CER read count: %f (%.2f%%)" % (total_CER_read_count, total_CER_read_count * 100.0 / self.total_read_count)))
                 print(("\tTotal CIR read count: %f (%.2f%%)" % (total_CIR_read_count, total_CIR_read_count * 100.0 / self.total_read_count)))
                 print(("\tTotal read count: %i" % self.total_read_count))
+                if self.params.get('subsample'):
+                        # Region counts and the total read count come from the same reads, so RPKMs and IRIs estimate the full library values.
+                        print(("\tSubsampling fraction: %g (estimated total read count of the full library: %i)" % (self.params['subsample'], self.total_read_count / self.params['subsample'])))
                 print(("\tGenome-wide intron retention index: %f" % IRI_genome_wide))                
                 
                 
@@ -0,0 +1,78 @@
+import copy
+
+# Several sets of quant counters filled in one pass over the alignments (saturation depths, cell barcode groups, ...).
+# Bucket 0 counts into the quanter's own counters, the others into zeroed copies of them. Before a read is assigned,
+# the quanter's counter attributes (the keys of get_quant_state()) are switched to the bucket the read belongs to,
+# so the assignment code itself does not change.
+
+def add_nested(counter, other):
+        for key, value in other.items():
+                if isinstance(value, dict):
+                        add_nested(counter[key], value)
+                else:
+                        counter[key] += value
+
+class Counter_Buckets(object):
+        def __init__(self, quanter, num_buckets):
+                self.quanter = quanter
+                state = quanter.get_quant_state()
+                self.buckets = [state] + [copy.deepcopy(state) for i in range(num_buckets - 1)]
+                self.read_counts = [0] * num_buckets
+                self.current = 0
+
+        # A new zeroed bucket, copied from template (a zeroed copy of the counters taken before counting started).
+        def add_bucket(self, template):
+                self.buckets.append(copy.deepcopy(template))
+                self.read_counts.append(0)
+                return len(self.buckets) - 1
+
+        def store(self):
+                self.buckets[self.current] = dict((key, getattr(self.quanter, key)) for key in self.buckets[self.current])
+
+        def load(self, bucket):
+                for key, value in self.buckets[bucket].items():
+                        setattr(self.quanter, key, value)
+                self.current = bucket
+
+        def switch_bucket(self, bucket):
+                if bucket != self.current:
+                        self.store()
+                        self.load(bucket)
+
+        def select_bucket(self, bucket):
+                self.read_counts[bucket] += 1
+                self.switch_bucket(bucket)
+
+        def get_state(self):
+                self.store()
+                buckets = {}
+                for bucket in range(len(self.buckets)):
+                        self.load(bucket)
+                        buckets[str(bucket)] = self.quanter.get_quant_state()
+                self.load(0)
+                return {'buckets': buckets, 'read_counts': list(self.read_counts)}
+
+        def set_state(self, state):
+                for bucket in range(len(self.buckets)):
+                        self.load(bucket)
+                        self.quanter.set_quant_state(state['buckets'][str(bucket)])
+                        self.store()
+                self.read_counts = list(state['read_counts'])
+                self.load(0)
+
+        # Write the outputs of a set of counters under another sample name. output_functions may modify the counters
+        # and the attributes listed in restore_attributes (e.g. filtered CIRs are deleted), so both are restored afterwards.
+        def output_counters(self, state, name, output_functions, restore_attributes):
+                saved_name = self.quanter.params['name']
+                saved_attributes = dict((key, copy.deepcopy(getattr(self.quanter, key))) for key in restore_attributes)
+                saved_counters = dict((key, getattr(self.quanter, key)) for key in state)
+                for key, value in state.items():
+                        setattr(self.quanter, key, copy.deepcopy(value))
+                self.quanter.params['name'] = name
+                try:
+                        for output_function in output_functions:
+                                output_function()
+                finally:
+                        self.quanter.params['name'] = saved_name
+                        for key, value in list(saved_attributes.items()) + list(saved_counters.items()):
+                                setattr(self.quanter, key, value)
@@ -0,0 +1,82 @@
+import os
+import time
+import pickle
+import logging
+
+CHECKPOINT_VERSION = 1
+
+# Counters in quant are nested defaultdicts of Counters built from lambdas, which cannot be pickled.
+# They are saved as plain nested dicts and written back into the live structures on resume.
+def to_plain_dict(counter):
+        if isinstance(counter, dict):
+                return {key: to_plain_dict(value) for key, value in counter.items()}
+        return counter
+
+def update_nested(counter, saved):
+        for key, value in saved.items():
+                if isinstance(value, dict):
+                        update_nested(counter[key], value)
+                else:
+                        counter[key] = value
+
+class Quant_Checkpoint(object):
+        def __init__(self, params):
+                self.params = params
+                self.path = os.path.join(params['outdir'], params['name'] + ".quant." + params['quanttype'] + ".checkpoint")
+                self.every_reads = params.get('checkpoint_reads') or 0
+                self.every_seconds = (params.get('checkpoint_minutes') or 0) * 60.0
+                self.enabled = self.every_reads > 0 or self.every_seconds > 0
+                if self.enabled and params.get('regions'):
+                        raise Exception("--regions cannot be combined with --checkpoint-reads or --checkpoint-minutes")
+                self.last_record_no = 0
+                self.last_time = time.time()
+
+        # Everything that changes the counts. A checkpoint taken under a different configuration must not be resumed.
+        def get_fingerprint(self):
+                altfile_stat = os.stat(self.params['altfile'])
+                keys = ['altfile', 'reference', 'quanttype', 'readtype', 'libtype', 'mapfile', 'species', 'annofile', 'minoverlap', 'subsample', 'saturation', 'barcode_tag', 'barcode_groups', 'split_by', 'libtype_sheet', 'umi_tag']
+                fingerprint = dict((key, self.params.get(key)) for key in keys)
+                fingerprint['altfile_size'] = altfile_stat.st_size
+                fingerprint['altfile_mtime'] = altfile_stat.st_mtime
+                return fingerprint
+
+        def load(self):
+                if not os.path.exists(self.path):
+                        logging.info("No checkpoint found at {}, starting from the beginning".format(self.path))
+                        return None
+                with open(self.path, "rb") as f:
+                        checkpoint = pickle.load(f)
+                if checkpoint.get('version') != CHECKPOINT_VERSION or checkpoint['fingerprint'] != self.get_fingerprint():
+                        raise Exception("Checkpoint {} was written for a different input file or different parameters. Remove it or rerun without --resume.".format(self.path))
+                self.last_record_no = checkpoint['record_no']
+                logging.info("Loaded checkpoint {} ({} records already processed)".format(self.path, checkpoint['record_no']))
+                return checkpoint
+
+        def is_due(self, record_no):
+                if self.every_reads > 0 and record_no - self.last_record_no >= self.every_reads:
+                        return True
+                if self.every_seconds > 0 and time.time() - self.last_time >= self.every_seconds:
+                        return True
+                return False
+
+        # record_no/offset point at the first record whose reads are not yet included in counters.
+        def save(self, counters, record_no, offset):
+                checkpoint = {'version': CHECKPOINT_VERSION,
+                              'fingerprint': self.get_fingerprint(),
+                              'record_no': record_no,
+                              'offset': offset,
+                              'counters': to_plain_dict(counters)}
+                # Write next to the final path and rename, so a preempted run never leaves a truncated checkpoint behind.
+                temp_path = self.path + ".tmp"
+                with open(temp_path, "wb") as f:
+                        pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+                self.last_record_no = record_no
+                self.last_time = time.time()
+                logging.info("Checkpoint written to {} at record #{}".format(self.path, record_no))
+
+        def remove(self):
+                if os.path.exists(self.path):
+                        os.remove(self.path)
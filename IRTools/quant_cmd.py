@@ -1,33 +1,78 @@
 import sys
 import logging
+from IRTools import metrics
+from IRTools.result_cache import open_quant_cache, run_with_cache
+from IRTools.table_io import check_output_format
+from IRTools.cohort_store import append_quant_results
 
-def run(args):
+# Loading the annotation is separated from counting, so that "IRTools serve" can load it once for many runs.
+def load_quanter(args):
         if args.quanttype == 'IRI':
                 from IRTools.quant_IRI import IRI_quant
-                IRI_quanter = IRI_quant(args)
+                return IRI_quant(args)
+        elif args.quanttype == 'IRC':
+                from IRTools.quant_IRC import IRC_quant
+                return IRC_quant(args)
+
+def count_and_write(quanter, args):
+        if args.quanttype == 'IRI':
+                IRI_quanter = quanter
+                metrics.start_stage("bam_counting")
                 IRI_quanter.quant()
+                metrics.end_stage(reads_processed=IRI_quanter.records_processed, **IRI_quanter.counting_metrics)
+                metrics.start_stage("output_writing")
+                if IRI_quanter.groups:
+                        if args.group_output == "matrix":
+                                IRI_quanter.groups.output_matrix("IRI", ["counts"])
+                        else:
+                                IRI_quanter.groups.output_groups([IRI_quanter.output_IRI_intron_level, IRI_quanter.output_IRI_gene_level, IRI_quanter.output_IRI_genome_wide],
+                                                                 ["CIR_effective_length"])
+                        metrics.end_stage()
+                        return
+                if IRI_quanter.saturation:
+                        IRI_quanter.saturation.output_depths([IRI_quanter.output_IRI_intron_level, IRI_quanter.output_IRI_gene_level],
+                                                             ["CIR_effective_length"],
+                                                             [("intron", "IRI_intron_level_df", "CIR_id", "intron_IRI"), ("gene", "IRI_gene_level_df", "gene_id", "gene_IRI")])
                 IRI_quanter.output_IRI_intron_level()
                 IRI_quanter.output_IRI_gene_level()
                 IRI_quanter.output_IRI_genome_wide()
+                if IRI_quanter.saturation:
+                        IRI_quanter.saturation.output_summary("IRI")
+                metrics.end_stage()
 
         elif args.quanttype == 'IRC':
-                from IRTools.quant_IRC import IRC_quant
-                IRC_quanter = IRC_quant(args)
+                IRC_quanter = quanter
+                metrics.start_stage("bam_counting")
                 IRC_quanter.quant()
+                metrics.end_stage(reads_processed=IRC_quanter.records_processed, **IRC_quanter.counting_metrics)
+                metrics.start_stage("output_writing")
+                if IRC_quanter.groups:
+                        if args.group_output == "matrix":
+                                IRC_quanter.groups.output_matrix("IRC", ["CIR_counts", "CJ_counts"])
+                        else:
+                                IRC_quanter.groups.output_groups([IRC_quanter.output_IRC_junction_level, IRC_quanter.output_IRC_intron_level, IRC_quanter.output_IRC_gene_level, IRC_quanter.output_IRC_genome_wide],
+                                                                 [])
+                        metrics.end_stage()
+                        return
+                if IRC_quanter.saturation:
+                        IRC_quanter.saturation.output_depths([IRC_quanter.output_IRC_junction_level, IRC_quanter.output_IRC_intron_level, IRC_quanter.output_IRC_gene_level],
+                                                             [],
+                                                             [("intron", "IRC_intron_level_df", "CIR_id", "intron_IRC"), ("gene", "IRC_gene_level_df", "gene_id", "gene_IRC")])
                 IRC_quanter.output_IRC_junction_level()
                 IRC_quanter.output_IRC_intron_level()
                 IRC_quanter.output_IRC_gene_level()
                 IRC_quanter.output_IRC_genome_wide()
-                
-                
-
-
-
-
-
-
-
-
-
-
+                if IRC_quanter.saturation:
+                        IRC_quanter.saturation.output_summary("IRC")
+                metrics.end_stage()
 
+# quanter: a loaded annotation to count with (IRTools serve). By default it is loaded here.
+def run(args, quanter=None):
+        check_output_format(args.__dict__.get('output_format'))
+        if args.__dict__.get('cohort_store') and (args.__dict__.get('barcode_tag') or args.__dict__.get('split_by')):
+                raise Exception("--cohort-store cannot be used with --barcode-tag or --split-by. Please quantify the groups into the cohort store one by one.")
+        run_with_cache(open_quant_cache(args.__dict__), args.no_cache, lambda: count_and_write(quanter or load_quanter(args), args))
+        if args.__dict__.get('cohort_store'):
+                metrics.start_stage("cohort_store")
+                append_quant_results(args.__dict__)
+                metrics.end_stage()
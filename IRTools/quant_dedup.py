@@ -0,0 +1,114 @@
+import heapq
+import hashlib
+import logging
+
+# On the fly removal of PCR duplicates by UMI: reads (or read pairs) with the same UMI, chromosome, strand and 5' position
+# (and, with --barcode-tag or --split-by, the same group tag value) are counted once, the first one seen is kept.
+# Every fragment is stored as a 64-bit hash of its key only.
+#  - Coordinate-sorted single-end input: fragments are kept in a rolling window of positions. Alignments start at or after
+#    the start of the current one, and the 5' position of a read is never before its start, so positions before the
+#    current start can never be seen again and are dropped. Memory is bounded by the reads overlapping the current position.
+#  - Other input (e.g. name-sorted read pairs): one hash set of all fragments.
+
+def fragment_hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+
+def five_prime_position(alt):
+        return alt.iv.start if alt.iv.strand == "+" else alt.iv.end
+
+class UMI_Deduplicator(object):
+        def __init__(self, umi_tag, group_tag=None, rolling_window=False):
+                self.umi_tag = umi_tag
+                self.group_tag = group_tag
+                self.rolling_window = rolling_window
+                self.chrom = None
+                self.start = -1
+                self.window = {}
+                self.positions = []
+                self.fragments = set()
+                self.unique_reads = 0
+                self.duplicate_reads = 0
+                self.no_umi_reads = 0
+                if rolling_window:
+                        logging.info("Removing UMI (tag {}) duplicates of coordinate-sorted reads in a rolling window of positions".format(umi_tag))
+                else:
+                        logging.info("Removing UMI (tag {}) duplicates. Input is not coordinate-sorted single-end reads, so all fragments are kept in memory".format(umi_tag))
+
+        def get_umi(self, alt):
+                try:
+                        umi = str(alt.optional_field(self.umi_tag))
+                        if self.group_tag:
+                                umi += "\t" + str(alt.optional_field(self.group_tag))
+                except KeyError:
+                        return None
+                return umi
+
+        def move_to(self, chrom, start):
+                if chrom != self.chrom:
+                        self.chrom = chrom
+                        self.window.clear()
+                        self.positions = []
+                elif start < self.start:
+                        raise Exception("Alignments are not sorted by coordinate: {}:{} comes after {}:{}. Sort them with samtools sort.".format(chrom, start + 1, chrom, self.start + 1))
+                self.start = start
+                while self.positions and self.positions[0] < start:
+                        del self.window[heapq.heappop(self.positions)]
+
+        def is_duplicate_fragment(self, chrom, position, fragment_key):
+                if self.rolling_window:
+                        fragments = self.window.get(position)
+                        if fragments is None:
+                                fragments = self.window[position] = set()
+                                heapq.heappush(self.positions, position)
+                        fragment = fragment_hash(fragment_key)
+                else:
+                        fragments = self.fragments
+                        fragment = fragment_hash("{}\t{}\t{}".format(chrom, position, fragment_key))
+                if fragment in fragments:
+                        self.duplicate_reads += 1
+                        return True
+                fragments.add(fragment)
+                self.unique_reads += 1
+                return False
+
+        # Reads without the UMI tag are always counted.
+        def is_duplicate(self, alt):
+                if self.rolling_window:
+                        self.move_to(alt.iv.chrom, alt.iv.start)
+                umi = self.get_umi(alt)
+                if umi is None:
+                        self.no_umi_reads += 1
+                        return False
+                return self.is_duplicate_fragment(alt.iv.chrom, five_prime_position(alt), "{}\t{}".format(alt.iv.strand, umi))
+
+        # Read pairs also need the 5' position of the second mate.
+        def is_duplicate_pair(self, alt_first, alt_second):
+                umi = self.get_umi(alt_first)
+                if umi is None:
+                        self.no_umi_reads += 1
+                        return False
+                return self.is_duplicate_fragment(alt_first.iv.chrom, five_prime_position(alt_first),
+                                                  "{}\t{}\t{}\t{}".format(alt_first.iv.strand, five_prime_position(alt_second), alt_second.iv.strand, umi))
+
+        def get_state(self):
+                return {'chrom': self.chrom, 'start': self.start, 'window': self.window, 'fragments': self.fragments,
+                        'unique_reads': self.unique_reads, 'duplicate_reads': self.duplicate_reads, 'no_umi_reads': self.no_umi_reads}
+
+        def set_state(self, state):
+                self.chrom = state['chrom']
+                self.start = state['start']
+                self.window = state['window']
+                self.positions = list(self.window.keys())
+                heapq.heapify(self.positions)
+                self.fragments = state['fragments']
+                self.unique_reads = state['unique_reads']
+                self.duplicate_reads = state['duplicate_reads']
+                self.no_umi_reads = state['no_umi_reads']
+
+        def log_summary(self):
+                total = self.unique_reads + self.duplicate_reads
+                logging.info("UMI deduplication:")
+                print(("\tUnique fragments: %i" % self.unique_reads))
+                print(("\tDuplicates removed: %i (%.2f%%)" % (self.duplicate_reads, self.duplicate_reads * 100.0 / total if total else 0)))
+                if self.no_umi_reads:
+                        print(("\tReads without %s tag (counted, not deduplicated): %i" % (self.umi_tag, self.no_umi_reads)))
@@ -0,0 +1,165 @@
+import os
+import copy
+import logging
+import scipy.io
+import scipy.sparse
+from IRTools.quant_buckets import Counter_Buckets
+
+# Counting reads separately by the value of an alignment tag, in a single pass over the alignments:
+#  - pseudo-bulk quantification of single-cell libraries: cell barcodes (e.g. tag CB) are mapped to groups of cells
+#    (e.g. clusters) by a barcode to group file;
+#  - demultiplexing of merged libraries: every value of the tag (e.g. RG) is its own group, optionally with its own library type.
+
+def load_two_column_file(filename, description):
+        # Two columns separated by tabs, commas or spaces. Lines starting with "#" are ignored.
+        mapping = {}
+        with open(filename) as f:
+                for line_number, line in enumerate(f, 1):
+                        line = line.strip()
+                        if not line or line.startswith("#"):
+                                continue
+                        fields = line.replace(",", "\t").split()
+                        if len(fields) < 2:
+                                raise Exception("Line {} of {} file {} does not have two columns: {}".format(line_number, description, filename, line))
+                        mapping[fields[0]] = fields[1]
+        if not mapping:
+                raise Exception("No entries found in {} file {}".format(description, filename))
+        return mapping
+
+def load_barcode_groups(filename):
+        return load_two_column_file(filename, "barcode group")
+
+def load_libtype_sheet(filename):
+        libtypes = load_two_column_file(filename, "library type")
+        for value, libtype in libtypes.items():
+                if libtype not in ("fr-unstranded", "fr-firststrand", "fr-secondstrand"):
+                        raise Exception("Unknown library type \"{}\" for {} in {}. Use fr-unstranded, fr-firststrand or fr-secondstrand.".format(libtype, value, filename))
+        return libtypes
+
+class Group_Counter(Counter_Buckets):
+        # Without barcode_groups, every value of the tag becomes a group the first time it is seen.
+        # libtypes optionally maps groups to library types, other groups use the library type of the run.
+        def __init__(self, quanter, tag, barcode_groups=None, libtypes=None):
+                Counter_Buckets.__init__(self, quanter, 1)
+                self.tag = tag
+                self.fixed_groups = barcode_groups is not None
+                self.libtypes = libtypes or {}
+                self.default_libtype = quanter.libtype
+                self.unassigned_reads = 0
+                if self.fixed_groups:
+                        self.groups = sorted(set(barcode_groups.values()))
+                        self.buckets += [copy.deepcopy(self.buckets[0]) for group in self.groups[1:]]
+                        self.read_counts = [0] * len(self.groups)
+                        group_index = dict((group, i) for i, group in enumerate(self.groups))
+                        self.barcode_index = dict((barcode, group_index[group]) for barcode, group in barcode_groups.items())
+                        logging.info("Counting reads separately for {} groups of {} barcodes (tag {})".format(len(self.groups), len(self.barcode_index), tag))
+                else:
+                        self.groups = []
+                        self.barcode_index = {}
+                        self.template = copy.deepcopy(self.buckets[0])
+                        logging.info("Counting reads separately for each value of tag {}".format(tag))
+                self.bucket_libtypes = [self.libtypes.get(group, self.default_libtype) for group in self.groups]
+
+        def add_group(self, group):
+                bucket = 0 if not self.groups else self.add_bucket(self.template)
+                self.groups.append(group)
+                self.bucket_libtypes.append(self.libtypes.get(group, self.default_libtype))
+                self.barcode_index[group] = bucket
+                if bucket == self.current:
+                        self.quanter.libtype = self.bucket_libtypes[bucket]
+                return bucket
+
+        def load(self, bucket):
+                Counter_Buckets.load(self, bucket)
+                if bucket < len(self.bucket_libtypes):
+                        self.quanter.libtype = self.bucket_libtypes[bucket]
+
+        # Returns False for reads that are not counted: without the tag, or with a barcode in none of the groups.
+        def select(self, alt):
+                try:
+                        value = alt.optional_field(self.tag)
+                except KeyError:
+                        self.unassigned_reads += 1
+                        return False
+                bucket = self.barcode_index.get(value)
+                if bucket is None:
+                        if self.fixed_groups:
+                                self.unassigned_reads += 1
+                                return False
+                        bucket = self.add_group(str(value).replace(os.sep, "_"))
+                        # numeric tag values are looked up as they are read
+                        self.barcode_index[value] = bucket
+                self.select_bucket(bucket)
+                return True
+
+        def get_state(self):
+                state = Counter_Buckets.get_state(self)
+                state['unassigned_reads'] = self.unassigned_reads
+                state['groups'] = list(self.groups)
+                return state
+
+        def set_state(self, state):
+                if not self.fixed_groups:
+                        for group in state['groups']:
+                                self.add_group(group)
+                Counter_Buckets.set_state(self, state)
+                self.unassigned_reads = state['unassigned_reads']
+
+        def log_summary(self):
+                logging.info("Reads per group:")
+                for group, read_count in zip(self.groups, self.read_counts):
+                        print(("\t%s: %i" % (group, read_count)))
+                print(("\tNo {} tag{}: %i".format(self.tag, " or not in any group" if self.fixed_groups else "") % self.unassigned_reads))
+
+        # One set of regular output files per group, named NAME.GROUP.quant.*
+        def output_groups(self, output_functions, restore_attributes):
+                self.store()
+                self.log_summary()
+                name = self.quanter.params['name']
+                for bucket, group in enumerate(self.groups):
+                        if self.read_counts[bucket] == 0:
+                                logging.info("No reads in group {}, no output files are written for it".format(group))
+                                continue
+                        logging.info("Writing results of group {}".format(group))
+                        self.output_counters(self.buckets[bucket], name + "." + group, output_functions, restore_attributes)
+                self.load(0)
+
+        @staticmethod
+        def flatten_counter(counter, path, rows):
+                for key in sorted(counter.keys()):
+                        value = counter[key]
+                        if isinstance(value, dict):
+                                Group_Counter.flatten_counter(value, path + [str(key)], rows)
+                        else:
+                                rows[tuple(path + [str(key)])] = value
+
+        # Raw counts of every region (rows) in every group (columns) as a Matrix Market sparse matrix, with the row and
+        # column names in NAME.quant.{IRI,IRC}.features.tsv and NAME.quant.{IRI,IRC}.groups.tsv.
+        def output_matrix(self, quanttype, counter_names):
+                self.store()
+                self.log_summary()
+                group_rows = []
+                for bucket in range(len(self.groups)):
+                        rows = {}
+                        for counter_name in counter_names:
+                                self.flatten_counter(self.buckets[bucket][counter_name], [counter_name], rows)
+                        group_rows.append(rows)
+                features = sorted(set().union(*[rows.keys() for rows in group_rows]))
+                feature_index = dict((feature, i) for i, feature in enumerate(features))
+
+                matrix = scipy.sparse.dok_matrix((len(features), len(self.groups)), dtype=float)
+                for bucket, rows in enumerate(group_rows):
+                        for feature, value in rows.items():
+                                if value:
+                                        matrix[feature_index[feature], bucket] = value
+
+                prefix = os.path.join(self.quanter.params['outdir'], self.quanter.params['name'] + ".quant." + quanttype)
+                logging.info("Writing region x group count matrix to file: {}.matrix.mtx".format(prefix))
+                scipy.io.mmwrite(prefix + ".matrix.mtx", matrix.tocoo(), comment="rows: {0}.features.tsv, columns: {0}.groups.tsv".format(os.path.basename(prefix)))
+                with open(prefix + ".features.tsv", "w") as f:
+                        for feature in features:
+                                f.write("\t".join(feature) + "\n")
+                with open(prefix + ".groups.tsv", "w") as f:
+                        for group, read_count in zip(self.groups, self.read_counts):
+                                f.write("{}\t{}\n".format(group, read_count))
+                self.load(0)
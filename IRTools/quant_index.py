@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import numpy as np
+import HTSeq
+from IRTools.quant_sweep import Sweep_Array
+
+# Annotation index: the GenomicArray(OfSets) used to assign reads (and the mappability scores) compiled into flat NumPy
+# arrays in a directory. Every run with the same annotation, mappability and strandedness maps the files read-only instead
+# of building the arrays again, so quant processes running at the same time on one machine share a single copy of them
+# in the page cache.
+#
+# For each array NAME:
+#   NAME.starts.npy, NAME.ends.npy    steps of all chromosomes and strands one after the other (see index.json)
+#   NAME.values.npy                   value of each step: the score, or for arrays of sets the number of the set
+#   NAME.set_offsets.npy, NAME.set_items.npy, NAME.item_offsets.npy, NAME.items.npy
+#                                     for arrays of sets: the items of set i are set_items[set_offsets[i]:set_offsets[i + 1]],
+#                                     item j is the JSON text items[item_offsets[j]:item_offsets[j + 1]]
+
+INDEX_VERSION = 1
+
+def file_signature(filename):
+        stat = os.stat(filename)
+        return [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+
+# The index depends on the annotation, the mappability file, the strandedness and the quantification type.
+def annotation_index_key(params, quanttype, stranded):
+        mapfile = params.get('mapfile')
+        key = {'version': INDEX_VERSION,
+               'quanttype': quanttype,
+               'stranded': stranded,
+               'species': params.get('species'),
+               'annofile': file_signature(params['annofile']) if params.get('annofile') else None,
+               'mapfile': file_signature(mapfile) if mapfile and os.path.exists(mapfile) else mapfile}
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+def annotation_index_dir(params, quanttype, stranded):
+        return os.path.join(params['annotation_index'], "{}.{}".format(quanttype, annotation_index_key(params, quanttype, stranded)))
+
+def decode_item(text):
+        item = json.loads(text)
+        return tuple(item) if isinstance(item, list) else item
+
+def write_annotation_index(directory, arrays, stranded):
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        # Written next to its final place and renamed, so that runs started at the same time never see half an index.
+        tmpdir = tempfile.mkdtemp(prefix=".tmp.", dir=parent)
+        vectors = []
+        for name, array in arrays.items():
+                starts, ends, values = [], [], []
+                is_set_array = isinstance(array, HTSeq.GenomicArrayOfSets)
+                set_numbers, sets = {}, []
+                item_numbers, items = {}, []
+                for chrom in sorted(array.chrom_vectors):
+                        for strand in sorted(array.chrom_vectors[chrom]):
+                                offset = len(starts)
+                                for iv, value in array.chrom_vectors[chrom][strand].steps():
+                                        starts.append(iv.start)
+                                        ends.append(iv.end)
+                                        if is_set_array:
+                                                # steps share their set objects, so sets are numbered by identity
+                                                if id(value) not in set_numbers:
+                                                        set_numbers[id(value)] = len(sets)
+                                                        sets.append([item_numbers.setdefault(item, len(item_numbers)) for item in value])
+                                                values.append(set_numbers[id(value)])
+                                        else:
+                                                values.append(value)
+                                vectors.append({'array': name, 'chrom': chrom, 'strand': strand, 'offset': offset, 'length': len(starts) - offset})
+                np.save(os.path.join(tmpdir, name + ".starts.npy"), np.array(starts, dtype=np.int64))
+                np.save(os.path.join(tmpdir, name + ".ends.npy"), np.array(ends, dtype=np.int64))
+                np.save(os.path.join(tmpdir, name + ".values.npy"), np.array(values, dtype=np.int64))
+                if is_set_array:
+                        items = [None] * len(item_numbers)
+                        for item, number in item_numbers.items():
+                                items[number] = json.dumps(item).encode()
+                        np.save(os.path.join(tmpdir, name + ".set_offsets.npy"), np.cumsum([0] + [len(items_of_set) for items_of_set in sets], dtype=np.int64))
+                        np.save(os.path.join(tmpdir, name + ".set_items.npy"), np.array([number for items_of_set in sets for number in items_of_set], dtype=np.int64))
+                        np.save(os.path.join(tmpdir, name + ".item_offsets.npy"), np.cumsum([0] + [len(item) for item in items], dtype=np.int64))
+                        np.save(os.path.join(tmpdir, name + ".items.npy"), np.frombuffer(b"".join(items), dtype=np.uint8))
+        with open(os.path.join(tmpdir, "index.json"), "w") as f:
+                json.dump({'version': INDEX_VERSION, 'stranded': stranded,
+                           'arrays': dict((name, 'sets' if isinstance(array, HTSeq.GenomicArrayOfSets) else 'scores') for name, array in arrays.items()),
+                           'vectors': vectors}, f)
+        try:
+                os.rename(tmpdir, directory)
+                logging.info("Annotation index written to directory: {}".format(directory))
+        except OSError:
+                # another run has written it meanwhile
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+# Sets of an array of sets are decoded the first time they are used. The same set object is returned for the same
+# set number, like the steps of a GenomicArrayOfSets share their set objects.
+class Set_Decoder(object):
+        def __init__(self, set_offsets, set_items, item_offsets, items):
+                self.set_offsets = set_offsets
+                self.set_items = set_items
+                self.item_offsets = item_offsets
+                self.items = items
+                self.sets = {}
+                self.decoded_items = {}
+
+        def get_item(self, number):
+                item = self.decoded_items.get(number)
+                if item is None:
+                        item = self.decoded_items[number] = decode_item(self.items[self.item_offsets[number]:self.item_offsets[number + 1]].tobytes().decode())
+                return item
+
+        def get_set(self, number):
+                value = self.sets.get(number)
+                if value is None:
+                        value = self.sets[number] = set(self.get_item(int(item)) for item in self.set_items[self.set_offsets[number]:self.set_offsets[number + 1]])
+                return value
+
+# The values of the steps of one chromosome and strand of an array of sets.
+class Index_Sets(object):
+        def __init__(self, set_numbers, decoder):
+                self.set_numbers = set_numbers
+                self.decoder = decoder
+
+        def __len__(self):
+                return len(self.set_numbers)
+
+        def __getitem__(self, i):
+                return self.decoder.get_set(self.set_numbers[i])
+
+class Index_Array(object):
+        def __init__(self, index, name, kind):
+                self.index = index
+                self.name = name
+                self.stranded = index.stranded
+                self.starts = index.load(name + ".starts.npy")
+                self.ends = index.load(name + ".ends.npy")
+                self.values = index.load(name + ".values.npy")
+                self.decoder = None
+                if kind == 'sets':
+                        self.decoder = Set_Decoder(index.load(name + ".set_offsets.npy"), index.load(name + ".set_items.npy"),
+                                                   index.load(name + ".item_offsets.npy"), index.load(name + ".items.npy"))
+
+        # Steps of one chromosome and strand as read-only views. A chromosome without annotation is one empty step,
+        # like in an "auto" GenomicArray. Items of memoryviews are plain ints, which the sweep compares much faster
+        # than NumPy scalars.
+        def get_steps(self, chrom, strand):
+                vector = self.index.vectors.get((self.name, chrom, strand))
+                if vector is None:
+                        return [0], [sys.maxsize], [set() if self.decoder else 0]
+                begin, end = vector['offset'], vector['offset'] + vector['length']
+                values = memoryview(self.values[begin:end])
+                if self.decoder:
+                        values = Index_Sets(values, self.decoder)
+                return memoryview(self.starts[begin:end]), memoryview(self.ends[begin:end]), values
+
+class Annotation_Index(object):
+        def __init__(self, directory):
+                self.directory = directory
+                with open(os.path.join(directory, "index.json")) as f:
+                        index = json.load(f)
+                if index['version'] != INDEX_VERSION:
+                        raise Exception("Annotation index {} was written by another version of IRTools. Please remove it.".format(directory))
+                self.stranded = index['stranded']
+                self.kinds = index['arrays']
+                self.vectors = dict(((vector['array'], vector['chrom'], vector['strand']), vector) for vector in index['vectors'])
+
+        def load(self, filename):
+                try:
+                        return np.load(os.path.join(self.directory, filename), mmap_mode="r")
+                except ValueError:
+                        # empty arrays cannot be mapped
+                        return np.load(os.path.join(self.directory, filename))
+
+        # A Sweep_Array, which the read assignment code uses like the GenomicArray(OfSets) it was compiled from.
+        def get_array(self, name):
+                return Sweep_Array(Index_Array(self, name, self.kinds[name]))
+
+def open_annotation_index(directory):
+        if not os.path.exists(os.path.join(directory, "index.json")):
+                return None
+        logging.info("Using annotation index: {}".format(directory))
+        return Annotation_Index(directory)
@@ -0,0 +1,45 @@
+import collections
+import logging
+
+# Memoization of read assignment. The regions a read is assigned to, and by how much, only depend on its aligned blocks
+# (chromosome, strand, start, end of each block), and highly expressed genes have many reads with the very same blocks.
+# The contributions of a read are computed once per block signature, as a list of
+# (counter attribute, key1, key2, key3, increment), and replayed for the next reads with the same signature.
+# They are added in the same order as the assignment code adds them, so the counts are exactly the same.
+
+def alignment_signature(alt_iv_seq):
+        return tuple((iv.chrom, iv.strand, iv.start, iv.end) for iv in alt_iv_seq)
+
+def add_contributions(quanter, contributions):
+        for counter_name, key1, key2, key3, value in contributions:
+                getattr(quanter, counter_name)[key1][key2][key3] += value
+
+class Assignment_Cache(object):
+        # Least recently used signatures are dropped once max_size signatures are stored.
+        def __init__(self, max_size):
+                self.max_size = max_size
+                self.cache = collections.OrderedDict()
+                self.hits = 0
+                self.misses = 0
+                logging.info("Caching the read assignment of up to {} alignment signatures".format(max_size))
+
+        def get(self, signature):
+                contributions = self.cache.get(signature)
+                if contributions is None:
+                        self.misses += 1
+                else:
+                        self.hits += 1
+                        self.cache.move_to_end(signature)
+                return contributions
+
+        def put(self, signature, contributions):
+                self.cache[signature] = contributions
+                if len(self.cache) > self.max_size:
+                        self.cache.popitem(last=False)
+
+        def hit_rate(self):
+                lookups = self.hits + self.misses
+                return self.hits * 1.0 / lookups if lookups else 0.0
+
+        def get_metrics(self):
+                return {"assignment_cache_hits": self.hits, "assignment_cache_misses": self.misses, "assignment_cache_hit_rate": self.hit_rate()}
@@ -0,0 +1,191 @@
+import re
+import time
+import hashlib
+import logging
+import HTSeq
+
+# htslib CRAM "required_fields" bit flags (htslib/cram/cram_structs.h).
+SAM_QNAME = 0x00000001
+SAM_FLAG  = 0x00000002
+SAM_RNAME = 0x00000004
+SAM_POS   = 0x00000008
+SAM_MAPQ  = 0x00000010
+SAM_CIGAR = 0x00000020
+SAM_RNEXT = 0x00000040
+SAM_PNEXT = 0x00000080
+SAM_TLEN  = 0x00000100
+SAM_SEQ   = 0x00000200
+SAM_QUAL  = 0x00000400
+SAM_AUX   = 0x00000800
+
+# quant only looks at read names, flags, coordinates, CIGAR, mate positions and tags (NH, ...).
+# Leaving SAM_SEQ and SAM_QUAL out lets htslib skip sequence reconstruction, so reference slices
+# are not even fetched for the containers being decoded.
+QUANT_REQUIRED_FIELDS = SAM_QNAME | SAM_FLAG | SAM_RNAME | SAM_POS | SAM_MAPQ | SAM_CIGAR | SAM_RNEXT | SAM_PNEXT | SAM_TLEN | SAM_AUX
+
+# A progress line is logged every PROGRESS_INTERVAL alignment records.
+PROGRESS_INTERVAL = 1000000
+
+# Subsampling keeps a read if the 64-bit hash of its name falls below fraction * SUBSAMPLE_HASH_RANGE.
+SUBSAMPLE_HASH_RANGE = 2 ** 64
+
+# Stable 64-bit hash of a read name, used to subsample reads and to rank them for saturation analysis.
+def read_name_hash(query_name):
+        return int.from_bytes(hashlib.blake2b(query_name.encode(), digest_size=8).digest(), "little")
+
+# Regions such as "chr1:10001-20000,chr2" (1-based and inclusive, like samtools) as (chrom, start, end) with 0-based,
+# half-open coordinates. end is None for a whole chromosome.
+def parse_regions(text):
+        regions = []
+        for region in text.split(","):
+                region = region.strip()
+                if not region:
+                        continue
+                match = re.match(r"^([^:]+)(?::(\d+)-(\d+))?$", region)
+                if not match or (match.group(2) and not 1 <= int(match.group(2)) <= int(match.group(3))):
+                        raise Exception("Invalid region \"{}\". Use CHROM or CHROM:START-END, e.g. chr1:10001-20000.".format(region))
+                if match.group(2):
+                        regions.append((match.group(1), int(match.group(2)) - 1, int(match.group(3))))
+                else:
+                        regions.append((match.group(1), 0, None))
+        if not regions:
+                raise Exception("No regions given in \"{}\"".format(text))
+        return regions
+
+class Alignment_Reader(object):
+        # regions: only the alignments overlapping these regions (see parse_regions) are read, from the index of the file.
+        def __init__(self, filename, reference=None, subsample=None, regions=None):
+                self.filename = filename
+                self.reference = reference
+                self.is_cram = self.is_cram_file(filename)
+                if self.is_cram and not reference:
+                        raise Exception("\"{}\" is a CRAM file. Please specify the reference FASTA file it was compressed against with --reference.".format(filename))
+                self.subsample_threshold = None
+                if subsample is not None and subsample != 1:
+                        if not 0 < subsample < 1:
+                                raise Exception("Subsampling fraction must be between 0 and 1, got {}".format(subsample))
+                        self.subsample_threshold = int(subsample * SUBSAMPLE_HASH_RANGE)
+                self.regions = parse_regions(regions) if regions else None
+                self.record_no = -1
+                # Virtual file offset at which the record being processed starts (BAM only; CRAM containers cannot be entered mid-way).
+                self.record_offset = None
+                self.exhausted = False
+                self.resume_record_no = 0
+                self.resume_offset = None
+
+        @staticmethod
+        def is_cram_file(filename):
+                with open(filename, "rb") as f:
+                        return f.read(4) == b"CRAM"
+
+        def open(self):
+                import pysam
+                if self.is_cram:
+                        # htslib complains on stderr when a CRAM has no .crai index, which quant does not need.
+                        verbosity = pysam.set_verbosity(0)
+                        try:
+                                samfile = pysam.AlignmentFile(self.filename, "rc", reference_filename=self.reference,
+                                                              format_options=[("required_fields=0x%x" % QUANT_REQUIRED_FIELDS).encode("ascii")])
+                        finally:
+                                pysam.set_verbosity(verbosity)
+                        logging.info("Reading CRAM file {} against reference {} (sequence decoding disabled)".format(self.filename, self.reference))
+                else:
+                        samfile = pysam.AlignmentFile(self.filename, "rb")
+                return samfile
+
+        # SO field of the @HD header line, e.g. "coordinate", "queryname" or "unsorted" (None if absent).
+        def get_sort_order(self):
+                samfile = self.open()
+                try:
+                        return samfile.header.to_dict().get("HD", {}).get("SO")
+                finally:
+                        samfile.close()
+
+        # Regions sorted in the order of the file and merged where they overlap, so that reads come in coordinate order.
+        def get_fetch_regions(self, samfile):
+                regions = []
+                for chrom, start, end in self.regions:
+                        tid = samfile.get_tid(chrom)
+                        if tid < 0:
+                                logging.info("Region {} is skipped: no reference sequence {} in {}".format(chrom, chrom, self.filename))
+                                continue
+                        length = samfile.get_reference_length(chrom)
+                        regions.append([tid, chrom, min(start, length), length if end is None else min(end, length)])
+                regions.sort()
+                merged = []
+                for region in regions:
+                        if merged and merged[-1][0] == region[0] and region[2] <= merged[-1][3]:
+                                merged[-1][3] = max(merged[-1][3], region[3])
+                        else:
+                                merged.append(region)
+                return [(chrom, start, end) for tid, chrom, start, end in merged]
+
+        def fetch_regions(self, samfile):
+                previous_chrom, previous_end = None, 0
+                for chrom, start, end in self.get_fetch_regions(samfile):
+                        try:
+                                records = samfile.fetch(chrom, start, end)
+                        except ValueError:
+                                raise Exception("Reading regions of {} requires its index (.bai, .csi or .crai). Create it with samtools index.".format(self.filename))
+                        for pa in records:
+                                # reads that also overlap the previous region of the chromosome were read with it
+                                if chrom == previous_chrom and pa.reference_start < previous_end:
+                                        continue
+                                yield pa
+                        previous_chrom, previous_end = chrom, end
+
+        # Alignments of read pairs in bundles of one read name, like HTSeq.pair_SAM_alignments(bundle=True).
+        # Alignments read from regions come in coordinate order, so mates are matched with a buffer and every pair is a bundle.
+        def pair_bundles(self):
+                if self.regions:
+                        return ([pair] for pair in HTSeq.pair_SAM_alignments_with_buffer(self))
+                return HTSeq.pair_SAM_alignments(self, bundle=True)
+
+        # The decision depends on the read name only, so it is the same in every run and mates are kept or dropped together.
+        def is_subsampled(self, query_name):
+                return read_name_hash(query_name) < self.subsample_threshold
+
+        # The next iteration starts at record number record_no, located at virtual offset "offset" if known.
+        def set_resume_point(self, record_no, offset=None):
+                self.resume_record_no = record_no
+                self.resume_offset = offset
+
+        def __iter__(self):
+                samfile = self.open()
+                records = self.fetch_regions(samfile) if self.regions else iter(samfile)
+                self.record_no = 0
+                self.exhausted = False
+                start_time = time.time()
+                try:
+                        if self.resume_record_no > 0:
+                                if self.resume_offset is not None and not self.is_cram:
+                                        samfile.seek(self.resume_offset)
+                                else:
+                                        for i in range(self.resume_record_no):
+                                                next(records)
+                                self.record_no = self.resume_record_no
+                                logging.info("Resuming from {}".format(self.get_line_number_string()))
+
+                        while True:
+                                offset = None if self.is_cram or self.regions else samfile.tell()
+                                try:
+                                        pa = next(records)
+                                except StopIteration:
+                                        break
+                                self.record_offset = offset
+                                # Dropped reads are never converted to HTSeq alignments, so their CIGAR is not even parsed.
+                                if self.subsample_threshold is None or self.is_subsampled(pa.query_name):
+                                        yield HTSeq.SAM_Alignment.from_pysam_AlignedSegment(pa, samfile)
+                                self.record_no += 1
+                                if self.record_no % PROGRESS_INTERVAL == 0:
+                                        records_read = self.record_no - self.resume_record_no
+                                        logging.info("{} alignment records processed ({:.0f} records/sec)".format(self.record_no, records_read / max(time.time() - start_time, 1e-9)))
+                        self.exhausted = True
+                finally:
+                        samfile.close()
+
+        def get_line_number_string(self):
+                if self.record_no == -1:
+                        return "unopened file %s" % (self.filename)
+                else:
+                        return "record #%d in file %s" % (self.record_no, self.filename)
@@ -0,0 +1,122 @@
+import os
+import bisect
+import logging
+import numpy as np
+import pandas as pd
+import scipy.stats
+from IRTools.quant_reader import read_name_hash, SUBSAMPLE_HASH_RANGE
+from IRTools.quant_buckets import Counter_Buckets, add_nested
+
+# Saturation analysis: every read gets a stable rank (the hash of its name, the same one --subsample uses) and is counted
+# in one of several depth buckets, e.g. ranks in [0%, 10%), [10%, 20%), ... . The counters of depth X% are the sum of
+# the buckets up to X%, so a single pass over the alignments gives the results of all the depths.
+
+def parse_saturation_depths(value):
+        # "10,20,...,100" is expanded with the step of the first two values
+        items = [item.strip() for item in value.split(",") if item.strip()]
+        if "..." in items:
+                i = items.index("...")
+                if i < 2 or i != len(items) - 2:
+                        raise Exception("Cannot expand saturation depths \"{}\". Use e.g. 10,20,...,100".format(value))
+                start, step, stop = float(items[0]), float(items[1]) - float(items[0]), float(items[-1])
+                if step <= 0:
+                        raise Exception("Cannot expand saturation depths \"{}\". Use e.g. 10,20,...,100".format(value))
+                depths = []
+                depth = start
+                while depth < stop - 1e-9:
+                        depths.append(depth)
+                        depth += step
+                depths.append(stop)
+        else:
+                depths = [float(item) for item in items]
+        for depth in depths:
+                if not 0 < depth <= 100:
+                        raise Exception("Saturation depths must be percentages between 0 and 100, got {}".format(depth))
+        # full depth is always counted, it is what the regular output files contain
+        return sorted(set(depths) | set([100.0]))
+
+def depth_label(depth):
+        return "depth{:g}".format(depth)
+
+class Saturation_Counter(Counter_Buckets):
+        def __init__(self, quanter, depths, subsample=None):
+                Counter_Buckets.__init__(self, quanter, len(depths))
+                self.depths = depths
+                # ranks are relative to the reads kept by --subsample
+                scale = subsample or 1.0
+                self.thresholds = [int(depth / 100.0 * scale * SUBSAMPLE_HASH_RANGE) for depth in depths[:-1]]
+
+        # Switches to the bucket of the read; it is counted by add_read() only if it passes the filters of quant.
+        def select(self, query_name):
+                self.switch_bucket(bisect.bisect_right(self.thresholds, read_name_hash(query_name)))
+
+        # Counts a read (or read pair) that is quantified, as the total read count of quant does.
+        def add_read(self):
+                self.read_counts[self.current] += 1
+
+        # Called once counting is done: outputs of every depth below 100% are written under NAME.depthX, then the quanter
+        # is left with the full depth counters for the regular outputs.
+        def output_depths(self, output_functions, restore_attributes, tables):
+                self.store()
+                name = self.quanter.params['name']
+                self.tables = tables
+                self.depth_tables = []
+                cumulative = self.buckets[0]
+                for bucket, depth in enumerate(self.depths):
+                        if bucket > 0:
+                                add_nested(cumulative, self.buckets[bucket])
+                        if depth == 100:
+                                break
+                        logging.info("Writing saturation results for {:g}% of the reads".format(depth))
+                        self.output_counters(cumulative, name + "." + depth_label(depth), output_functions + [self.save_table_values], restore_attributes)
+                self.load(0)
+
+        def save_table_values(self):
+                self.depth_tables.append(self.get_table_values())
+
+        def get_table_values(self):
+                values = []
+                for level, df_attribute, id_column, value_column in self.tables:
+                        df = getattr(self.quanter, df_attribute)
+                        values.append(pd.Series(pd.to_numeric(df[value_column], errors="coerce").values, index=df[id_column]))
+                return values
+
+        @staticmethod
+        def correlation(values, full_values):
+                both = pd.concat([values, full_values], axis=1, join="inner").replace([np.inf, -np.inf], np.nan).dropna()
+                if len(both) < 2 or both.iloc[:, 0].nunique() < 2 or both.iloc[:, 1].nunique() < 2:
+                        return len(both), np.nan, np.nan
+                return len(both), scipy.stats.pearsonr(both.iloc[:, 0], both.iloc[:, 1])[0], scipy.stats.spearmanr(both.iloc[:, 0], both.iloc[:, 1])[0]
+
+        # Called after the regular (full depth) outputs are written.
+        def output_summary(self, quanttype):
+                full_tables = self.get_table_values()
+                columns = ["depth_percent", "read_count"]
+                for level, df_attribute, id_column, value_column in self.tables:
+                        columns += [level + "s_quantified", level + "_pearson_r", level + "_spearman_r"]
+
+                summary_data = []
+                read_count = 0
+                for bucket, depth in enumerate(self.depths):
+                        read_count += self.read_counts[bucket]
+                        tables = self.depth_tables[bucket] if depth < 100 else full_tables
+                        row = [depth, read_count]
+                        for values, full_values in zip(tables, full_tables):
+                                quantified = int(np.isfinite(values).sum())
+                                n, pearson, spearman = self.correlation(values, full_values)
+                                row += [quantified, pearson, spearman]
+                        summary_data.append(row)
+                # The 100% row covers all the quantified reads, so it must match the total read count of quant (IRI).
+                total_read_count = getattr(self.quanter, 'total_read_count', None)
+                if total_read_count is not None and read_count != total_read_count:
+                        raise Exception("Saturation read count at 100% ({}) differs from the total read count ({})".format(read_count, total_read_count))
+                summary_df = pd.DataFrame(summary_data, columns=columns)
+
+                outfile = self.quanter.params['name'] + ".quant." + quanttype + ".saturation.txt"
+                outfile_fullpath = os.path.join(self.quanter.params['outdir'], outfile)
+                logging.info("Writing saturation summary to file: {}".format(outfile_fullpath))
+                summary_df.to_csv(outfile_fullpath, index=None, sep='\t', na_rep="NA")
+
+                logging.info("Saturation of intron retention estimates (correlation with full depth):")
+                for row in summary_data:
+                        print(("\t%g%% of reads: " % row[0]) + ", ".join("%s Spearman r = %.4f" % (level, row[4 + 3 * i]) for i, (level, a, b, c) in enumerate(self.tables)))
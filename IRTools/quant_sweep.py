@@ -0,0 +1,150 @@
+import bisect
+import logging
+import HTSeq
+
+# Sweep-line lookups for coordinate-sorted alignments. The steps of each chromosome (and strand) of an annotation
+# GenomicArray(OfSets) are compiled once into sorted lists of step starts, ends and values. As the reads come in order,
+# a pointer to the step holding the current read start only ever moves forward, so the steps a read overlaps are found
+# from there instead of by a random-access lookup of the whole array. Lookups return the very same steps and values as
+# the GenomicArray does, so the results do not change.
+
+def chrom_vector_steps(chrom_vector):
+        starts, ends, values = [], [], []
+        for iv, value in chrom_vector.steps():
+                starts.append(iv.start)
+                ends.append(iv.end)
+                values.append(value)
+        return starts, ends, values
+
+class Sweep_Vector(object):
+        # starts, ends and values: any sequences, e.g. lists or read-only NumPy arrays of a mapped annotation index
+        def __init__(self, chrom, strand, starts, ends, values):
+                self.chrom = chrom
+                self.strand = strand
+                self.starts = starts
+                self.ends = ends
+                self.values = values
+                self.pointer = 0
+
+        # position must not be before the position of the previous seek, unless reset is set.
+        def seek(self, position, reset=False):
+                ends = self.ends
+                if reset:
+                        self.pointer = bisect.bisect_right(ends, position)
+                else:
+                        pointer = self.pointer
+                        while ends[pointer] <= position:
+                                pointer += 1
+                        self.pointer = pointer
+
+        def find(self, position):
+                if position >= self.starts[self.pointer]:
+                        return bisect.bisect_right(self.ends, position, self.pointer)
+                return bisect.bisect_right(self.ends, position)
+
+        def steps(self, start, end):
+                ends, values = self.ends, self.values
+                i = self.find(start)
+                step_start = start
+                while step_start < end:
+                        step_end = int(ends[i]) if ends[i] < end else end
+                        yield HTSeq.GenomicInterval(self.chrom, step_start, step_end, self.strand), values[i]
+                        step_start = step_end
+                        i += 1
+
+        def value_at(self, position):
+                return self.values[self.find(position)]
+
+        def sum(self, start, end):
+                starts, ends, values = self.starts, self.ends, self.values
+                i = self.find(start)
+                total = 0
+                while i < len(starts) and starts[i] < end:
+                        total += values[i] * (min(ends[i], end) - max(starts[i], start))
+                        i += 1
+                return total
+
+class Sweep_Slice(object):
+        def __init__(self, vector, iv):
+                self.vector = vector
+                self.iv = iv
+
+        def steps(self):
+                return self.vector.steps(self.iv.start, self.iv.end)
+
+# Stands in for a GenomicArray(OfSets) in the read assignment code: array[iv].steps(), array[position] and score_sum().
+# array is a GenomicArray(OfSets) or an array of an annotation index (see quant_index).
+class Sweep_Array(object):
+        def __init__(self, array):
+                self.array = array
+                self.stranded = array.stranded
+                self.vectors = {}
+                self.chrom = None
+                self.position = -1
+
+        def get_vector(self, chrom, strand):
+                if not self.stranded:
+                        strand = "."
+                vector = self.vectors.get((chrom, strand))
+                if vector is None:
+                        if not isinstance(self.array, HTSeq.GenomicArray):
+                                starts, ends, values = self.array.get_steps(chrom, strand)
+                        else:
+                                if chrom not in self.array.chrom_vectors:
+                                        # an "auto" array adds an empty chromosome the first time it is looked up
+                                        self.array[HTSeq.GenomicInterval(chrom, 0, 1, strand if self.stranded else "+")]
+                                starts, ends, values = chrom_vector_steps(self.array.chrom_vectors[chrom][strand])
+                        vector = Sweep_Vector(chrom, strand, starts, ends, values)
+                        vector.seek(self.position if chrom == self.chrom else 0, reset=True)
+                        self.vectors[(chrom, strand)] = vector
+                return vector
+
+        def move_to(self, chrom, position):
+                reset = chrom != self.chrom or position < self.position
+                self.chrom = chrom
+                self.position = position
+                for strand in ("+", "-") if self.stranded else (".",):
+                        vector = self.vectors.get((chrom, strand))
+                        if vector is not None:
+                                vector.seek(position, reset)
+
+        def __getitem__(self, key):
+                vector = self.get_vector(key.chrom, key.strand)
+                if isinstance(key, HTSeq.GenomicPosition):
+                        return vector.value_at(key.pos)
+                return Sweep_Slice(vector, key)
+
+        def sum(self, iv):
+                return self.get_vector(iv.chrom, iv.strand).sum(iv.start, iv.end)
+
+# Sum of the values of a score GenomicArray (or its Sweep_Array) over iv, step by step rather than base by base.
+def score_sum(array, iv):
+        if isinstance(array, Sweep_Array):
+                return array.sum(iv)
+        return sum(value * step_iv.length for step_iv, value in array[iv].steps())
+
+class Annotation_Sweep(object):
+        # arrays: names of the quanter's GenomicArray(OfSets) attributes used to assign reads. They are replaced by
+        # Sweep_Arrays, which follow the reads with move_to().
+        def __init__(self, quanter, arrays):
+                self.quanter = quanter
+                self.sweep_arrays = {}
+                self.wrapped = []
+                for name in arrays:
+                        array = getattr(quanter, name)
+                        # arrays of an annotation index are Sweep_Arrays already
+                        if not isinstance(array, Sweep_Array):
+                                array = Sweep_Array(array)
+                                setattr(quanter, name, array)
+                                self.wrapped.append(name)
+                        self.sweep_arrays[name] = array
+                logging.info("Alignments are sorted by coordinate, reads are assigned by sweeping along the annotation")
+
+        def move_to(self, chrom, position):
+                for sweep_array in self.sweep_arrays.values():
+                        sweep_array.move_to(chrom, position)
+
+        # Puts the GenomicArray(OfSets) back once the reads are counted.
+        def close(self):
+                for name in self.wrapped:
+                        setattr(self.quanter, name, self.sweep_arrays[name].array)
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+from IRTools import metrics
+from IRTools.quant_reader import Alignment_Reader
+from IRTools.table_io import EXTENSIONS
+from IRTools.cohort_store import open_cohort_store
+from IRTools.diff_input import get_replicate_names
+
+# Result cache: the output files of a finished quant or diff run are stored in DIR/{quant,diff}/KEY. KEY is computed
+# from everything the results depend on: for quant, the size, modification time and header checksum of the alignment
+# file, the contents of the annotation, mappability and other input files and the parameters; for diff, the contents
+# of the input quant files and the parameters. A rerun with the same key gets the stored files back at once.
+#
+# Files are hard-linked into and out of the cache where possible (copied otherwise). Before a run writes its outputs,
+# outputs that are hard links are replaced by copies, so that rewriting them cannot change the cached copy. The size and
+# modification time of every cached file are kept in the manifest of the entry, and an entry whose files were
+# changed anyway is dropped instead of being reused.
+
+CACHE_VERSION = 1
+
+# Parameters that change the quant results. The input files are part of the key by their contents.
+QUANT_KEY_PARAMS = ['name', 'quanttype', 'readtype', 'libtype', 'species', 'minoverlap', 'subsample', 'saturation', 'barcode_tag',
+                    'group_output', 'split_by', 'umi_tag', 'regions', 'output_format']
+
+DIFF_KEY_PARAMS = ['name', 'quanttype', 'analysistype', 's1files', 's2files', 'output_format', 'cohort_store', 'group_test', 'post_hoc', 'count_test', 'test', 'permutations',
+                   'keep_intermediate']
+
+def file_digest(filename):
+        digest = hashlib.sha1()
+        with open(filename, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(chunk)
+        return digest.hexdigest()
+
+def optional_file_digest(filename):
+        if filename and os.path.exists(filename):
+                return file_digest(filename)
+        # e.g. a species name given instead of a mappability file
+        return filename
+
+def alignment_file_signature(filename, reference=None):
+        stat = os.stat(filename)
+        samfile = Alignment_Reader(filename, reference).open()
+        try:
+                header = str(samfile.header)
+        finally:
+                samfile.close()
+        return [stat.st_size, stat.st_mtime_ns, hashlib.sha1(header.encode()).hexdigest()]
+
+def get_key(key):
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def quant_cache_key(params):
+        key = {'version': CACHE_VERSION,
+               'altfile': alignment_file_signature(params['altfile'], params.get('reference')),
+               'annofile': optional_file_digest(params.get('annofile')),
+               'mapfile': optional_file_digest(params.get('mapfile')) if params['quanttype'] == 'IRI' else None,
+               'barcode_groups': optional_file_digest(params.get('barcode_groups')),
+               'libtype_sheet': optional_file_digest(params.get('libtype_sheet')),
+               'params': dict((name, params.get(name)) for name in QUANT_KEY_PARAMS)}
+        return get_key(key)
+
+def diff_input_files(params):
+        levels = ["introns", "genes"] + (["junctions"] if params['quanttype'] == 'IRC' else [])
+        names = get_replicate_names(params)
+        if params.get('cohort_store'):
+                store = open_cohort_store(params['cohort_store'])
+                store.check_samples(params['quanttype'], names)
+                return [os.path.join(params['cohort_store'], level + ".ids.txt") for level in levels] + \
+                       [filename for name in names for level in levels for filename in store.get_sample_files(name, level)]
+        prefixes = [os.path.join(params['indir'], name + ".quant." + params['quanttype'] + "." + level) for name in names for level in levels]
+        # in whichever format they were written
+        return [next((path for path in (prefix + extension for extension in EXTENSIONS.values()) if os.path.exists(path)), prefix + ".txt") for prefix in prefixes]
+
+def diff_cache_key(params):
+        key = {'version': CACHE_VERSION,
+               'inputs': [optional_file_digest(filename) for filename in diff_input_files(params)],
+               'sample_sheet': optional_file_digest(params.get('sample_sheet')),
+               'params': dict((name, params.get(name)) for name in DIFF_KEY_PARAMS)}
+        return get_key(key)
+
+def link_or_copy(source, destination):
+        try:
+                os.link(source, destination)
+        except OSError:
+                shutil.copy2(source, destination)
+
+class Result_Cache(object):
+        # subdirs: directories under outdir holding output files. is_output(filename) tells output files by their name.
+        def __init__(self, cache_dir, command, key, outdir, subdirs, is_output):
+                self.entry = os.path.join(cache_dir, command, key)
+                self.outdir = outdir
+                self.subdirs = subdirs
+                self.is_output = is_output
+                self.previous_outputs = {}
+
+        def find_outputs(self):
+                outputs = []
+                for subdir in self.subdirs:
+                        directory = os.path.join(self.outdir, subdir)
+                        if not os.path.isdir(directory):
+                                continue
+                        for filename in sorted(os.listdir(directory)):
+                                path = os.path.join(directory, filename)
+                                if self.is_output(filename) and os.path.isfile(path):
+                                        outputs.append(os.path.join(subdir, filename))
+                return outputs
+
+        def load_manifest(self):
+                manifest_file = os.path.join(self.entry, "manifest.json")
+                if not os.path.exists(manifest_file):
+                        return None
+                with open(manifest_file) as f:
+                        manifest = json.load(f)
+                for filename, (size, mtime) in manifest['files'].items():
+                        path = os.path.join(self.entry, filename)
+                        if not os.path.exists(path) or os.stat(path).st_size != size or os.stat(path).st_mtime_ns != mtime:
+                                logging.info("Cached results {} were modified since they were stored, they are not used".format(self.entry))
+                                shutil.rmtree(self.entry, ignore_errors=True)
+                                return None
+                return manifest
+
+        # Puts the cached output files into the output directory. Returns False if there are none.
+        def restore(self):
+                manifest = self.load_manifest()
+                if manifest is None:
+                        logging.info("No cached results found in {}".format(self.entry))
+                        return False
+                logging.info("Reusing cached results of an earlier run with the same input files and parameters ({})".format(self.entry))
+                for filename in sorted(manifest['files']):
+                        destination = os.path.join(self.outdir, filename)
+                        if os.path.dirname(destination) and not os.path.exists(os.path.dirname(destination)):
+                                os.makedirs(os.path.dirname(destination))
+                        if os.path.lexists(destination):
+                                os.remove(destination)
+                        link_or_copy(os.path.join(self.entry, filename), destination)
+                        print(("\t%s" % destination))
+                return True
+
+        def get_output_stats(self):
+                stats = {}
+                for filename in self.find_outputs():
+                        stat = os.stat(os.path.join(self.outdir, filename))
+                        stats[filename] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                return stats
+
+        # Called before the outputs are written. Outputs that are hard links are replaced by copies, so that rewriting them cannot change the cached copy.
+        def begin(self):
+                for filename in self.find_outputs():
+                        path = os.path.join(self.outdir, filename)
+                        if os.stat(path).st_nlink > 1:
+                                # replaced by a copy of its own
+                                shutil.copy2(path, path + ".tmp")
+                                os.replace(path + ".tmp", path)
+                self.previous_outputs = self.get_output_stats()
+
+        # Stores the output files written since begin(), i.e. new or changed ones. Older outputs of other runs with the
+        # same name are left out.
+        def store(self):
+                outputs = [filename for filename, stat in sorted(self.get_output_stats().items()) if self.previous_outputs.get(filename) != stat]
+                parent = os.path.dirname(os.path.abspath(self.entry))
+                os.makedirs(parent, exist_ok=True)
+                # Written next to its final place and renamed, so that runs started at the same time never see half an entry.
+                tmpdir = tempfile.mkdtemp(prefix=".tmp.", dir=parent)
+                files = {}
+                for filename in outputs:
+                        destination = os.path.join(tmpdir, filename)
+                        if not os.path.exists(os.path.dirname(destination)):
+                                os.makedirs(os.path.dirname(destination))
+                        link_or_copy(os.path.join(self.outdir, filename), destination)
+                        stat = os.stat(destination)
+                        files[filename] = [stat.st_size, stat.st_mtime_ns]
+                with open(os.path.join(tmpdir, "manifest.json"), "w") as f:
+                        json.dump({'version': CACHE_VERSION, 'created': time.time(), 'files': files}, f)
+                shutil.rmtree(self.entry, ignore_errors=True)
+                try:
+                        os.rename(tmpdir, self.entry)
+                        logging.info("Results stored in cache: {}".format(self.entry))
+                except OSError:
+                        # another run has stored them meanwhile
+                        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def open_quant_cache(params):
+        if not params.get('cache_dir'):
+                return None
+        name, quanttype = params['name'], params['quanttype']
+        is_output = lambda filename: filename.startswith(name + ".") and ".quant." + quanttype + "." in filename and not filename.endswith((".log", ".checkpoint"))
+        return Result_Cache(params['cache_dir'], "quant", quant_cache_key(params), params['outdir'], [""], is_output)
+
+def open_diff_cache(params):
+        if not params.get('cache_dir'):
+                return None
+        prefix = params['name'] + ".diff."
+        is_output = lambda filename: filename.startswith(prefix) and "." + params['quanttype'] + "." in filename[len(prefix) - 1:]
+        # intermediate files are written to the "temp" directory
+        return Result_Cache(params['cache_dir'], "diff", diff_cache_key(params), params['outdir'], ["", "temp"], is_output)
+
+# Calls run() unless the results of cache (None: no cache) are found, and stores the results afterwards.
+# With no_cache the results are computed again in any case.
+def run_with_cache(cache, no_cache, run):
+        if cache:
+                metrics.start_stage("result_cache")
+                restored = not no_cache and cache.restore()
+                metrics.end_stage()
+                if restored:
+                        return
+                cache.begin()
+        run()
+        if cache:
+                cache.store()
@@ -0,0 +1,345 @@
+import os
+import io
+import sys
+import json
+import time
+import socket
+import logging
+import traceback
+import collections
+import contextlib
+import http.client
+import http.server
+import socketserver
+import multiprocessing
+from IRTools import metrics
+from IRTools import quant_cmd
+from IRTools.profiling import run_with_profiler
+
+# "IRTools serve": a long-running quant server. Annotations (and mappability scores) are loaded once and kept in memory,
+# and every job is a quant run forked from the loaded annotation, so it starts counting reads at once. A forked job
+# shares the annotation with the server copy-on-write and cannot change it for the jobs after it.
+#
+# Jobs are submitted with "IRTools submit" (or any HTTP client) over a Unix socket or a localhost port:
+#   POST /jobs      {"args": [quant arguments], "cwd": directory relative paths are resolved against} -> {"job": ID}
+#   GET /jobs/ID    {"job": ID, "status": "queued"|"running"|"done"|"failed", "outputs": [files], "error": message}
+#   GET /status     loaded annotations and the number of queued, running and finished jobs
+
+# Finished jobs are kept for GET /jobs/ID until this many more have finished.
+FINISHED_JOBS_KEPT = 10000
+
+# Interval in seconds at which the server starts queued jobs and collects finished ones.
+POLL_INTERVAL = 0.02
+
+def get_quanter_key(args):
+        stranded = args.libtype in ("fr-firststrand", "fr-secondstrand")
+        # IRC does not use mappability
+        mapfile = args.mapfile if args.quanttype == 'IRI' else None
+        return (args.quanttype, args.species, args.annofile, mapfile, stranded, args.annotation_index)
+
+# Annotation files are shared by jobs from different directories, so they are looked up by absolute path.
+def resolve_annotation_paths(args, cwd):
+        if args.annofile:
+                args.annofile = os.path.join(cwd, args.annofile)
+        if args.annotation_index:
+                args.annotation_index = os.path.join(cwd, args.annotation_index)
+        # the map file can also be a species name
+        if args.mapfile and os.path.exists(os.path.join(cwd, args.mapfile)):
+                args.mapfile = os.path.join(cwd, args.mapfile)
+
+# Files NAME.*quant.{IRI,IRC}.* in the output directory written by the job.
+def get_output_files(args, start_time):
+        outdir = os.path.abspath(args.outdir or ".")
+        outputs = []
+        for filename in sorted(os.listdir(outdir)):
+                path = os.path.join(outdir, filename)
+                if filename.startswith(args.name + ".") and ".quant." + args.quanttype + "." in filename and os.path.isfile(path) and os.path.getmtime(path) >= start_time:
+                        outputs.append(path)
+        return outputs
+
+# Runs in the forked job process. Output of the run goes to NAME.quant.{IRI,IRC}.serve.log in the output directory.
+def run_job(quanter, args, cwd, connection):
+        try:
+                os.chdir(cwd)
+                if args.outdir and not os.path.exists(args.outdir):
+                        os.makedirs(args.outdir)
+                log_file = os.open(os.path.join(args.outdir, args.name + ".quant." + args.quanttype + ".serve.log"), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os.dup2(log_file, 1)
+                os.dup2(log_file, 2)
+                os.close(log_file)
+                # file mtimes can be rounded down to the second
+                start_time = int(time.time())
+                metrics.RUN_METRICS.__init__()
+                logging.info("Beginning IRTools quant run (IRTools serve): {}".format(" ".join(args.job_args)))
+                quanter.params = args.__dict__.copy()
+                quanter.libtype = args.libtype
+                run_with_profiler(lambda args: quant_cmd.run(args, quanter), args, "quant")
+                logging.info("Stage metrics:")
+                metrics.RUN_METRICS.log_summary()
+                if args.metrics_json:
+                        metrics.RUN_METRICS.write_json(args.metrics_json, "quant", args.__dict__)
+                sys.stdout.flush()
+                connection.send({"status": "done", "outputs": get_output_files(args, start_time)})
+        except BaseException as e:
+                traceback.print_exc()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                connection.send({"status": "failed", "error": "{}: {}".format(type(e).__name__, e)})
+        finally:
+                connection.close()
+
+class Quant_Server(object):
+        def __init__(self, argparser, workers):
+                self.argparser = argparser
+                self.workers = workers
+                self.context = multiprocessing.get_context("fork")
+                self.quanters = {}
+                self.jobs = collections.OrderedDict()
+                self.queue = collections.deque()
+                self.running = {}
+                self.next_job_id = 1
+                self.finished_jobs = 0
+
+        # Parses quant arguments with the quant command line parser. Raises Exception with the parser message if they are invalid.
+        def parse_quant_args(self, quant_args):
+                message = io.StringIO()
+                try:
+                        with contextlib.redirect_stderr(message):
+                                args = self.argparser.parse_args(["quant"] + list(quant_args))
+                except SystemExit:
+                        raise Exception(message.getvalue().strip().splitlines()[-1] if message.getvalue().strip() else "invalid quant arguments")
+                args.job_args = list(quant_args)
+                return args
+
+        def get_quanter(self, args):
+                key = get_quanter_key(args)
+                quanter = self.quanters.get(key)
+                if quanter is None:
+                        logging.info("Loading {} annotation {} (library type {})".format(args.quanttype, args.annofile or args.species, args.libtype))
+                        start_time = time.time()
+                        quanter = self.quanters[key] = quant_cmd.load_quanter(args)
+                        logging.info("Annotation loaded in {:.1f} seconds".format(time.time() - start_time))
+                return quanter
+
+        # Annotations given on the serve command line are loaded before the first job comes in.
+        def preload(self, quanttypes, annofiles, species, libtypes, mapfile, annotation_index):
+                for quanttype in quanttypes:
+                        for annotation in [("-g", annofile) for annofile in annofiles] + [("-e", name) for name in species]:
+                                for libtype in libtypes:
+                                        quant_args = ["-q", quanttype, annotation[0], annotation[1], "-s", libtype, "-i", "-", "-n", "preload"]
+                                        if mapfile:
+                                                quant_args += ["-u", mapfile]
+                                        if annotation_index:
+                                                quant_args += ["--annotation-index", annotation_index]
+                                        args = self.parse_quant_args(quant_args)
+                                        resolve_annotation_paths(args, os.getcwd())
+                                        self.get_quanter(args)
+
+        def submit(self, request):
+                if not isinstance(request.get("args"), list):
+                        raise Exception("Job request must have a list of quant arguments in \"args\"")
+                args = self.parse_quant_args(request["args"])
+                cwd = request.get("cwd") or os.getcwd()
+                if not os.path.isdir(cwd):
+                        raise Exception("Working directory {} does not exist".format(cwd))
+                resolve_annotation_paths(args, cwd)
+                job_id = str(self.next_job_id)
+                self.next_job_id += 1
+                self.jobs[job_id] = {"job": job_id, "status": "queued", "args": args.job_args, "args_namespace": args, "cwd": cwd,
+                                     "submitted": time.time()}
+                self.queue.append(job_id)
+                logging.info("Job {} queued: {}".format(job_id, " ".join(args.job_args)))
+                return job_id
+
+        def start_jobs(self):
+                while self.queue and len(self.running) < self.workers:
+                        job_id = self.queue.popleft()
+                        job = self.jobs[job_id]
+                        args = job.pop("args_namespace")
+                        try:
+                                quanter = self.get_quanter(args)
+                        except Exception as e:
+                                self.finish_job(job, {"status": "failed", "error": "Annotation could not be loaded: {}".format(e)})
+                                continue
+                        receiver, sender = self.context.Pipe(duplex=False)
+                        process = self.context.Process(target=run_job, args=(quanter, args, job["cwd"], sender))
+                        process.start()
+                        sender.close()
+                        job["status"] = "running"
+                        job["started"] = time.time()
+                        self.running[job_id] = (process, receiver)
+
+        def collect_jobs(self):
+                for job_id, (process, receiver) in list(self.running.items()):
+                        if receiver.poll():
+                                try:
+                                        result = receiver.recv()
+                                except EOFError:
+                                        result = None
+                        elif not process.is_alive():
+                                result = None
+                        else:
+                                continue
+                        process.join()
+                        receiver.close()
+                        del self.running[job_id]
+                        if result is None:
+                                result = {"status": "failed", "error": "Job process exited with code {}".format(process.exitcode)}
+                        self.finish_job(self.jobs[job_id], result)
+
+        def finish_job(self, job, result):
+                job.update(result)
+                job["finished"] = time.time()
+                logging.info("Job {} {} in {:.2f} seconds".format(job["job"], job["status"], job["finished"] - job["submitted"]))
+                self.finished_jobs += 1
+                while len(self.jobs) > FINISHED_JOBS_KEPT and self.jobs[next(iter(self.jobs))].get("finished"):
+                        self.jobs.popitem(last=False)
+
+        def service(self):
+                self.collect_jobs()
+                self.start_jobs()
+
+        def get_job(self, job_id):
+                job = self.jobs.get(job_id)
+                if job is None:
+                        return None
+                return dict((key, value) for key, value in job.items() if key != "args_namespace")
+
+        def get_status(self):
+                return {"annotations": [{"quanttype": key[0], "species": key[1], "annofile": key[2], "mapfile": key[3], "stranded": key[4]} for key in self.quanters],
+                        "workers": self.workers, "queued": len(self.queue), "running": len(self.running), "finished": self.finished_jobs}
+
+        def stop(self):
+                for process, receiver in self.running.values():
+                        process.terminate()
+                        process.join()
+
+class Quant_Request_Handler(http.server.BaseHTTPRequestHandler):
+        def send_json(self, code, data):
+                body = json.dumps(data).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def do_GET(self):
+                quant_server = self.server.quant_server
+                if self.path == "/status":
+                        self.send_json(200, quant_server.get_status())
+                elif self.path.startswith("/jobs/"):
+                        job = quant_server.get_job(self.path[len("/jobs/"):])
+                        if job is None:
+                                self.send_json(404, {"error": "No such job"})
+                        else:
+                                self.send_json(200, job)
+                else:
+                        self.send_json(404, {"error": "Unknown path {}".format(self.path)})
+
+        def do_POST(self):
+                if self.path != "/jobs":
+                        self.send_json(404, {"error": "Unknown path {}".format(self.path)})
+                        return
+                try:
+                        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                        job_id = self.server.quant_server.submit(request)
+                except Exception as e:
+                        self.send_json(400, {"error": str(e)})
+                        return
+                self.send_json(200, {"job": job_id})
+
+        # client addresses of a Unix socket are empty strings
+        def address_string(self):
+                return self.client_address[0] if self.client_address else "local"
+
+        def log_message(self, format, *args):
+                pass
+
+class Quant_HTTP_Server(http.server.HTTPServer):
+        def __init__(self, address, quant_server):
+                http.server.HTTPServer.__init__(self, address, Quant_Request_Handler)
+                self.quant_server = quant_server
+
+        # called by serve_forever() between requests
+        def service_actions(self):
+                self.quant_server.service()
+
+class Quant_Unix_HTTP_Server(Quant_HTTP_Server):
+        address_family = socket.AF_UNIX
+
+        def server_bind(self):
+                socketserver.TCPServer.server_bind(self)
+                self.server_name = "localhost"
+                self.server_port = 0
+
+def run(args, argparser):
+        quant_server = Quant_Server(argparser, args.workers)
+        quant_server.preload(args.quanttypes or ["IRI", "IRC"], args.annofiles or [], args.species or [], args.libtypes or ["fr-unstranded"],
+                             args.mapfile, args.annotation_index)
+        if args.socket:
+                if os.path.exists(args.socket):
+                        os.remove(args.socket)
+                httpd = Quant_Unix_HTTP_Server(args.socket, quant_server)
+                address = "Unix socket {}".format(args.socket)
+        else:
+                httpd = Quant_HTTP_Server(("127.0.0.1", args.port), quant_server)
+                address = "http://127.0.0.1:{}".format(args.port)
+        logging.info("Serving quant jobs on {} with {} workers".format(address, args.workers))
+        try:
+                httpd.serve_forever(poll_interval=POLL_INTERVAL)
+        finally:
+                quant_server.stop()
+                httpd.server_close()
+                if args.socket and os.path.exists(args.socket):
+                        os.remove(args.socket)
+
+class Unix_HTTP_Connection(http.client.HTTPConnection):
+        def __init__(self, socket_path, timeout=None):
+                http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+                self.socket_path = socket_path
+
+        def connect(self):
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.socket_path)
+
+def send_request(args, method, path, data=None):
+        if args.socket:
+                connection = Unix_HTTP_Connection(args.socket)
+        else:
+                connection = http.client.HTTPConnection("127.0.0.1", args.port)
+        try:
+                body = json.dumps(data).encode() if data is not None else None
+                connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+                response = connection.getresponse()
+                result = json.loads(response.read() or b"{}")
+        finally:
+                connection.close()
+        if response.status != 200:
+                raise Exception(result.get("error", "Server replied {}".format(response.status)))
+        return result
+
+# "IRTools submit": sends a quant job to "IRTools serve", waits for it and prints the output files.
+# Returns the exit code: 0 if the job is done, 1 if it failed.
+def submit(args):
+        quant_args = args.quant_args[1:] if args.quant_args[:1] == ["--"] else args.quant_args
+        try:
+                job_id = send_request(args, "POST", "/jobs", {"args": quant_args, "cwd": os.getcwd()})["job"]
+                if args.no_wait:
+                        print(job_id)
+                        return 0
+                while True:
+                        job = send_request(args, "GET", "/jobs/" + job_id)
+                        if job["status"] in ("done", "failed"):
+                                break
+                        time.sleep(POLL_INTERVAL)
+        except (Exception, OSError) as e:
+                sys.stderr.write("IRTools submit: {}\n".format(e))
+                return 1
+        if job["status"] == "failed":
+                sys.stderr.write("Job {} failed: {}\n".format(job_id, job.get("error")))
+                return 1
+        for output in job["outputs"]:
+                print(output)
+        return 0
@@ -0,0 +1,169 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Result tables of quant and diff are written as tab-separated text (the default) or in a columnar binary format, which
+# loads much faster and can be read column by column, e.g. only intron_IRI of hundreds of samples:
+#   tsv      NAME.*.txt
+#   parquet  NAME.*.parquet (zstd compressed)
+#   feather  NAME.*.feather (Arrow IPC, zstd compressed)
+# Parquet and Feather need pyarrow. In the binary formats, ID, interval and type columns are categorical and metric
+# columns are numbers. The labels of filtered CIRs (e.g. "NA (5'AS)" in intron_IRI) are NaN in the metric column and
+# the label ("5'AS") is in an extra column, e.g. intron_IRI_filter.
+
+OUTPUT_FORMATS = ("tsv", "parquet", "feather")
+
+EXTENSIONS = {"tsv": ".txt", "parquet": ".parquet", "feather": ".feather"}
+
+# Metric columns that hold the labels of filtered CIRs in text tables, and the labels.
+FILTER_COLUMNS = ("intron_IRI", "intron_IRC")
+
+FILTER_LABELS = ["NA (5'AS)", "NA (3'AS)", "NA (unannotated exon)"]
+
+def is_category_column(column):
+        return column.endswith(("_id", "_iv")) or column == "CJ_type"
+
+def filter_column(column):
+        return column + "_filter"
+
+def get_table_path(prefix, output_format):
+        return prefix + EXTENSIONS[output_format]
+
+def get_format(path):
+        for output_format, extension in EXTENSIONS.items():
+                if path.endswith(extension):
+                        return output_format
+        raise Exception("Unknown table format of file {}. Tables must end in .txt, .parquet or .feather.".format(path))
+
+# The path of the table prefix + .txt, .parquet or .feather that exists.
+def find_table(prefix):
+        for output_format in OUTPUT_FORMATS:
+                path = get_table_path(prefix, output_format)
+                if os.path.exists(path):
+                        return path
+        raise Exception("No result table {}.txt, .parquet or .feather found".format(prefix))
+
+def check_output_format(output_format):
+        if output_format in ("parquet", "feather"):
+                try:
+                        import pyarrow
+                except ImportError:
+                        raise Exception("--output-format {} requires the pyarrow package. Please install it (pip install IRTools[columnar] or pip install pyarrow) or use --output-format tsv.".format(output_format))
+
+def to_number(value):
+        try:
+                return float(value)
+        except (TypeError, ValueError):
+                return np.nan
+
+# Metric columns become numbers; labels of filtered CIRs go to the filter column.
+def split_filter_labels(df):
+        for column in FILTER_COLUMNS:
+                if column in df.columns:
+                        values = df[column]
+                        if values.dtype.kind in "fiu":
+                                # no labels
+                                df[column] = values.astype(float)
+                                df[filter_column(column)] = pd.Series(np.nan, index=df.index, dtype=object).astype("category")
+                                continue
+                        # float() parses text exactly, unlike pd.to_numeric
+                        numbers = values.map(to_number).astype(float)
+                        labels = values.where(numbers.isna() & values.map(lambda value: isinstance(value, str)))
+                        df[column] = numbers
+                        df[filter_column(column)] = labels.map(lambda label: label[4:-1] if isinstance(label, str) and label.startswith("NA (") else label, na_action="ignore").astype("category")
+        return df
+
+def to_typed_frame(df, categorical=True):
+        df = split_filter_labels(df.copy())
+        for column in df.columns:
+                if categorical and is_category_column(column):
+                        df[column] = df[column].astype("category")
+        return df
+
+# Writes df to prefix + the extension of output_format and returns the path.
+def write_table(df, prefix, output_format="tsv"):
+        path = get_table_path(prefix, output_format)
+        if output_format == "tsv":
+                df.to_csv(path, index=None, sep='\t', na_rep="NA")
+        elif output_format == "parquet":
+                to_typed_frame(df).to_parquet(path, index=False, compression="zstd")
+        elif output_format == "feather":
+                to_typed_frame(df).reset_index(drop=True).to_feather(path, compression="zstd")
+        return path
+
+# Writes a binary table chunk by chunk (DataFrames with the same columns), so that it never is in memory as a whole.
+# Categorical columns have 32 bit dictionary indices in Parquet, and are plain strings in Feather, whose files cannot
+# have another dictionary in each chunk.
+class Table_Writer(object):
+        def __init__(self, prefix, output_format, columns):
+                self.prefix = prefix
+                self.output_format = output_format
+                self.path = get_table_path(prefix, output_format)
+                self.writer = None
+                self.schema = None
+                self.empty = pd.DataFrame([], columns=columns)
+
+        def get_schema(self, table):
+                import pyarrow
+                fields = []
+                for field in table.schema:
+                        if pyarrow.types.is_dictionary(field.type):
+                                value_type = field.type.value_type
+                                field = field.with_type(pyarrow.dictionary(pyarrow.int32(), value_type) if self.output_format == "parquet" else value_type)
+                        fields.append(field)
+                return pyarrow.schema(fields)
+
+        def write(self, df):
+                import pyarrow
+                if not len(df):
+                        # the types of empty columns are not known
+                        self.empty = df
+                        return
+                table = pyarrow.Table.from_pandas(to_typed_frame(df), preserve_index=False)
+                if self.writer is None:
+                        self.schema = self.get_schema(table)
+                        if self.output_format == "parquet":
+                                import pyarrow.parquet
+                                self.writer = pyarrow.parquet.ParquetWriter(self.path, self.schema, compression="zstd")
+                        else:
+                                import pyarrow.ipc
+                                self.writer = pyarrow.ipc.new_file(self.path, self.schema, options=pyarrow.ipc.IpcWriteOptions(compression="zstd"))
+                self.writer.write_table(table.cast(self.schema))
+
+        # Returns the path of the table.
+        def close(self):
+                if self.writer is None:
+                        return write_table(self.empty, self.prefix, self.output_format)
+                self.writer.close()
+                return self.path
+
+# Reads a table written by write_table. columns: read only these columns (all by default). Text tables are typed
+# like the binary ones, so the result is the same in every format. categorical: False leaves the IDs of text tables
+# strings, which is faster if they are not needed as categories.
+def read_table(path, columns=None, categorical=True):
+        output_format = get_format(path)
+        if output_format == "tsv":
+                text_columns = None
+                if columns is not None:
+                        # filter labels are in the metric column of text tables
+                        text_columns = [column[:-len("_filter")] if column.endswith("_filter") and column[:-len("_filter")] in FILTER_COLUMNS else column for column in columns]
+                        text_columns = list(dict.fromkeys(text_columns))
+                na_values = ["NA"]
+                if columns is not None and text_columns == columns:
+                        # the labels are not read, they are just NA
+                        na_values += FILTER_LABELS
+                df = pd.read_csv(path, sep="\t", usecols=text_columns, na_values=na_values, keep_default_na=False, float_precision="round_trip")
+                df = to_typed_frame(df, categorical)
+                if columns is not None:
+                        df = df[columns]
+                return df
+        elif output_format == "parquet":
+                return pd.read_parquet(path, columns=columns)
+        else:
+                return pd.read_feather(path, columns=columns)
+
+# Text of a metric value as a text table has it, "NA" for missing values and labels.
+def format_value(value):
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+                return "NA"
+        return repr(float(value))
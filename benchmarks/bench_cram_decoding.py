@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Compare the cost of reading the same alignments from BAM and from CRAM through the quant reader.
+
+Example:
+        python benchmarks/bench_cram_decoding.py -i sample.bam -c sample.cram -r genome.fa
+"""
+import os
+import sys
+import time
+import argparse as ap
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from IRTools.quant_reader import Alignment_Reader
+
+
+def time_reader(reader, repeat):
+        best = None
+        for i in range(repeat):
+                start_time = time.time()
+                n = 0
+                for alt in reader:
+                        if alt.aligned:
+                                # touch what quant touches: coordinates, CIGAR blocks and the NH tag
+                                [co.ref_iv for co in alt.cigar if co.type == "M"]
+                                dict(alt.optional_fields).get("NH", 1)
+                        n += 1
+                elapsed = time.time() - start_time
+                if best is None or elapsed < best:
+                        best = elapsed
+        return n, best
+
+
+class Full_Decode_CRAM_Reader(Alignment_Reader):
+        # CRAM read back with sequences and qualities, as samtools/HTSeq would do by default.
+        def open(self):
+                import pysam
+                verbosity = pysam.set_verbosity(0)
+                try:
+                        return pysam.AlignmentFile(self.filename, "rc", reference_filename=self.reference)
+                finally:
+                        pysam.set_verbosity(verbosity)
+
+
+def main():
+        argparser = ap.ArgumentParser(description="Benchmark BAM vs CRAM decoding in the IRTools quant reader.")
+        argparser.add_argument("-i", "--bam", dest="bam", type=str, required=True, help="BAM file.")
+        argparser.add_argument("-c", "--cram", dest="cram", type=str, required=True, help="The same alignments as CRAM.")
+        argparser.add_argument("-r", "--reference", dest="reference", type=str, required=True, help="Reference FASTA of the CRAM file.")
+        argparser.add_argument("--repeat", dest="repeat", type=int, default=3, help="Number of timed passes per format, the best is reported. DEFAULT: 3.")
+        args = argparser.parse_args()
+
+        readers = [("BAM", args.bam, Alignment_Reader(args.bam)),
+                   ("CRAM (full decode)", args.cram, Full_Decode_CRAM_Reader(args.cram, args.reference)),
+                   ("CRAM (quant fields)", args.cram, Alignment_Reader(args.cram, args.reference))]
+
+        print("{:<22}{:>14}{:>12}{:>12}{:>16}".format("format", "size (MB)", "records", "seconds", "records/sec"))
+        for label, filename, reader in readers:
+                n, elapsed = time_reader(reader, args.repeat)
+                size = os.path.getsize(filename) / 1024.0 / 1024.0
+                print("{:<22}{:>14.1f}{:>12}{:>12.2f}{:>16.0f}".format(label, size, n, elapsed, n / elapsed if elapsed > 0 else float("inf")))
+
+
+if __name__ == '__main__':
+        main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""Time IRTools annotation, quant (IRI/IRC, single/paired, counting and output stages) and diff on synthetic data.
+
+Synthetic inputs are generated once per configuration and cached in --data-dir. Each case runs in a fresh
+process so that peak memory and module state are not shared between cases. Results are written as JSON and,
+given --baseline, compared case by case against an earlier result file: a case whose time grows by more than
+--threshold is reported as a regression and the script exits with status 1.
+
+Examples:
+        python benchmarks/run_benchmarks.py --scales 1M -o results.json --save-baseline benchmarks/baseline.json
+        python benchmarks/run_benchmarks.py --scales 1M,10M,100M -o results.json --baseline benchmarks/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import platform
+import tempfile
+import argparse as ap
+import multiprocessing
+import importlib.util
+import importlib.machinery
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCHMARK_DIR, os.pardir)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+import synthetic
+
+RESULTS_VERSION = 1
+QUANT_CASES = [("IRI", "single"), ("IRI", "paired"), ("IRC", "single"), ("IRC", "paired")]
+DIFF_CASES = [("IRI", "U"), ("IRI", "P"), ("IRC", "U"), ("IRC", "P")]
+# Library type of the synthetic alignments (read 1 on the gene strand).
+LIBTYPE = "fr-secondstrand"
+
+
+def load_argparser():
+        # Arguments are parsed by the real command line parser, so new options get their defaults here too.
+        loader = importlib.machinery.SourceFileLoader("IRTools_cli", os.path.join(REPO_DIR, "bin", "IRTools"))
+        module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+        loader.exec_module(module)
+        return module.prepare_argparser()
+
+
+def parse_args(argv):
+        return load_argparser().parse_args(argv)
+
+
+class Timer(object):
+        def __enter__(self):
+                self.start_wall = time.time()
+                self.start_cpu = time.process_time()
+                return self
+
+        def __exit__(self, *exc):
+                self.wall_seconds = time.time() - self.start_wall
+                self.cpu_seconds = time.process_time() - self.start_cpu
+
+
+def bench_annotation(data):
+        from IRTools import annotation_cmd
+        args = parse_args(["annotation", "-g", data["gtf"], "-o", "annotation.gtf", "--outdir", data["workdir"]])
+        stages = {}
+        with Timer() as t:
+                annotation_cmd.run(args)
+        stages["run"] = t
+        return stages, None
+
+
+def bench_quant(data):
+        quanttype, readtype = data["quanttype"], data["readtype"]
+        args = parse_args(["quant", "-q", quanttype, "-i", data["bam"], "-p", readtype, "-s", LIBTYPE, "-g", data["annofile"],
+                           "-n", "bench", "--outdir", data["workdir"]])
+        stages = {}
+        if quanttype == "IRI":
+                from IRTools.quant_IRI import IRI_quant
+                with Timer() as t:
+                        quanter = IRI_quant(args)
+                stages["init"] = t
+                with Timer() as t:
+                        quanter.quant()
+                stages["quant"] = t
+                with Timer() as t:
+                        quanter.output_IRI_intron_level()
+                        quanter.output_IRI_gene_level()
+                        quanter.output_IRI_genome_wide()
+                stages["output"] = t
+        else:
+                from IRTools.quant_IRC import IRC_quant
+                with Timer() as t:
+                        quanter = IRC_quant(args)
+                stages["init"] = t
+                with Timer() as t:
+                        quanter.quant()
+                stages["quant"] = t
+                with Timer() as t:
+                        quanter.output_IRC_junction_level()
+                        quanter.output_IRC_intron_level()
+                        quanter.output_IRC_gene_level()
+                        quanter.output_IRC_genome_wide()
+                stages["output"] = t
+        return stages, quanter.records_processed
+
+
+def bench_diff(data):
+        from IRTools import diff_cmd
+        args = parse_args(["diff", "-q", data["quanttype"], "--indir", data["indir"], "-s1", ",".join(data["s1"]), "-s2", ",".join(data["s2"]),
+                           "-t", data["analysistype"], "-n", "bench", "--outdir", data["workdir"]])
+        stages = {}
+        with Timer() as t:
+                diff_cmd.run(args)
+        stages["run"] = t
+        return stages, None
+
+
+def quant_outputs(data):
+        # untimed quant run producing the replicate inputs of the diff benchmarks
+        bench_quant(data)
+
+
+BENCHMARKS = {"annotation": bench_annotation, "quant": bench_quant, "diff": bench_diff, "quant_outputs": quant_outputs}
+
+
+def run_case_worker(kind, data, connection):
+        from IRTools.metrics import peak_rss_mb
+        # IRTools prints progress on stdout; keep the benchmark report readable.
+        sys.stdout = open(os.devnull, "w")
+        logging.basicConfig(level=logging.WARNING)
+        try:
+                if not os.path.exists(data["workdir"]):
+                        os.makedirs(data["workdir"])
+                with Timer() as total:
+                        result = BENCHMARKS[kind](data)
+                if result is None:
+                        connection.send({})
+                        return
+                stages, reads = result
+                case = {"wall_seconds": total.wall_seconds,
+                        "cpu_seconds": total.cpu_seconds,
+                        "peak_rss_mb": peak_rss_mb(),
+                        "stages": dict((name, {"wall_seconds": t.wall_seconds, "cpu_seconds": t.cpu_seconds}) for name, t in stages.items())}
+                if reads is not None:
+                        case["reads_processed"] = reads
+                        case["reads_per_second"] = reads / stages["quant"].wall_seconds if stages["quant"].wall_seconds > 0 else None
+                connection.send(case)
+        except Exception as e:
+                connection.send({"error": "{}: {}".format(type(e).__name__, e)})
+                raise
+
+
+def run_case(kind, data):
+        context = multiprocessing.get_context("spawn")
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=run_case_worker, args=(kind, data, sender))
+        process.start()
+        sender.close()
+        try:
+                result = receiver.recv()
+        except EOFError:
+                result = {"error": "benchmark process died (exit code {})".format(process.exitcode)}
+        process.join()
+        if "error" in result:
+                raise Exception("Benchmark {} failed: {}".format(kind, result["error"]))
+        return result
+
+
+def best_of(kind, data, repeat):
+        best = None
+        for i in range(repeat):
+                result = run_case(kind, data)
+                if best is None or result["wall_seconds"] < best["wall_seconds"]:
+                        best = result
+        best["repeat"] = repeat
+        return best
+
+
+def get_dataset(args, genes, chrom_sizes, name, n_fragments, paired, seed, **fragment_options):
+        # Cached by every parameter that changes the file.
+        key = "{}.genes{}.reads{}.{}.seed{}.rl{}.ir{}.sp{}.mm{}{}".format(
+                name, args.genes, n_fragments, "paired" if paired else "single", seed, args.read_length, args.ir_rate,
+                args.splice_rate, args.multimap_rate, ".boost{}".format(args.diff_effect) if fragment_options.get("ir_multiplier") else "")
+        filename = os.path.join(args.data_dir, key + ".bam")
+        if not os.path.exists(filename):
+                logging.info("Generating {}".format(filename))
+                # Paired-end quant needs the mates of each read pair next to each other.
+                synthetic.write_bam(genes, chrom_sizes, filename + ".tmp.bam", n_fragments, paired=paired,
+                                    sort_order="queryname" if paired else "coordinate", seed=seed, threads=args.threads,
+                                    read_length=args.read_length, ir_rate=args.ir_rate, splice_rate=args.splice_rate,
+                                    multimap_rate=args.multimap_rate, **fragment_options)
+                os.replace(filename + ".tmp.bam", filename)
+                if os.path.exists(filename + ".tmp.bam.bai"):
+                        os.replace(filename + ".tmp.bam.bai", filename + ".bai")
+        return filename
+
+
+def compare_with_baseline(results, baseline, threshold):
+        regressions = []
+        print("\n{:<36}{:>14}{:>14}{:>10}".format("case", "baseline (s)", "current (s)", "change"))
+        for key, case in results["cases"].items():
+                if key not in baseline["cases"]:
+                        print("{:<36}{:>14}{:>14.2f}{:>10}".format(key, "-", case["wall_seconds"], "new"))
+                        continue
+                base_seconds = baseline["cases"][key]["wall_seconds"]
+                change = case["wall_seconds"] / base_seconds - 1.0 if base_seconds > 0 else 0.0
+                flag = ""
+                if change > threshold:
+                        regressions.append(key)
+                        flag = "  REGRESSION"
+                print("{:<36}{:>14.2f}{:>14.2f}{:>+9.1f}%{}".format(key, base_seconds, case["wall_seconds"], change * 100, flag))
+        return regressions
+
+
+def main():
+        argparser = ap.ArgumentParser(description="Benchmark IRTools on synthetic gene models and alignments.")
+        argparser.add_argument("--scales", dest="scales", type=str, default="1M",
+                               help="Comma-separated numbers of reads (single-end) / read pairs (paired-end) for the quant benchmarks, with k/M suffixes. DEFAULT: 1M.")
+        argparser.add_argument("--genes", dest="genes", type=synthetic.parse_count, default=5000, help="Number of synthetic genes. DEFAULT: 5000.")
+        argparser.add_argument("--read-length", dest="read_length", type=int, default=76, help="DEFAULT: 76.")
+        argparser.add_argument("--ir-rate", dest="ir_rate", type=float, default=0.05, help="Mean fraction of intronic fragments. DEFAULT: 0.05.")
+        argparser.add_argument("--splice-rate", dest="splice_rate", type=float, default=0.25, help="Fraction of fragments crossing a splice junction. DEFAULT: 0.25.")
+        argparser.add_argument("--multimap-rate", dest="multimap_rate", type=float, default=0.05, help="Fraction of multi-mapped fragments. DEFAULT: 0.05.")
+        argparser.add_argument("--diff-reads", dest="diff_reads", type=synthetic.parse_count, default=200000,
+                               help="Reads per replicate of the diff benchmarks (3 replicates per condition). DEFAULT: 200k.")
+        argparser.add_argument("--diff-effect", dest="diff_effect", type=float, default=3.0,
+                               help="Intron retention fold change of 10%% of the genes in condition 2 of the diff benchmarks. DEFAULT: 3.")
+        argparser.add_argument("--cases", dest="cases", type=str, default="annotation,quant,diff",
+                               help="Comma-separated benchmark groups to run: annotation, quant, diff. DEFAULT: all.")
+        argparser.add_argument("--repeat", dest="repeat", type=int, default=1, help="Timed runs per case, the fastest is kept. DEFAULT: 1.")
+        argparser.add_argument("--seed", dest="seed", type=int, default=0, help="DEFAULT: 0.")
+        argparser.add_argument("--threads", dest="threads", type=int, default=2, help="Threads for writing and sorting synthetic BAM files. DEFAULT: 2.")
+        argparser.add_argument("--data-dir", dest="data_dir", type=str, default=os.path.join(tempfile.gettempdir(), "IRTools_benchmarks"),
+                               help="Cache directory for synthetic inputs and scratch outputs. DEFAULT: $TMPDIR/IRTools_benchmarks.")
+        argparser.add_argument("-o", "--output", dest="output", type=str, default="benchmark_results.json", help="Results JSON file. DEFAULT: benchmark_results.json.")
+        argparser.add_argument("--baseline", dest="baseline", type=str, help="Results JSON file of an earlier run to compare against.")
+        argparser.add_argument("--threshold", dest="threshold", type=float, default=0.10,
+                               help="Fractional slow-down over the baseline reported as a regression. DEFAULT: 0.10.")
+        argparser.add_argument("--save-baseline", dest="save_baseline", type=str, help="Also write the results to this file, to be used as --baseline later.")
+        args = argparser.parse_args()
+
+        logging.basicConfig(level=logging.INFO, format='[%(asctime)s]: %(message)s ', datefmt='%Y-%m-%d %H:%M:%S')
+        groups = args.cases.split(",")
+        scales = [(scale.strip(), synthetic.parse_count(scale)) for scale in args.scales.split(",")]
+        if not os.path.exists(args.data_dir):
+                os.makedirs(args.data_dir)
+        workdir = os.path.join(args.data_dir, "work")
+
+        from IRTools.Constants import IRTools_VERSION
+        results = {"version": RESULTS_VERSION,
+                   "irtools_version": IRTools_VERSION,
+                   "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "host": socket.gethostname(),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "config": dict((key, value) for key, value in vars(args).items() if key not in ("output", "baseline", "save_baseline", "data_dir")),
+                   "cases": {}}
+
+        genes, chrom_sizes = synthetic.generate_gene_models(args.genes, seed=args.seed)
+        gtf = os.path.join(args.data_dir, "genes{}.seed{}.gtf".format(args.genes, args.seed))
+        synthetic.write_gtf(genes, gtf)
+
+        # The IR annotation is needed by quant and diff whether or not it is benchmarked.
+        annofile = os.path.join(workdir, "annotation.gtf")
+        data = {"gtf": gtf, "workdir": workdir}
+        if "annotation" in groups:
+                logging.info("Benchmarking annotation ({} genes)".format(args.genes))
+                results["cases"]["annotation"] = best_of("annotation", data, args.repeat)
+        elif not os.path.exists(annofile):
+                run_case("annotation", data)
+
+        if "quant" in groups:
+                for label, n_reads in scales:
+                        for quanttype, readtype in QUANT_CASES:
+                                bam = get_dataset(args, genes, chrom_sizes, "quant", n_reads, readtype == "paired", args.seed)
+                                key = "quant/{}/{}/{}".format(label, quanttype, readtype)
+                                logging.info("Benchmarking {}".format(key))
+                                data = {"bam": bam, "annofile": annofile, "quanttype": quanttype, "readtype": readtype, "workdir": workdir}
+                                results["cases"][key] = best_of("quant", data, args.repeat)
+
+        if "diff" in groups:
+                diff_indir = os.path.join(args.data_dir, "diff_inputs.genes{}.reads{}.effect{}".format(args.genes, args.diff_reads, args.diff_effect))
+                boosted = dict((gene.gene_id, args.diff_effect) for gene in genes[::10])
+                s1, s2 = ["S1_rep1", "S1_rep2", "S1_rep3"], ["S2_rep1", "S2_rep2", "S2_rep3"]
+                for i, name in enumerate(s1 + s2):
+                        replicate_seed = args.seed + 1 + i
+                        options = {"ir_multiplier": boosted} if name in s2 else {}
+                        bam = get_dataset(args, genes, chrom_sizes, "diff", args.diff_reads, False, replicate_seed, **options)
+                        for quanttype in ("IRI", "IRC"):
+                                if not os.path.exists(os.path.join(diff_indir, "{}.quant.{}.genes.txt".format(name, quanttype))):
+                                        data = {"bam": bam, "annofile": annofile, "quanttype": quanttype, "readtype": "single", "workdir": diff_indir}
+                                        run_case("quant_outputs", data)
+                                        for suffix in ("introns", "genes", "junctions"):
+                                                source = os.path.join(diff_indir, "bench.quant.{}.{}.txt".format(quanttype, suffix))
+                                                if os.path.exists(source):
+                                                        os.replace(source, os.path.join(diff_indir, "{}.quant.{}.{}.txt".format(name, quanttype, suffix)))
+                for quanttype, analysistype in DIFF_CASES:
+                        key = "diff/{}/{}".format(quanttype, analysistype)
+                        logging.info("Benchmarking {}".format(key))
+                        data = {"quanttype": quanttype, "analysistype": analysistype, "indir": diff_indir, "s1": s1, "s2": s2, "workdir": workdir}
+                        results["cases"][key] = best_of("diff", data, args.repeat)
+
+        print("\n{:<36}{:>12}{:>12}{:>14}{:>16}".format("case", "wall (s)", "CPU (s)", "peak RSS (MB)", "reads/sec"))
+        for key, case in results["cases"].items():
+                reads_per_second = "{:.0f}".format(case["reads_per_second"]) if case.get("reads_per_second") else "-"
+                print("{:<36}{:>12.2f}{:>12.2f}{:>14.1f}{:>16}".format(key, case["wall_seconds"], case["cpu_seconds"], case["peak_rss_mb"], reads_per_second))
+
+        for filename in [args.output, args.save_baseline]:
+                if filename:
+                        with open(filename, "w") as f:
+                                json.dump(results, f, indent=2, sort_keys=True)
+                        logging.info("Benchmark results written to {}".format(filename))
+
+        if args.baseline:
+                with open(args.baseline) as f:
+                        baseline = json.load(f)
+                regressions = compare_with_baseline(results, baseline, args.threshold)
+                if regressions:
+                        print("\n{} case(s) slower than the baseline by more than {:.0f}%: {}".format(len(regressions), args.threshold * 100, ", ".join(regressions)))
+                        sys.exit(1)
+                print("\nNo regressions over {:.0f}%.".format(args.threshold * 100))
+
+
+if __name__ == '__main__':
+        main()
@@ -0,0 +1,250 @@
+"""Synthetic gene models and RNA-Seq alignments for the IRTools benchmarks.
+
+Everything is driven by a seed, so the same parameters always produce the same GTF and BAM files.
+
+Example:
+        python benchmarks/synthetic.py --genes 2000 --reads 1000000 --read-type paired -o /tmp/synthetic
+"""
+import os
+import random
+import logging
+import argparse as ap
+import collections
+
+GENES_PER_CHROM = 2000
+MIN_OVERLAP = 8
+
+# One gene: exons of each transcript are (start, end) half-open, 0-based and in ascending order.
+# expression and ir_weight are relative; they make a few genes much deeper than the rest
+# (as in real libraries) and intron retention vary from gene to gene.
+Gene = collections.namedtuple("Gene", ["gene_id", "chrom", "strand", "start", "end", "transcripts", "expression", "ir_weight"])
+
+
+def generate_gene_models(n_genes, seed=0, genes_per_chrom=GENES_PER_CHROM):
+        rng = random.Random(seed)
+        genes = []
+        chrom_sizes = collections.OrderedDict()
+        for i in range(n_genes):
+                chrom = "chr{}".format(i // genes_per_chrom + 1)
+                pos = chrom_sizes.get(chrom, 0) + rng.randint(2000, 20000)
+
+                exons = []
+                for e in range(rng.randint(3, 10)):
+                        length = rng.randint(100, 400)
+                        exons.append((pos, pos + length))
+                        pos += length + int(rng.lognormvariate(7, 0.8)) + 100
+                gene_end = exons[-1][1]
+
+                transcripts = [exons]
+                # exon skipping
+                if len(exons) >= 4 and rng.random() < 0.5:
+                        skipped = rng.randint(1, len(exons) - 2)
+                        transcripts.append(exons[:skipped] + exons[skipped + 1:])
+                # alternative 5' splice site on the second exon
+                if rng.random() < 0.3:
+                        shift = rng.randint(10, 60)
+                        transcripts.append([exons[0], (exons[1][0] + shift, exons[1][1])] + exons[2:])
+
+                genes.append(Gene("G{:06d}".format(i), chrom, "+-"[i % 2], exons[0][0], gene_end, transcripts,
+                                  rng.lognormvariate(0, 1.5), rng.lognormvariate(0, 1)))
+                chrom_sizes[chrom] = gene_end
+        for chrom in chrom_sizes:
+                chrom_sizes[chrom] += 20000
+        return genes, chrom_sizes
+
+
+def write_gtf(genes, filename):
+        with open(filename, "w") as f:
+                for gene in genes:
+                        for t, exons in enumerate(gene.transcripts):
+                                for start, end in exons:
+                                        f.write('{}\tsynthetic\texon\t{}\t{}\t.\t{}\t.\tgene_id "{}"; transcript_id "{}.{}";\n'.format(
+                                                gene.chrom, start + 1, end, gene.strand, gene.gene_id, gene.gene_id, t + 1))
+        logging.info("Wrote {} synthetic genes to {}".format(len(genes), filename))
+
+
+# Genomic blocks covered by "length" bases starting "offset" bases into the concatenated segments.
+def map_blocks(segments, offset, length):
+        blocks = []
+        for start, end in segments:
+                size = end - start
+                if offset >= size:
+                        offset -= size
+                        continue
+                block_start = start + offset
+                block_end = min(end, block_start + length)
+                blocks.append((block_start, block_end))
+                length -= block_end - block_start
+                offset = 0
+                if length == 0:
+                        break
+        return blocks
+
+
+def cigar_of(blocks):
+        cigar = [(0, blocks[0][1] - blocks[0][0])]
+        for previous, block in zip(blocks, blocks[1:]):
+                cigar.append((3, block[0] - previous[1]))
+                cigar.append((0, block[1] - block[0]))
+        return cigar
+
+
+class Fragment_Generator(object):
+        """Draws RNA fragments from the gene models.
+
+        A fragment is intronic (a retained intron, read from the unspliced gene) with probability
+        ir_rate * gene.ir_weight, crosses a splice junction with probability splice_rate, and otherwise
+        lies within an exon. With probability multimap_rate it also gets a secondary alignment in another gene.
+        """
+        def __init__(self, genes, seed=0, read_length=76, fragment_length=250, ir_rate=0.05, splice_rate=0.25, multimap_rate=0.05, ir_multiplier=None):
+                self.genes = genes
+                self.rng = random.Random(seed)
+                self.read_length = read_length
+                self.fragment_length = fragment_length
+                self.ir_rate = ir_rate
+                self.splice_rate = splice_rate
+                self.multimap_rate = multimap_rate
+                self.ir_multiplier = ir_multiplier or {}
+                self.cum_weights = []
+                total = 0.0
+                for gene in genes:
+                        total += gene.expression
+                        self.cum_weights.append(total)
+
+        def draw_genes(self, n):
+                return self.rng.choices(self.genes, cum_weights=self.cum_weights, k=n)
+
+        # (segments, offset, size) of one fragment from gene
+        def draw_fragment(self, gene, paired, exonic_only=False):
+                rng = self.rng
+                size = rng.randint(self.fragment_length - 30, self.fragment_length + 30) if paired else self.read_length
+                exons = rng.choice(gene.transcripts)
+                u = rng.random()
+                ir_rate = min(self.ir_rate * gene.ir_weight * self.ir_multiplier.get(gene.gene_id, 1.0), 0.9)
+                if not exonic_only and u < ir_rate:
+                        segments = [(gene.start, gene.end)]
+                        i = rng.randrange(len(exons) - 1)
+                        intron_start, intron_end = exons[i][1], exons[i + 1][0]
+                        offset = rng.randint(intron_start - size // 2, intron_end - size // 2) - gene.start
+                        return segments, max(0, min(offset, gene.end - gene.start - size)), size
+
+                lengths = [end - start for start, end in exons]
+                transcript_length = sum(lengths)
+                size = min(size, transcript_length)
+                if not exonic_only and u < ir_rate + self.splice_rate:
+                        junction = sum(lengths[:rng.randrange(len(exons) - 1) + 1])
+                        offset = junction - rng.randint(MIN_OVERLAP, size - MIN_OVERLAP)
+                else:
+                        i = rng.choices(range(len(exons)), weights=lengths)[0]
+                        exon_offset = sum(lengths[:i])
+                        offset = exon_offset + rng.randint(0, max(0, lengths[i] - size))
+                return exons, max(0, min(offset, transcript_length - size)), size
+
+        # Alignments of fragment number i as (name, chrom, blocks, flag, mate blocks, tags) tuples.
+        # Mates are placed forward/reverse as in an fr-secondstrand library: read 1 is on the strand of the gene.
+        def alignments(self, i, gene, paired):
+                name = "frag{:010d}".format(i)
+                placements = [(gene, self.draw_fragment(gene, paired))]
+                if self.rng.random() < self.multimap_rate:
+                        other = self.genes[self.rng.randrange(len(self.genes))]
+                        placements.append((other, self.draw_fragment(other, paired, exonic_only=True)))
+                nh = len(placements)
+                records = []
+                for hit, (hit_gene, (segments, offset, size)) in enumerate(placements):
+                        secondary = 0x100 if hit > 0 else 0
+                        tags = [("NH", nh), ("HI", hit + 1)]
+                        left = map_blocks(segments, offset, self.read_length if paired else size)
+                        if not paired:
+                                records.append((name, hit_gene.chrom, left, secondary | (0x10 if hit_gene.strand == "-" else 0), None, tags))
+                                continue
+                        right = map_blocks(segments, offset + size - self.read_length, self.read_length)
+                        first_left = 0x40 if hit_gene.strand == "+" else 0x80
+                        first_right = 0x80 if hit_gene.strand == "+" else 0x40
+                        records.append((name, hit_gene.chrom, left, secondary | 0x1 | 0x2 | 0x20 | first_left, right, tags))
+                        records.append((name, hit_gene.chrom, right, secondary | 0x1 | 0x2 | 0x10 | first_right, left, tags))
+                return records
+
+
+def write_bam(genes, chrom_sizes, filename, n_fragments, paired=False, sort_order="coordinate", seed=0, threads=1, chunk=100000, **fragment_options):
+        """Write n_fragments reads (single-end) or read pairs (paired-end) to a BAM file.
+
+        sort_order is "coordinate" (sorted with samtools and indexed) or "queryname" (mates and secondary
+        alignments of one fragment are adjacent, which is what quant expects for paired-end input).
+        """
+        import pysam
+        chroms = list(chrom_sizes.keys())
+        chrom_index = dict((chrom, i) for i, chrom in enumerate(chroms))
+        header = pysam.AlignmentHeader.from_dict({"HD": {"VN": "1.6", "SO": "queryname" if sort_order == "queryname" else "unsorted"},
+                                                 "SQ": [{"SN": chrom, "LN": chrom_sizes[chrom]} for chrom in chroms],
+                                                 "PG": [{"ID": "synthetic", "PN": "IRTools benchmarks"}]})
+        generator = Fragment_Generator(genes, seed=seed, **fragment_options)
+        read_length = generator.read_length
+        sequence_rng = random.Random(seed)
+        sequence = "".join(sequence_rng.choice("ACGT") for i in range(read_length))
+        qualities = pysam.qualitystring_to_array("I" * read_length)
+
+        unsorted = filename + ".unsorted.bam" if sort_order == "coordinate" else filename
+        with pysam.AlignmentFile(unsorted, "wb", header=header, threads=threads) as out:
+                for chunk_start in range(0, n_fragments, chunk):
+                        chunk_genes = generator.draw_genes(min(chunk, n_fragments - chunk_start))
+                        for j, gene in enumerate(chunk_genes):
+                                for name, chrom, blocks, flag, mate_blocks, tags in generator.alignments(chunk_start + j, gene, paired):
+                                        a = pysam.AlignedSegment(header)
+                                        a.query_name = name
+                                        a.flag = flag
+                                        a.reference_id = chrom_index[chrom]
+                                        a.reference_start = blocks[0][0]
+                                        a.mapping_quality = 255 if tags[0][1] == 1 else 3
+                                        a.cigartuples = cigar_of(blocks)
+                                        a.query_sequence = sequence
+                                        a.query_qualities = qualities
+                                        if mate_blocks is not None:
+                                                a.next_reference_id = a.reference_id
+                                                a.next_reference_start = mate_blocks[0][0]
+                                                span = max(blocks[-1][1], mate_blocks[-1][1]) - min(blocks[0][0], mate_blocks[0][0])
+                                                a.template_length = span if blocks[0][0] <= mate_blocks[0][0] else -span
+                                        a.set_tags(tags)
+                                        out.write(a)
+
+        if sort_order == "coordinate":
+                pysam.sort("-@", str(threads), "-o", filename, unsorted)
+                os.remove(unsorted)
+                pysam.index(filename)
+        logging.info("Wrote {} synthetic {} fragments to {}".format(n_fragments, "paired-end" if paired else "single-end", filename))
+
+
+def parse_count(value):
+        value = value.strip()
+        suffixes = {"k": 1000, "K": 1000, "m": 1000000, "M": 1000000, "g": 1000000000, "G": 1000000000}
+        if value[-1] in suffixes:
+                return int(float(value[:-1]) * suffixes[value[-1]])
+        return int(value)
+
+
+def main():
+        argparser = ap.ArgumentParser(description="Generate synthetic gene models (GTF) and RNA-Seq alignments (BAM) for benchmarking IRTools.")
+        argparser.add_argument("-o", "--outdir", dest="outdir", type=str, required=True, help="Output directory.")
+        argparser.add_argument("--genes", dest="genes", type=parse_count, default=2000, help="Number of genes. DEFAULT: 2000.")
+        argparser.add_argument("--reads", dest="reads", type=parse_count, default=1000000, help="Number of reads (single-end) or read pairs (paired-end); accepts k/M suffixes. DEFAULT: 1M.")
+        argparser.add_argument("--read-type", dest="readtype", choices=("single", "paired"), default="single", help="DEFAULT: single.")
+        argparser.add_argument("--sort-order", dest="sort_order", choices=("coordinate", "queryname"), default="coordinate", help="DEFAULT: coordinate.")
+        argparser.add_argument("--read-length", dest="read_length", type=int, default=76, help="DEFAULT: 76.")
+        argparser.add_argument("--ir-rate", dest="ir_rate", type=float, default=0.05, help="Mean fraction of intronic (retained intron) fragments. DEFAULT: 0.05.")
+        argparser.add_argument("--splice-rate", dest="splice_rate", type=float, default=0.25, help="Fraction of fragments crossing a splice junction. DEFAULT: 0.25.")
+        argparser.add_argument("--multimap-rate", dest="multimap_rate", type=float, default=0.05, help="Fraction of fragments with a secondary alignment (NH=2). DEFAULT: 0.05.")
+        argparser.add_argument("--seed", dest="seed", type=int, default=0, help="DEFAULT: 0.")
+        argparser.add_argument("--threads", dest="threads", type=int, default=1, help="BAM compression and sorting threads. DEFAULT: 1.")
+        args = argparser.parse_args()
+
+        logging.basicConfig(level=logging.INFO, format='[%(asctime)s]: %(message)s ', datefmt='%Y-%m-%d %H:%M:%S')
+        if not os.path.exists(args.outdir):
+                os.makedirs(args.outdir)
+        genes, chrom_sizes = generate_gene_models(args.genes, seed=args.seed)
+        write_gtf(genes, os.path.join(args.outdir, "genes.gtf"))
+        write_bam(genes, chrom_sizes, os.path.join(args.outdir, "{}.bam".format(args.readtype)), args.reads,
+                  paired=args.readtype == "paired", sort_order=args.sort_order, seed=args.seed, threads=args.threads,
+                  read_length=args.read_length, ir_rate=args.ir_rate, splice_rate=args.splice_rate, multimap_rate=args.multimap_rate)
+
+
+if __name__ == '__main__':
+        main()
@@ -38,6 +38,8 @@ def main():
                       'bx-python',
                       'HTSeq==0.13.5',
                       'pysam==0.19.1'],
+              extras_require={
+                      'columnar': ['pyarrow']},
               )
 
 if __name__ == '__main__':
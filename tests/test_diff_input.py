@@ -0,0 +1,24 @@
+import os
+import tempfile
+import unittest
+from IRTools.diff_input import get_groups
+
+class Sample_Sheet_Test(unittest.TestCase):
+        def write_sheet(self, text):
+                f = tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False)
+                f.write(text)
+                f.close()
+                self.addCleanup(os.remove, f.name)
+                return f.name
+
+        def test_groups_in_order_of_the_sheet(self):
+                sheet = self.write_sheet("# replicate group\nrep1\tB\nrep2,A\nrep3 B\n")
+                self.assertEqual(get_groups({'sample_sheet': sheet}), [("B", ["rep1", "rep3"]), ("A", ["rep2"])])
+
+        def test_replicate_listed_twice(self):
+                sheet = self.write_sheet("rep1\tA\nrep2\tA\nrep1\tB\n")
+                with self.assertRaisesRegex(Exception, "Line 3 of sample sheet file .* lists replicate rep1 again"):
+                        get_groups({'sample_sheet': sheet})
+
+if __name__ == "__main__":
+        unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+
+import numpy as np
+import scipy.optimize
+import scipy.special
+import scipy.stats
+
+from IRTools.diff_stats import beta_binomial_test
+
+# Log-likelihood of a beta-binomial model with a mean (logit) for each group and a shared log precision, without the
+# binomial coefficients (which cancel in the likelihood ratio).
+def loglik(params, retained, total, groups):
+        means = scipy.special.expit(params[:-1])[groups]
+        precision = np.exp(params[-1])
+        alpha, beta = means * precision, (1 - means) * precision
+        return np.sum(scipy.special.betaln(retained + alpha, total - retained + beta) - scipy.special.betaln(alpha, beta))
+
+# Maximum likelihood by scipy.optimize.minimize, from a few starting precisions.
+def fit(retained, total, groups):
+        logits = [scipy.special.logit((retained[groups == group].sum() + 0.5) / (total[groups == group].sum() + 1)) for group in range(groups.max() + 1)]
+        best = None
+        for log_precision in (0.0, 3.0, 8.0):
+                result = scipy.optimize.minimize(lambda params: -loglik(params, retained, total, groups), logits + [log_precision], method="Nelder-Mead",
+                                                 options={"xatol": 1e-10, "fatol": 1e-12, "maxiter": 20000, "maxfev": 20000})
+                if best is None or result.fun < best.fun:
+                        best = result
+        return -best.fun, best.x
+
+def reference_test(retained, total, groups):
+        full_loglik, full_params = fit(retained, total, groups)
+        null_loglik, null_params = fit(retained, total, np.zeros_like(groups))
+        return scipy.stats.chi2.sf(max(2 * (full_loglik - null_loglik), 0), groups.max()), scipy.special.expit(full_params[:-1])
+
+class Beta_Binomial_Test(unittest.TestCase):
+        def test_matches_scipy_minimize(self):
+                rng = np.random.default_rng(1)
+                for replicates in ([3, 3], [4, 5], [3, 3, 4]):
+                        groups = np.repeat(np.arange(len(replicates)), replicates)
+                        for row in range(4):
+                                total = rng.integers(20, 200, size=len(groups))
+                                means = rng.uniform(0.05, 0.6, size=len(replicates))[groups]
+                                retained = rng.binomial(total, rng.beta(means * 20, (1 - means) * 20))
+                                pvals, fitted_means = beta_binomial_test([(retained[None, groups == group], total[None, groups == group]) for group in range(len(replicates))])
+                                reference_pval, reference_means = reference_test(retained, total, groups)
+                                self.assertAlmostEqual(np.log10(pvals[0]), np.log10(reference_pval), delta=1e-3)
+                                np.testing.assert_allclose(fitted_means[0], reference_means, atol=1e-4)
+
+        def test_rows_not_tested(self):
+                # one replicate with reads in the first group; the same IRC in all replicates
+                retained = np.array([[3, 0, 0, 4, 5, 6], [2, 4, 6, 1, 3, 5]])
+                total = np.array([[10, 0, 0, 20, 20, 20], [10, 20, 30, 5, 15, 25]])
+                pvals, means = beta_binomial_test([(retained[:, :3], total[:, :3]), (retained[:, 3:], total[:, 3:])])
+                self.assertTrue(np.isnan(pvals).all())
+                self.assertTrue(np.isnan(means).all())
+
+        def test_groups_without_or_with_only_retained_reads(self):
+                retained = np.array([[0, 0, 0, 4, 9, 6], [10, 20, 30, 4, 9, 6]])
+                total = np.array([[10, 20, 30, 20, 25, 20], [10, 20, 30, 20, 25, 20]])
+                pvals, means = beta_binomial_test([(retained[:, :3], total[:, :3]), (retained[:, 3:], total[:, 3:])])
+                self.assertTrue(np.isfinite(pvals).all())
+                self.assertEqual(means[0, 0], 0)
+                self.assertEqual(means[1, 0], 1)
+                self.assertTrue((means[:, 1] > 0).all() and (means[:, 1] < 1).all())
+
+if __name__ == "__main__":
+        unittest.main()
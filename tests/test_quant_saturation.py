@@ -0,0 +1,89 @@
+import os
+import re
+import sys
+import random
+import subprocess
+import tempfile
+import unittest
+
+import pandas as pd
+import pysam
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+READ_LENGTH = 50
+# Two genes of three exons on chr1
+EXONS = [[(1001, 1200), (2001, 2200), (3001, 3200)], [(6001, 6200), (7001, 7200), (8001, 8200)]]
+
+def write_annotation(filename):
+        with open(filename, "w") as f:
+                for gene, exons in enumerate(EXONS):
+                        for start, end in exons:
+                                f.write('chr1\ttest\texon\t{}\t{}\t.\t+\t.\tgene_id "G{}"; transcript_id "G{}.t1";\n'.format(start, end, gene, gene))
+
+# Writes exonic and intronic reads; some are multi-mapped, unmapped or on a contig that is not a chromosome, which quant
+# does not count. Returns the number of reads quant counts.
+def write_alignments(filename):
+        random.seed(0)
+        header = {'HD': {'VN': '1.0', 'SO': 'unsorted'}, 'SQ': [{'SN': 'chr1', 'LN': 10000}, {'SN': 'scaffold1', 'LN': 10000}]}
+        counted = 0
+        with pysam.AlignmentFile(filename, "wb", header=header) as out:
+                for i in range(400):
+                        exons = random.choice(EXONS)
+                        start = random.randint(exons[0][0], exons[-1][1] - READ_LENGTH)
+                        read = pysam.AlignedSegment()
+                        read.query_name = "r{}".format(i)
+                        read.query_sequence = "A" * READ_LENGTH
+                        read.query_qualities = pysam.qualitystring_to_array("I" * READ_LENGTH)
+                        kind = i % 10
+                        if kind == 0:
+                                read.flag = 4
+                        else:
+                                read.reference_id = 1 if kind == 1 else 0
+                                read.reference_start = start - 1
+                                read.cigartuples = [(0, READ_LENGTH)]
+                                read.mapping_quality = 60
+                                read.set_tags([('NH', 2 if kind == 2 else 1)])
+                                if kind > 2:
+                                        counted += 1
+                        out.write(read)
+        return counted
+
+class Saturation_Read_Count_Test(unittest.TestCase):
+        @classmethod
+        def setUpClass(cls):
+                cls.directory = tempfile.TemporaryDirectory()
+                cls.bam = os.path.join(cls.directory.name, "reads.bam")
+                write_annotation(os.path.join(cls.directory.name, "genes.gtf"))
+                cls.counted = write_alignments(cls.bam)
+                cls.run_irtools("annotation", "-g", os.path.join(cls.directory.name, "genes.gtf"), "-o", "anno.gtf", "--outdir", cls.directory.name)
+
+        @classmethod
+        def tearDownClass(cls):
+                cls.directory.cleanup()
+
+        @staticmethod
+        def run_irtools(*args):
+                env = dict(os.environ, PYTHONPATH=REPO)
+                command = [sys.executable, os.path.join(REPO, "bin", "IRTools")] + list(args)
+                return subprocess.run(command, env=env, capture_output=True, text=True, check=True)
+
+        def run_saturation(self, quanttype):
+                result = self.run_irtools("quant", "-q", quanttype, "-i", self.bam, "-p", "single", "-s", "fr-secondstrand", "-g", os.path.join(self.directory.name, "anno.gtf"),
+                                          "-n", "s", "--outdir", self.directory.name, "--saturation", "50,100")
+                summary = pd.read_csv(os.path.join(self.directory.name, "s.quant.{}.saturation.txt".format(quanttype)), sep="\t")
+                return result, summary
+
+        def test_IRI_full_depth_read_count_is_the_total_read_count(self):
+                result, summary = self.run_saturation("IRI")
+                total = int(re.search(r"Total read count: (\d+)", result.stdout).group(1))
+                self.assertEqual(total, self.counted)
+                self.assertEqual(summary["read_count"].tolist()[-1], total)
+                self.assertLess(summary["read_count"].tolist()[0], total)
+
+        def test_IRC_full_depth_read_count_is_the_quantified_read_count(self):
+                result, summary = self.run_saturation("IRC")
+                self.assertEqual(summary["read_count"].tolist()[-1], self.counted)
+
+if __name__ == "__main__":
+        unittest.main()
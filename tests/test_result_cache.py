@@ -0,0 +1,55 @@
+import os
+import sys
+import subprocess
+import tempfile
+import unittest
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# IRI values of three replicates per sample, intron and gene level
+VALUES = {"introns": ("CIR_id", "intron_IRI"), "genes": ("gene_id", "gene_IRI")}
+
+def write_quant_files(indir):
+        for replicate in range(6):
+                for level, (id_column, metric) in VALUES.items():
+                        with open(os.path.join(indir, "rep{}.quant.IRI.{}.txt".format(replicate, level)), "w") as f:
+                                f.write(id_column + "\t" + metric + "\n")
+                                for id in range(20):
+                                        f.write("ID{}\t{!r}\n".format(id, 0.1 * ((id * 7 + replicate * 3) % 11) + (0.5 if replicate >= 3 and id < 5 else 0)))
+
+class Diff_Cache_Test(unittest.TestCase):
+        def setUp(self):
+                self.directory = tempfile.TemporaryDirectory()
+                self.indir = os.path.join(self.directory.name, "in")
+                self.outdir = os.path.join(self.directory.name, "out")
+                os.makedirs(self.indir)
+                write_quant_files(self.indir)
+
+        def tearDown(self):
+                self.directory.cleanup()
+
+        def run_diff(self, *args):
+                env = dict(os.environ, PYTHONPATH=REPO)
+                command = [sys.executable, os.path.join(REPO, "bin", "IRTools"), "diff", "--indir", self.indir, "-s1", "rep0,rep1,rep2", "-s2", "rep3,rep4,rep5",
+                           "-n", "d", "--outdir", self.outdir, "--cache-dir", os.path.join(self.directory.name, "cache")] + list(args)
+                return subprocess.run(command, env=env, capture_output=True, text=True, check=True)
+
+        def test_keep_intermediate_is_not_restored_from_a_plain_run(self):
+                self.run_diff()
+                self.assertFalse(os.path.exists(os.path.join(self.outdir, "temp", "d.diff.input.IRI.introns.txt")))
+                result = self.run_diff("--keep-intermediate")
+                self.assertNotIn("Reusing cached results", result.stdout + result.stderr)
+                for level in VALUES:
+                        self.assertTrue(os.path.exists(os.path.join(self.outdir, "temp", "d.diff.input.IRI.{}.txt".format(level))))
+
+        def test_keep_intermediate_rerun_restores_the_intermediate_files(self):
+                self.run_diff("--keep-intermediate")
+                for level in VALUES:
+                        os.remove(os.path.join(self.outdir, "temp", "d.diff.input.IRI.{}.txt".format(level)))
+                result = self.run_diff("--keep-intermediate")
+                self.assertIn("Reusing cached results", result.stdout + result.stderr)
+                for level in VALUES:
+                        self.assertTrue(os.path.exists(os.path.join(self.outdir, "temp", "d.diff.input.IRI.{}.txt".format(level))))
+
+if __name__ == "__main__":
+        unittest.main()